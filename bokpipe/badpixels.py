@@ -7,7 +7,7 @@ from astropy.stats import sigma_clip
 import fitsio
 
 from .bokio import FileNameMap
-from .bokutil import rebin,BokMefImage,BokProcess
+from .bokutil import rebin,BokMefImage,BokProcess,read_image
 from .bokdm import SimpleFileNameMap
 from .bokproc import NormalizeFlat,combine_ccds
 
@@ -77,6 +77,6 @@ def make_sextractor_gain_map(flatFn,bpMaskFn,gainMapFn,**kwargs):
 	mask = fitsio.FITS(bpMaskFn)
 	for extName,data,hdr in flat:
 		# invert the mask, makes bad pixels = 0
-		data *= (1 - mask[extName].read())
+		data *= (1 - read_image(mask[extName]))
 		flat.update(data,hdr)
 	flat.close()
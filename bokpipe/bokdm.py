@@ -2,12 +2,15 @@
 
 import os
 import pickle
+import threading
+from copy import copy
 import numpy as np
 from numpy.core.defchararray import add as char_add
 from astropy.table import Table
 
-from .bokio import FileNameMap,IdentityNameMap
+from .bokio import FileNameMap,IdentityNameMap,StoreNameMap
 from .bokutil import FakeFITS,array_stats,stats_region,load_mask
+from .bokutil import open_calibration
 
 ##############################################################################
 #                                                                            #
@@ -106,7 +109,7 @@ default_filenames = {
   'oscan':'','bias':'_b','proc1':'_p','comb':'_c','weight':'.wht',
   'imgmask':'.dq','pass1cat':'.cat1','skymask':'.skymsk','skyfit':'.sky',
   'sky':'_s','proc2':'_q','wcscat':'.wcscat',
-  'cat':'.cat','psf':'.psf'
+  'cat':'.cat','psf':'.psf','oscanfit':'.oscfit'
 }
 
 class SimpleFileNameMap(FileNameMap):
@@ -132,12 +135,17 @@ class SimpleFileNameMap(FileNameMap):
 #####
 
 class BokCalibrator(object):
+	# number of times calibration images have been read in
+	nLoads = 0
 	def setTarget(self,f):
 		raise NotImplementedError
 	def getImage(self,extn):
 		raise NotImplementedError
 	def getFileName(self):
 		raise NotImplementedError
+	def getCalKey(self,f):
+		'''the calibration file that would be used for f'''
+		return None
 	def __getitem__(self,extn):
 		return self.getImage(extn)
 
@@ -148,16 +156,24 @@ class NullCalibrator(BokCalibrator):
 		return None
 	def getFileName(self):
 		return None
+	def getCalKey(self,f):
+		return None
 
 class MasterCalibrator(BokCalibrator):
+	# the image is loaded on first use, which may be from an HDU thread
+	_loadLock = threading.Lock()
 	def __init__(self,masterFile):
 		super(MasterCalibrator,self).__init__()
 		self.masterFile = masterFile
 		self.masterFits = None
 	def _load_fits(self):
-		if self.masterFits is None:
-			print 'Loading master cal ',os.path.basename(self.masterFile)
-			self.masterFits = FakeFITS(self.masterFile)
+		if self.masterFits is not None:
+			return
+		with self._loadLock:
+			if self.masterFits is None:
+				print 'Loading master cal ',os.path.basename(self.masterFile)
+				self.masterFits = open_calibration(self.masterFile)
+				self.nLoads += 1
 	def setTarget(self,f):
 		pass
 	def getImage(self,extn):
@@ -165,6 +181,8 @@ class MasterCalibrator(BokCalibrator):
 		return self.masterFits[extn]
 	def getFileName(self):
 		return self.masterFile
+	def getCalKey(self,f):
+		return self.masterFile
 	def __call__(self,f):
 		self._load_fits()
 		return self.masterFits
@@ -184,17 +202,37 @@ class CalibratorMap(BokCalibrator):
 			for filt in np.unique(calTab['filter']):
 				ii = np.where(calTab['filter'] == filt)[0]
 				jj = np.where((obsDb['filter'] == filt) & domap)[0]
-				for j in jj:
-					k = os.path.join(obsDb['utDir'][j],obsDb['fileName'][j])
-					dt = np.abs(obsDb['mjdStart'][j]-calTab['mjd'][ii])
-					i = np.argmin(dt)
-					self.calMap[k] = self.nameMap(calTab['fileName'][ii[i]])
+				self._map_nearest(obsDb,jj,calTab,ii)
 		else:
 			jj = np.where(domap)[0]
-			for j in jj:
-				i = np.argmin(np.abs(obsDb['mjdStart'][j]-calTab['mjd']))
-				k = os.path.join(obsDb['utDir'][j],obsDb['fileName'][j])
-				self.calMap[k] = self.nameMap(calTab['fileName'][i])
+			self._map_nearest(obsDb,jj,calTab,np.arange(len(calTab)))
+	@staticmethod
+	def _nearest(mjd,calMjd):
+		'''index of the nearest calMjd value for each mjd, with ties going
+		   to the first entry in calMjd (as in np.argmin(abs(dt)))'''
+		order = np.argsort(calMjd,kind='mergesort')
+		s = calMjd[order]
+		i = np.searchsorted(s,mjd)
+		lo = np.clip(i-1,0,len(s)-1)
+		hi = np.clip(i,0,len(s)-1)
+		# with a stable sort the first of a run of equal values has the
+		# lowest index in calMjd
+		lo = np.searchsorted(s,s[lo])
+		hi = np.searchsorted(s,s[hi])
+		dlo = np.abs(mjd-s[lo])
+		dhi = np.abs(mjd-s[hi])
+		usehi = (dhi < dlo) | ((dhi == dlo) & (order[hi] < order[lo]))
+		return np.where(usehi,order[hi],order[lo])
+	def _map_nearest(self,obsDb,jj,calTab,ii):
+		if len(jj) == 0:
+			return
+		nearest = ii[self._nearest(np.asarray(obsDb['mjdStart'][jj]),
+		                           np.asarray(calTab['mjd'][ii]))]
+		calNames = { i:self.nameMap(calTab['fileName'][i]) 
+		                for i in np.unique(nearest) }
+		for j,i in zip(jj,nearest):
+			k = os.path.join(obsDb['utDir'][j],obsDb['fileName'][j])
+			self.calMap[k] = calNames[i]
 	def setTarget(self,f):
 		try:
 			cal = self.calMap[f]
@@ -211,7 +249,8 @@ class CalibratorMap(BokCalibrator):
 			if self.currentFits:
 				self.currentFits.close()
 			self.currentFile = cal
-			self.currentFits = FakeFITS(self.currentFile)
+			self.currentFits = open_calibration(self.currentFile)
+			self.nLoads += 1
 			return True
 		return False
 	def getImage(self,extn):
@@ -223,6 +262,8 @@ class CalibratorMap(BokCalibrator):
 		return self.currentFits[extn]
 	def getFileName(self):
 		return self.currentFile
+	def getCalKey(self,f):
+		return self.calMap.get(f)
 
 class FringeMap(CalibratorMap):
 	'''Special case of CalibratorMap -- fringe images need be scaled to
@@ -286,6 +327,9 @@ class BokDataManager(object):
 		self._tmpInput = False
 		self._tmpOutput = False
 		self._tmpDir = os.path.join(self.procDir,'tmp')
+		self.fileStore = None
+		self.storeProducts = []
+		self.storageTypes = {}
 		self.refCatDir = None
 		self.fileSuffixes = default_filenames
 		self.setInPlace(True)
@@ -350,6 +394,30 @@ class BokDataManager(object):
 		self.diagDir = diagDir
 	def getTmpDir(self):
 		return self._tmpDir
+	def setFileStore(self,fileStore,products=['bias','tmp']):
+		'''keep the listed products (file types, or 'tmp' for the files
+		   in the tmp directory) in fileStore (bokio.TmpfsFileStore)'''
+		self.fileStore = fileStore
+		self.storeProducts = products if fileStore is not None else []
+	def getFileStore(self):
+		return self.fileStore
+	def setStorage(self,products,storage='int16',quantLevel=4.):
+		'''store the listed products with the given storage type (see
+		   bokutil.storage_types), picked up by the processes through the
+		   name maps'''
+		for t in products:
+			self.storageTypes[t] = (storage,quantLevel)
+	def getTmpMap(self,subDir=None):
+		'''name map for temporary files'''
+		tmpDir = self._tmpDir
+		if subDir is not None:
+			tmpDir = os.path.join(tmpDir,subDir)
+		nameMap = FileNameMap(tmpDir)
+		if 'tmp' in self.storeProducts:
+			nameMap = StoreNameMap(self.fileStore,nameMap)
+		elif not os.path.exists(tmpDir):
+			os.makedirs(tmpDir)
+		return nameMap
 	def setUtDates(self,utDates):
 		# allows a range of dates to be specified by simply shortening the
 		# string, i.e., '2014' is equivalent to '2014*'
@@ -478,10 +546,20 @@ class BokDataManager(object):
 		self.inPlace = inPlace
 		if self.inPlace:
 			self.filesToMap = ['oscan','pass1cat','weight','imgmask',
-			                   'skymask','skyfit','wcscat','cat','psf']
+			                   'skymask','skyfit','wcscat','cat','psf',
+			                   'oscanfit']
 		else:
 			self.filesToMap = self.fileSuffixes.keys()
 	def __call__(self,t):
+		nameMap = self._name_map(t)
+		if t in self.storeProducts:
+			nameMap = StoreNameMap(self.fileStore,nameMap)
+		if t in self.storageTypes:
+			# some maps are shared between products (e.g., cal)
+			nameMap = copy(nameMap)
+			nameMap.storage,nameMap.quantLevel = self.storageTypes[t]
+		return nameMap
+	def _name_map(self,t):
 		procDir = self.procDir
 		if t in self._all_process_steps:
 			if self.firstStep is None:
@@ -116,7 +116,7 @@ class FocalPlaneMap(object):
 						fitsim = fitsio.FITS(fitsfn)
 					except IOError:
 						continue
-					ims = np.array([hdu.read() for hdu in fitsim[1:]])
+					ims = np.array([bokutil.read_image(hdu) for hdu in fitsim[1:]])
 					if False: #s == 'mean':
 						_vmin,_vmax = vmin,vmax
 					else:
@@ -243,7 +243,7 @@ def check_sky_level(fileName,maskFile=None,statreg='ccd_central_quadrant',
 	for i in range(4):
 		ax = plt.subplot(2,2,i+1)
 		extn = 'CCD%d'%(i+1)
-		pix = fits[extn].read()[statsPix]
+		pix = bokutil.read_image(fits[extn])[statsPix]
 		if maskFits is not None:
 			pix = np.ma.masked_array(pix,
 			                         mask=maskFits[extn].read()[statsPix]>0)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import shutil
+import fcntl
+from contextlib import contextmanager
+from time import time
 
 def IdentityNameMap(f):
 	return f
@@ -32,3 +36,152 @@ class FileRenameMap(object):
 	def __call__(self,fileName):
 		return self.inputMap(fileName).replace('.fits',self.newSuffix+'.fits')
 
+
+def _makedirs(d):
+	if not os.path.exists(d):
+		try:
+			os.makedirs(d)
+		except OSError:
+			pass # created by another process
+
+_lockFile = '.storelock'
+
+class TmpfsFileStore(object):
+	'''Keeps files on a memory-backed filesystem in place of their paths on
+	   disk, so that intermediate products which are written and soon
+	   deleted never touch the disk. Files are addressed by their usual
+	   (disk) paths through resolve(), which returns the stored copy if
+	   there is one, the disk file if it exists, and otherwise a location
+	   in the store for a new file (or the disk path when the store is full).
+	   When the store exceeds capacity MB the least recently used files are
+	   spilled to their disk paths (unless spill=False, in which case new
+	   files go straight to disk). Files used within the last min_age
+	   seconds are never spilled, as they may still be open for writing.
+	   resolve() and spilling take a lock file in the store, and resolve()
+	   marks the file it returns as used, so it can't be spilled before the
+	   caller opens it (within min_age).
+	   The state lives entirely in the store directory, so the object can
+	   be passed to worker processes with the name maps.'''
+	def __init__(self,storeDir=None,capacity=4096,spill=True,min_age=60):
+		if storeDir is None:
+			storeDir = os.path.join('/dev/shm','bokstore_%d' % os.getpid())
+		self.storeDir = os.path.abspath(storeDir)
+		self.capacity = capacity * 1024**2
+		self.spill = spill
+		self.minAge = min_age
+		self.nSpilled = 0
+		self.bytesSpilled = 0
+	def storePath(self,path):
+		return os.path.join(self.storeDir,os.path.abspath(path).lstrip(os.sep))
+	def diskPath(self,storePath):
+		return os.path.join(os.sep,os.path.relpath(storePath,self.storeDir))
+	@contextmanager
+	def _locked(self):
+		# serializes resolve and spill between the worker processes
+		_makedirs(self.storeDir)
+		with open(os.path.join(self.storeDir,_lockFile),'a') as lockf:
+			fcntl.flock(lockf,fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lockf,fcntl.LOCK_UN)
+	def resolve(self,path):
+		if os.path.abspath(path).startswith(self.storeDir+os.sep):
+			return path
+		with self._locked():
+			return self._resolve(path)
+	def _resolve(self,path):
+		storePath = self.storePath(path)
+		if os.path.exists(storePath):
+			# mark as recently used
+			try:
+				os.utime(storePath,None)
+				return storePath
+			except OSError:
+				pass # deleted in the meantime
+		for sfx in ['','.fz','.gz']:
+			if os.path.exists(path+sfx):
+				return path
+		if not self._make_room():
+			return path
+		_makedirs(os.path.dirname(storePath))
+		return storePath
+	def files(self):
+		'''list of (path,nbytes,mtime) for the files in the store'''
+		rv = []
+		for d,dirs,files in os.walk(self.storeDir):
+			for fn in files:
+				if d == self.storeDir and fn == _lockFile:
+					continue
+				f = os.path.join(d,fn)
+				try:
+					st = os.stat(f)
+				except OSError:
+					continue
+				rv.append((f,st.st_size,st.st_mtime))
+		return rv
+	def usage(self):
+		return sum([ nbytes for f,nbytes,mtime in self.files() ])
+	def _spill_file(self,storePath):
+		diskPath = self.diskPath(storePath)
+		diskDir = os.path.dirname(diskPath)
+		if not os.path.exists(diskDir):
+			os.makedirs(diskDir)
+		nbytes = os.path.getsize(storePath)
+		# copy then rename, so the disk path is never seen half-written
+		shutil.copy2(storePath,diskPath+'.spill')
+		os.rename(diskPath+'.spill',diskPath)
+		os.unlink(storePath)
+		self.nSpilled += 1
+		self.bytesSpilled += nbytes
+		return nbytes
+	def _make_room(self):
+		files = self.files()
+		used = sum([ nbytes for f,nbytes,mtime in files ])
+		# guess the size of the new file from the ones already stored
+		need = used // len(files) if len(files) > 0 else 0
+		if used + need <= self.capacity:
+			return True
+		if not self.spill:
+			return False
+		now = time()
+		for f,nbytes,mtime in sorted(files,key=lambda x: x[2]):
+			if now - mtime < self.minAge:
+				break
+			try:
+				used -= self._spill_file(f)
+			except (IOError,OSError):
+				continue # deleted or spilled by another process
+			if used + need <= self.capacity:
+				return True
+		return used + need <= self.capacity
+	def flush(self):
+		'''spill all stored files to disk'''
+		if not os.path.exists(self.storeDir):
+			return
+		with self._locked():
+			for f,nbytes,mtime in self.files():
+				try:
+					self._spill_file(f)
+				except (IOError,OSError):
+					pass
+	def clear(self):
+		if os.path.exists(self.storeDir):
+			shutil.rmtree(self.storeDir)
+	def report(self):
+		'''contents of the store, and what this process has spilled'''
+		files = self.files()
+		return {'nfiles':len(files),
+		        'nbytes':sum([ nbytes for f,nbytes,mtime in files ]),
+		        'nspilled':self.nSpilled,'bytes_spilled':self.bytesSpilled}
+
+class StoreNameMap(object):
+	'''resolves the names from nameMap through a TmpfsFileStore'''
+	def __init__(self,store,nameMap):
+		self.store = store
+		self.nameMap = nameMap
+	def __call__(self,fileName):
+		f = self.nameMap(fileName)
+		if f is None:
+			return None
+		return self.store.resolve(f)
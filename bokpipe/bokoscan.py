@@ -2,13 +2,15 @@
 
 import os
 import re
-from collections import OrderedDict
+import hashlib
+from collections import OrderedDict,defaultdict
 import numpy as np
 from scipy.ndimage.filters import median_filter
 from scipy.interpolate import LSQUnivariateSpline
 import fitsio
 
-from .bokutil import BokProcess,array_clip,mask_saturation
+from .bokutil import BokProcess,array_clip,mask_saturation,get_clip_engine
+from .bokstats import nan_clip
 
 # argh
 ampOrder = [ 4,  3,  2,  1,  8,  7,  6,  5,  9, 10, 11, 12, 13, 14, 15, 16 ]
@@ -40,23 +42,49 @@ def extract_overscan(data,hdr):
 	data = data[y1:y2,x1:x2].astype(np.float32)
 	return ( data,overscan_cols,overscan_rows )
 
+def trim_overscan(data,hdr):
+	'''trim an amplifier image to DATASEC, converted to floats'''
+	x1,x2,y1,y2 = _convertfitsreg(hdr['DATASEC'])
+	return data[y1:y2,x1:x2].astype(np.float32)
+
+def read_overscan(fits,extName,hdr):
+	'''Read just the overscan regions of an amplifier from a BokMefImage
+	   (subset reads), returning the same overscan_cols and overscan_rows
+	   as extract_overscan'''
+	x1,x2,y1,y2 = _convertfitsreg(hdr['BIASSEC'])
+	overscan_cols = fits.get(extName,np.s_[y1:y2,x1:x2]).astype(np.float32)
+	x1,x2,y1,y2 = _convertfitsreg(hdr['DATASEC'])
+	if hdr['NAXIS2'] > y2+1:
+		overscan_rows = fits.get(extName,np.s_[y2:hdr['NAXIS2'],
+		                                       0:hdr['NAXIS1']])
+		overscan_rows = overscan_rows.astype(np.float32)
+	else:
+		overscan_rows = None
+	return overscan_cols,overscan_rows
+
 oscan_fit_keywords = ['reject','method','apply_filter','filter_window',
                       'mask_along','clip_iters','clip_sig',
                       'spline_nknots','spline_niter']
 
+def _pop_fit_args(kwargs):
+	# the arguments to fit_overscan that aren't passed on to array_clip
+	return dict(reject=kwargs.pop('reject','sigma_clip'),
+	            method=kwargs.pop('method','mean'),
+	            applyFilter=kwargs.pop('apply_filter','median'),
+	            windowSize=kwargs.pop('filter_window',31),
+	            maskAlong=kwargs.pop('mask_along',[0,1,2,-1]),
+	            along=kwargs.pop('along','columns'),
+	            spline_nknots=kwargs.pop('spline_nknots',7),
+	            spline_niter=kwargs.pop('spline_niter',2))
+
 def fit_overscan(overscan,**kwargs):
-	reject = kwargs.pop('reject','sigma_clip')
-	method = kwargs.pop('method','mean')
-	applyFilter = kwargs.pop('apply_filter','median')
-	windowSize = kwargs.pop('filter_window',31)
-	maskAlong = kwargs.pop('mask_along',[0,1,2,-1])
-	along = kwargs.pop('along','columns')
-	spline_nknots = kwargs.pop('spline_nknots',7)
-	spline_niter = kwargs.pop('spline_niter',2)
+	fitArgs = _pop_fit_args(kwargs)
+	reject = fitArgs['reject']
+	maskAlong = fitArgs['maskAlong']
+	along = fitArgs['along']
 	if along == 'rows':
 		# make it look like a column overscan for simplicity
 		overscan = overscan.transpose()
-	npix = overscan.shape[0]
 	#
 	overscan = np.ma.masked_array(overscan)
 	overscan[:,maskAlong] = np.ma.masked
@@ -76,6 +104,11 @@ def fit_overscan(overscan,**kwargs):
 		overscan = array_clip(overscan,axis=0,
 		                      clip_iters=None,clip_sig=3.5,
 		                      clip_cenfunc=np.ma.median)
+	return _collapse_overscan(overscan,**fitArgs)
+
+def _collapse_overscan(overscan,method,applyFilter,windowSize,
+                       spline_nknots,spline_niter,**kwargs):
+	npix = overscan.shape[0]
 	# collapse overscan into scalar or vector
 	if method == 'mean':
 		oscan_fit = overscan.mean(axis=1)
@@ -110,6 +143,126 @@ def fit_overscan(overscan,**kwargs):
 			oscan_fit = median_filter(oscan_fit,windowSize)
 	return oscan_fit
 
+def _median_stack(data,mask,cnt,axis):
+	# np.ma.median along axis (same float32 average of the middle pair),
+	# sorting with the masked values as NaN which go to the end
+	s = np.sort(np.where(mask,np.float32(np.nan),data),axis=axis)
+	h = cnt // 2
+	l = np.where(cnt % 2 == 1,h,np.maximum(h-1,0))
+	ii = list(np.ogrid[tuple(slice(0,n) for n in cnt.shape)])
+	ii[axis] = l
+	lo = s[tuple(ii)]
+	ii[axis] = np.minimum(h,s.shape[axis]-1)
+	hi = s[tuple(ii)]
+	med = lo + hi
+	med /= 2.
+	return med
+
+def _batch_clip(data,mask,axis,clip_sig=2.5,clip_iters=2,
+                clip_cenfunc=np.ma.mean):
+	'''array_clip along axis for each image in a stack, done for the whole
+	   stack in single numpy calls. Rejected pixels are added to mask in
+	   place and are exactly those array_clip rejects image by image; for
+	   the astropy engine this means reproducing the masked array
+	   arithmetic of sigma_clip (float64 mean and rms, separate upper and
+	   lower limits, in-place float32 upper limit for median centers).'''
+	if get_clip_engine() == 'nan':
+		work = np.where(mask,np.float32(np.nan),data)
+		nan_clip(work,axis=axis,clip_sig=clip_sig,clip_iters=clip_iters,
+		         clip_cenfunc=clip_cenfunc)
+		mask |= np.isnan(work)
+		return mask
+	if clip_cenfunc not in [np.ma.mean,np.ma.median]:
+		raise ValueError('clip center function %s unsupported' % clip_cenfunc)
+	niter = 0
+	with np.errstate(invalid='ignore',divide='ignore'):
+		while clip_iters is None or niter < clip_iters:
+			good = ~mask
+			cnt = good.sum(axis=axis,keepdims=True)
+			dsum = np.where(mask,data.dtype.type(0),data).sum(axis=axis,
+			                                                 keepdims=True)
+			mean = dsum * 1. / cnt
+			anom = np.where(mask,0.,data - mean)
+			anom *= anom
+			std = np.sqrt(anom.sum(axis=axis,keepdims=True) / cnt)
+			std *= clip_sig
+			if clip_cenfunc is np.ma.median:
+				cen = _median_stack(data,mask,cnt,axis)
+			else:
+				cen = mean
+			lo = cen - std
+			hi = cen.copy()
+			hi += std
+			rej = good & ((data > hi) | (data < lo))
+			niter += 1
+			if not rej.any():
+				break
+			mask |= rej
+	return mask
+
+def _fit_overscan_stack(overscans,**kwargs):
+	fitArgs = _pop_fit_args(kwargs)
+	reject = fitArgs['reject']
+	maskAlong = fitArgs['maskAlong']
+	along = fitArgs['along']
+	mask = np.array([ np.ma.getmaskarray(o) for o in overscans ])
+	data = np.array([ np.ma.getdata(o) for o in overscans ])
+	if along == 'rows':
+		# make it look like a column overscan for simplicity
+		# (as a view, so the reductions run in the same order)
+		data = data.transpose(0,2,1)
+		mask = mask.transpose(0,2,1)
+	mask |= ~np.isfinite(data)
+	mask[:,:,maskAlong] = True
+	if along == 'rows':
+		mask[:,maskAlong,:] = True
+	if reject == 'sigma_clip':
+		_batch_clip(data,mask,2,**kwargs)
+	elif reject == 'minmax':
+		for d,m in zip(data,mask):
+			# same fill values as np.ma.argmax/argmin
+			m[:,np.where(m,-np.inf,d).argmax(axis=1)] = True
+			m[:,np.where(m,np.inf,d).argmin(axis=1)] = True
+	_batch_clip(data,mask,1,clip_iters=None,clip_sig=3.5,
+	            clip_cenfunc=np.ma.median)
+	if fitArgs['method'] == 'mean':
+		return _collapse_mean_stack(data,mask,**fitArgs)
+	return [ _collapse_overscan(np.ma.masked_array(d,mask=m),**fitArgs)
+	           for d,m in zip(data,mask) ]
+
+def _collapse_mean_stack(data,mask,applyFilter,windowSize,**kwargs):
+	# method='mean' of _collapse_overscan for a stack, with the vector
+	# rejection done for all the images at once
+	cnt = (~mask).sum(axis=2)
+	dsum = np.where(mask,data.dtype.type(0),data).sum(axis=2)
+	with np.errstate(invalid='ignore',divide='ignore'):
+		fits = dsum * 1. / cnt
+	fitmask = cnt == 0
+	_batch_clip(fits,fitmask,1,clip_iters=None,clip_sig=3.0,
+	            clip_cenfunc=np.ma.mean)
+	rv = []
+	for fit,m in zip(fits,fitmask):
+		fit = np.ma.masked_array(fit,mask=m)
+		fit = fit.filled(np.ma.median(fit))
+		if applyFilter == 'median':
+			fit = median_filter(fit,windowSize)
+		rv.append(fit)
+	return rv
+
+def fit_overscan_batch(overscans,**kwargs):
+	'''Fit a list of overscan strips (e.g., from all 16 amplifiers) at once.
+	   Strips with the same shape are stacked and clipped together, the
+	   fits are identical to calling fit_overscan on each strip.'''
+	rv = [None] * len(overscans)
+	groups = defaultdict(list)
+	for i,o in enumerate(overscans):
+		groups[o.shape].append(i)
+	for shape,ii in groups.items():
+		fits = _fit_overscan_stack([ overscans[i] for i in ii ],**kwargs)
+		for i,fit in zip(ii,fits):
+			rv[i] = fit
+	return rv
+
 def overscan_subtract(data,hdr,returnFull=False,row_kwargs=None,**kwargs):
 	data,oscan_cols,oscan_rows = extract_overscan(data,hdr)
 	colbias = fit_overscan(oscan_cols,**kwargs)
@@ -132,64 +285,267 @@ def overscan_subtract(data,hdr,returnFull=False,row_kwargs=None,**kwargs):
 	else:
 		return data
 
+def fit_overscans(oscanCols,oscanRows,row_kwargs=None,**kwargs):
+	'''The overscan fits of overscan_subtract for a set of amplifiers at
+	   once (see fit_overscan_batch). oscanRows has None for amplifiers 
+	   without overscan rows. Returns the lists colbias, oscan_rows (with
+	   the column overscan subtracted) and rowbias.'''
+	colbias = fit_overscan_batch(oscanCols,**kwargs)
+	ii = [ i for i,rows in enumerate(oscanRows) if rows is not None ]
+	oscanRows = list(oscanRows)
+	rowbias = [None] * len(oscanRows)
+	if len(ii) > 0:
+		# XXX hardcoded geometry, as in overscan_subtract
+		_colbias = fit_overscan_batch([ oscanRows[i][:,-20:] for i in ii ],
+		                              **kwargs)
+		for i,cb in zip(ii,_colbias):
+			oscanRows[i] = oscanRows[i][:,:-20] - cb[:,np.newaxis]
+		if row_kwargs is None: 
+			row_kwargs = {'method':'cubic_spline'}
+		fits = fit_overscan_batch([ oscanRows[i] for i in ii ],
+		                          along='rows',**row_kwargs)
+		for i,rb in zip(ii,fits):
+			rowbias[i] = rb
+	return colbias,oscanRows,rowbias
+
+def subtract_overscan_fit(data,hdr,colbias,rowbias):
+	'''trim data and subtract overscan fits (from fit_overscans)'''
+	data = trim_overscan(data,hdr)
+	data[:] -= colbias[:,np.newaxis]
+	if rowbias is not None:
+		data[:] -= rowbias[np.newaxis,:data.shape[1]]
+	return data
+
+def raw_file_key(fileName):
+	'''A cheap identity for a raw file: size, modification time, and a hash
+	   of the first and last FITS blocks'''
+	st = os.stat(fileName)
+	h = hashlib.md5()
+	with open(fileName,'rb') as f:
+		h.update(f.read(2880))
+		f.seek(max(0,st.st_size-2880))
+		h.update(f.read(2880))
+	return '%d-%d-%s' % (st.st_size,int(st.st_mtime),h.hexdigest())
+
+def _fit_args_card(fitArgs,rowFitArgs=None):
+	'''the overscan fit arguments as a header value, with the arguments of
+	   the row fit prefixed by row_'''
+	args = dict(fitArgs)
+	if rowFitArgs is not None:
+		args.update({ 'row_'+k:v for k,v in rowFitArgs.items() })
+	return ','.join('%s=%s' % kv for kv in sorted(args.items()))
+
+def write_overscan_sidecar(sidecarFile,rawFile,extns,oscanCols,colbias,
+                           rowbias,fitArgs={},rowFitArgs=None):
+	'''Save the overscan models of a frame to a small FITS table: the median
+	   of the raw overscan columns, the fitted column and row bias vectors,
+	   and the rms of the fit residuals, per amplifier. The table is keyed 
+	   to the raw file (raw_file_key) so that stale sidecars are ignored,
+	   and records the fit arguments (as passed to overscan_subtract).'''
+	ncol = max(len(cb) for cb in colbias)
+	nrow = max([ len(rb) for rb in rowbias if rb is not None ] + [1])
+	tab = np.zeros(len(extns),dtype=[('extName','S8'),('oscanMed','f8'),
+	                                 ('residRms','f4'),('nColBias','i4'),
+	                                 ('colBias','f8',ncol),('nRowBias','i4'),
+	                                 ('rowBias','f8',nrow)])
+	for i,(extn,oscan,cb,rb) in enumerate(zip(extns,oscanCols,
+	                                          colbias,rowbias)):
+		tab['extName'][i] = extn
+		tab['oscanMed'][i] = np.median(oscan)
+		tab['residRms'][i] = np.ma.std(oscan - cb[:,np.newaxis])
+		tab['nColBias'][i] = len(cb)
+		tab['colBias'][i,:len(cb)] = cb
+		if rb is not None:
+			tab['nRowBias'][i] = len(rb)
+			tab['rowBias'][i,:len(rb)] = rb
+	hdr = OrderedDict()
+	hdr['RAWFILE'] = os.path.basename(rawFile)
+	hdr['RAWKEY'] = raw_file_key(rawFile)
+	hdr['OSCANFIT'] = _fit_args_card(fitArgs,rowFitArgs)
+	# written aside and moved into place so readers never see a partial file
+	tmpFile = sidecarFile+'.tmp%d' % os.getpid()
+	if os.path.exists(tmpFile):
+		os.unlink(tmpFile)
+	sideFits = fitsio.FITS(tmpFile,'rw')
+	sideFits.write(tab,header=hdr,extname='OSCANFIT')
+	sideFits.close()
+	os.rename(tmpFile,sidecarFile)
+
+def load_overscan_sidecar(sidecarFile,rawFile,fit_args=None,
+                          row_fit_args=None):
+	'''Load the overscan models saved by write_overscan_sidecar, returns
+	   { extName:(oscanMed,colbias,rowbias,residRms) }, or None if the
+	   sidecar is missing or was made from a different raw file. If
+	   fit_args is given, None is also returned unless the models were fit
+	   with those arguments (and row_fit_args), e.g., fit_args={} for the 
+	   defaults of overscan_subtract.'''
+	try:
+		sideFits = fitsio.FITS(sidecarFile)
+	except IOError:
+		return None
+	try:
+		hdr = sideFits[1].read_header()
+		if hdr['RAWKEY'] != raw_file_key(rawFile):
+			return None
+		if fit_args is not None and \
+		     (hdr.get('OSCANFIT') or '') != _fit_args_card(fit_args,
+		                                                   row_fit_args):
+			return None
+		tab = sideFits[1].read()
+	finally:
+		sideFits.close()
+	rv = {}
+	for row in tab:
+		rowbias = row['rowBias'][:row['nRowBias']] if row['nRowBias'] > 0 \
+		             else None
+		rv[row['extName'].strip()] = (row['oscanMed'],
+		                              row['colBias'][:row['nColBias']],
+		                              rowbias,row['residRms'])
+	return rv
+
 class OverscanCollection(object):
-	def __init__(self,oscanImgFile,along='columns'):
+	'''Accumulates the overscan strips and fit residuals of one amplifier
+	   in an append-only store of fixed-width records, one per frame. Each
+	   record (file name, MJD, median overscan, overscan and residual
+	   strips) goes to disk with a single O_APPEND write, so pool workers
+	   can append concurrently. The store is read back through a memmap
+	   when writing the final image. With incremental=True the store is
+	   kept between runs and new frames are added to the existing history,
+	   a frame processed again replaces its earlier record.'''
+	_hdrSize = 512
+	_magic = 'BOKOSCAN'
+	def __init__(self,oscanImgFile,along='columns',incremental=False):
 		self.along = along
 		self.imgFile = oscanImgFile
-		if along=='columns':
-			self.arr_stack = np.hstack
-		else:
-			self.arr_stack = np.vstack
-		self.tmpfn1 = oscanImgFile+'_oscantmp.npy'
-		self.tmpfn2 = oscanImgFile+'_restmp.npy'
-		if os.path.exists(self.tmpfn1):
-			os.unlink(self.tmpfn1)
-		if os.path.exists(self.tmpfn2):
-			os.unlink(self.tmpfn2)
-		self.tmpOscanImgFile = open(self.tmpfn1,'ab')
-		self.tmpOscanResImgFile = open(self.tmpfn2,'ab')
-		self.files = []
+		self.incremental = incremental
+		self.storeFile = oscanImgFile+'_oscanhist.dat'
+		if not incremental and os.path.exists(self.storeFile):
+			os.unlink(self.storeFile)
 	def close(self):
-		os.unlink(self.tmpfn1)
-		os.unlink(self.tmpfn2)
-	def append(self,oscan,oscanFit,fileName):
+		if not self.incremental and os.path.exists(self.storeFile):
+			os.unlink(self.storeFile)
+	@staticmethod
+	def _dtype(dtype,shape):
+		return np.dtype([('file','S80'),('mjd','f8'),('oscanmed','f4'),
+		                 ('oscan',dtype,shape),('resid','f4',shape)])
+	def _read_header(self):
+		try:
+			with open(self.storeFile,'rb') as f:
+				hdr = f.read(self._hdrSize).split()
+		except IOError:
+			return None
+		if len(hdr) < 5 or hdr[0] != self._magic:
+			raise ValueError('%s is not an overscan store' % self.storeFile)
+		return hdr[1],hdr[2],tuple(int(n) for n in hdr[3:])
+	def _create(self,dtype,shape):
+		info = self._read_header()
+		if info is None:
+			# the header goes in with an atomic link so that no other
+			# process can append to a store without one
+			hdr = ' '.join([self._magic,self.along,dtype.str]+map(str,shape))
+			tmpFile = self.storeFile+'.%d' % os.getpid()
+			with open(tmpFile,'wb') as f:
+				f.write(hdr.ljust(self._hdrSize))
+			try:
+				os.link(tmpFile,self.storeFile)
+			except OSError:
+				pass # someone else got there first
+			finally:
+				os.unlink(tmpFile)
+			info = self._read_header()
+		if info != (self.along,dtype.str,shape):
+			raise ValueError('overscan store %s has %s %s %s, got %s %s %s' %
+			                 ((self.storeFile,)+info+
+			                  (self.along,dtype.str,shape)))
+	def append(self,oscan,oscanFit,fileName,mjd=np.nan):
 		if self.along=='columns':
 			resim = (oscan - oscanFit[:,np.newaxis]).astype(np.float32)
 		else:
 			resim = (oscan - oscanFit[np.newaxis,:]).astype(np.float32)
+		dtype = np.dtype(np.float32) if oscan.dtype.itemsize <= 4 \
+		                              else np.dtype(np.float64)
+		self._create(dtype,oscan.shape)
+		rec = np.zeros(1,dtype=self._dtype(dtype,oscan.shape))
+		rec['file'] = os.path.basename(fileName)
+		rec['mjd'] = np.nan if mjd is None else mjd
+		rec['oscanmed'] = np.ma.median(oscanFit)
+		rec['oscan'] = np.ma.filled(oscan,np.nan)
+		rec['resid'] = np.ma.filled(resim,np.nan)
+		buf = rec.tobytes()
+		fd = os.open(self.storeFile,os.O_WRONLY|os.O_APPEND)
 		try:
-			np.save(self.tmpOscanImgFile,oscan.filled(np.nan))
-		except:
-			np.save(self.tmpOscanImgFile,oscan)
-		np.save(self.tmpOscanResImgFile,resim)
-		self.files.append(os.path.basename(fileName))
-	def write_image(self):
-		self.tmpOscanImgFile.close() # could just reset file pointer?
-		self.tmpOscanResImgFile.close()
-		nfiles = len(self.files)
-		if nfiles==0:
+			if os.write(fd,buf) != len(buf):
+				raise IOError('short write to %s' % self.storeFile)
+		finally:
+			os.close(fd)
+	def records(self):
+		'''memmap of the stored records, the latest one for each frame,
+		   ordered by (mjd,file)'''
+		info = self._read_header()
+		if info is None:
+			return None
+		dtype = self._dtype(*info[1:])
+		# a partial record at the end (from a crashed writer) is ignored
+		n = (os.path.getsize(self.storeFile)-self._hdrSize) // dtype.itemsize
+		if n == 0:
+			return None
+		recs = np.memmap(self.storeFile,dtype=dtype,mode='r',
+		                 offset=self._hdrSize,shape=(n,))
+		_,ii = np.unique(recs['file'][::-1],return_index=True)
+		if len(ii) < n:
+			recs = recs[np.sort(n-1-ii)]
+		# the workers append in completion order
+		order = np.lexsort((recs['file'],recs['mjd']))
+		if np.any(order != np.arange(len(recs))):
+			recs = recs[order]
+		return recs
+	def frame_table(self):
+		'''per-frame metadata (file, mjd, oscanmed) for trend plots'''
+		recs = self.records()
+		if recs is None:
+			return None
+		tab = np.empty(len(recs),dtype=[('file','S80'),('mjd','f8'),
+		                                ('oscanmed','f4')])
+		for k in tab.dtype.names:
+			tab[k] = recs[k]
+		return tab
+	def _stack(self,arr):
+		# (nframe,ny,nx) -> frames side by side along the overscan direction
+		n,ny,nx = arr.shape
+		if self.along=='columns':
+			return arr.transpose(1,0,2).reshape(ny,n*nx)
+		else:
+			return arr.reshape(n*ny,nx)
+	def write_image(self,fmt='fits'):
+		recs = self.records()
+		if recs is None:
+			return
+		if fmt == 'npz':
+			np.savez(self.imgFile+'.npz',files=np.array(recs['file']),
+			         mjd=np.array(recs['mjd']),
+			         oscanmed=np.array(recs['oscanmed']),
+			         oscan=recs['oscan'],resid=recs['resid'])
 			return
 		hdr = OrderedDict()
-		hdr['NOVSCAN'] = nfiles
-		for n,f in enumerate(self.files,start=1):
+		hdr['NOVSCAN'] = len(recs)
+		for n,f in enumerate(recs['file'],start=1):
 			hdr['OVSCN%03d'%n] = f
-		f1 = open(self.tmpfn1,'rb')
-		oscanImg = self.arr_stack([np.load(f1) for i in range(nfiles)])
-		f1.close()
-		f2 = open(self.tmpfn2,'rb')
-		oscanResImg = self.arr_stack([np.load(f2) for i in range(nfiles)])
-		f2.close()
 		if os.path.exists(self.imgFile+'.fits'):
 			os.unlink(self.imgFile+'.fits')
 		oscanFits = fitsio.FITS(self.imgFile+'.fits','rw')
-		oscanFits.write(oscanImg,header=hdr)
-		oscanFits.write(oscanResImg,clobber=False)
+		oscanFits.write(self._stack(recs['oscan']),header=hdr)
+		oscanFits.write(self._stack(recs['resid']),clobber=False)
+		oscanFits.write(self.frame_table(),extname='FRAMES',clobber=False)
 		oscanFits.close()
 	def n_images(self):
-		return len(self.files)
+		recs = self.records()
+		return 0 if recs is None else len(recs)
 
 class BokOverscanSubtract(BokProcess):
 	_procMsg = 'overscan subtracting %s'
+	_hduParallel = True
+	# fit all the amplifiers together in _preprocess (see fit_overscans)
+	_batchFit = True
 	def __init__(self,**kwargs):
 		kwargs.setdefault('header_key','OSCNSUB')
 		# forcing the process to iterate over the default extensions handles
@@ -208,37 +564,73 @@ class BokOverscanSubtract(BokProcess):
 		self.writeOscanImg = kwargs.get('write_overscan_image',False)
 		self.oscanColsImgFile = kwargs.get('oscan_cols_file')
 		self.oscanRowsImgFile = kwargs.get('oscan_rows_file')
+		self.oscanHistory = kwargs.get('oscan_history',False)
+		self.oscanImgFormat = kwargs.get('oscan_image_format','fits')
+		self.batchFit = kwargs.get('batch_fit',self._batchFit)
+		self.sidecarMap = kwargs.get('oscan_sidecar_map')
 		self.curFileName = None
+		self.curMjd = None
+		self.oscanFits = None
 		self._init_oscan_images()
 	def _init_oscan_images(self):
 		if self.writeOscanImg:
 			self.colImg = { extn:OverscanCollection(self.oscanColsImgFile+
-			                                        '_'+extn)
+			                                        '_'+extn,
+			                               incremental=self.oscanHistory)
 			                   for extn in bok90mef_extensions }
 			self.rowImg = { extn:OverscanCollection(self.oscanRowsImgFile+
-			                                        '_'+extn,along='rows')
+			                                        '_'+extn,along='rows',
+			                               incremental=self.oscanHistory)
 			                   for extn in bok90mef_extensions }
 	def _save_oscan_data(self,oscan_cols,colbias,oscan_rows,rowbias,f,extn):
 		if self.writeOscanImg:
-			self.colImg[extn].append(oscan_cols,colbias,f)
+			self.colImg[extn].append(oscan_cols,colbias,f,self.curMjd)
 			if oscan_rows is not None:
-				self.rowImg[extn].append(oscan_rows,rowbias,f)
+				self.rowImg[extn].append(oscan_rows,rowbias,f,self.curMjd)
 	def _finish_oscan_images(self):
 		if self.writeOscanImg:
 			for extn in bok90mef_extensions:
-				self.colImg[extn].write_image()
+				self.colImg[extn].write_image(self.oscanImgFormat)
 				self.colImg[extn].close()
 				if self.rowImg[extn].n_images() > 0:
-					self.rowImg[extn].write_image()
+					self.rowImg[extn].write_image(self.oscanImgFormat)
 				self.rowImg[extn].close()
 	def _preprocess(self,fits,f):
 		super(BokOverscanSubtract,self)._preprocess(fits,f)
 		self.curFileName = fits.fileName
+		if self.writeOscanImg:
+			self.curMjd = fits.get_header(0).get('MJD-OBS')
+		self.oscanFits = None
+		if self.batchFit:
+			self.oscanFits = self._fit_all(fits)
+			if self.sidecarMap is not None:
+				self._write_sidecar(fits,f)
+	def _fit_all(self,fits):
+		# read only the overscan strips and fit all amplifiers at once
+		extns = fits.extensions
+		hdrs = [ fits.get_header(extn) for extn in extns ]
+		oscanCols,oscanRows = zip(*[ read_overscan(fits,extn,hdr)
+		                               for extn,hdr in zip(extns,hdrs) ])
+		colbias,oscanRows,rowbias = fit_overscans(oscanCols,oscanRows,
+		                                          self.row_fit_kwargs,
+		                                          **self.fit_kwargs)
+		return { extn:v for extn,v in zip(extns,zip(oscanCols,colbias,
+		                                            oscanRows,rowbias)) }
+	def _write_sidecar(self,fits,f):
+		extns = self.oscanFits.keys()
+		oscanCols,colbias,_,rowbias = zip(*self.oscanFits.values())
+		write_overscan_sidecar(self.sidecarMap(f),fits.fileName,extns,
+		                       oscanCols,colbias,rowbias,self.fit_kwargs,
+		                       self.row_fit_kwargs)
 	def process_hdu(self,extName,data,hdr):
-		data,oscan_cols,oscan_rows,colbias,rowbias = \
-		         overscan_subtract(data,hdr,returnFull=True,
-		                           row_kwargs=self.row_fit_kwargs,
-		                           **self.fit_kwargs)
+		if self.oscanFits is not None:
+			oscan_cols,colbias,oscan_rows,rowbias = self.oscanFits[extName]
+			data = subtract_overscan_fit(data,hdr,colbias,rowbias)
+		else:
+			data,oscan_cols,oscan_rows,colbias,rowbias = \
+			         overscan_subtract(data,hdr,returnFull=True,
+			                           row_kwargs=self.row_fit_kwargs,
+			                           **self.fit_kwargs)
 		# write the output file
 		hdr['OSCANSUB'] = 'method=%s' % self.fit_kwargs.get('method','default')
 		# something changed about what median returns...
@@ -257,6 +649,9 @@ class BokOverscanSubtract(BokProcess):
 		self._finish_oscan_images()
 
 class BokOverscanSubtractWithSatFix(BokOverscanSubtract):
+	# the saturation fix can change the overscan pixels, so they have to
+	# be fit from the corrected image
+	_batchFit = False
 	def process_hdu(self,extName,data,hdr):
 		data,mask = mask_saturation(extName,data)
 		return super(BokOverscanSubtractWithSatFix,self).process_hdu(extName,
@@ -8,7 +8,7 @@ from astropy.table import Table,vstack
 from astropy.wcs import WCS
 import fitsio
 
-from .bokutil import load_mask
+from .bokutil import load_mask,read_image
 from .bokastrom import read_headers
 
 try:
@@ -174,7 +174,7 @@ def aper_phot_image(imageFile,ra,dec,aperRad,badPixMask=None,varIm=None,
 	tabs = []
 	fitsData = fitsio.FITS(imageFile)
 	for i,hdu in enumerate(fitsData[1:]):
-		im = hdu.read()
+		im = read_image(hdu)
 		extn = hdu.get_extname()
 		# argh... header need to be from astropy, fix this!!!
 		hdr = getheader(imageFile,extn)
@@ -4,7 +4,6 @@ import os
 import re
 import glob
 import shutil
-import subprocess
 from copy import copy
 from functools import partial
 import multiprocessing
@@ -38,7 +37,7 @@ def makeccd4image(dataMap,inputFile,outputFile=None,**kwargs):
 		ccd4map = lambda f: outputFile
 	bokproc.combine_ccds([inputFile,],output_map=ccd4map,**kwargs)
 
-def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},**kwargs):
+def _overscan_process(dataMap,fixsaturation=False,header_fixes={},**kwargs):
 	if fixsaturation:
 		oscanSubtract = BokOverscanSubtractWithSatFix(input_map=dataMap('raw'),
 	                                        output_map=dataMap('oscan'),
@@ -47,9 +46,18 @@ def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},**kwargs):
 	else:
 		oscanSubtract = BokOverscanSubtract(input_map=dataMap('raw'),
 	                                        output_map=dataMap('oscan'),
+	                                   oscan_sidecar_map=dataMap('oscanfit'),
 	                                        header_fixes=header_fixes,
 	                                        **kwargs)
-	oscanSubtract.process_files(dataMap.getFiles())
+	return oscanSubtract
+
+def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},
+                      files=None,**kwargs):
+	oscanSubtract = _overscan_process(dataMap,fixsaturation,header_fixes,
+	                                  **kwargs)
+	if files is None:
+		files = dataMap.getFiles()
+	oscanSubtract.process_files(files)
 
 def _bias_worker(dataMap,biasStack,nSkip,writeccdim,biasIn,**kwargs):
 	biasFile,biasList = biasIn
@@ -177,7 +185,7 @@ def make_dome_flats(dataMap,nobiascorr=False,
 	status = procmap(p_flat_worker,dataMap.getCalSequences('flat'))
 	dataMap.updateCalSequences('flat',status)
 
-def _ramp_worker(tmpDir,inputMap,calMap,verbose,biasIn):
+def _ramp_worker(tmpMap,inputMap,calMap,verbose,biasIn):
 	biasFile,biasList = biasIn
 	if verbose >= 1:
 		try:
@@ -185,28 +193,27 @@ def _ramp_worker(tmpDir,inputMap,calMap,verbose,biasIn):
 		except:
 			pid = '1'
 		print '[%2s] RAMP: %s' % (pid,biasFile)
-	outFile = os.path.join(tmpDir,'ramp'+biasFile+'.fits')
+	rampFile = 'ramp'+biasFile+'.fits'
+	outFile = tmpMap(rampFile)
 	if os.path.exists(outFile):
-		return outFile
+		return rampFile
 	imsub = bokproc.BokImArith('-',calMap(biasFile),
 	                           output_map=lambda f: outFile)
 	imsub.process_files([inputMap(biasList[0])])
-	return outFile
+	return rampFile
 
 # XXX removed smoothing of image b/c not being used, but could do with spline smoother?
 def make_rampcorr_image(dataMap,**kwargs):
 	processes = kwargs.get('processes',1)
 	procmap = kwargs.pop('procmap')
-	tmpDir = os.path.join(dataMap._tmpDir,'biasramps')
+	tmpMap = dataMap.getTmpMap('biasramps')
 	inputMap = dataMap('oscan')
 	calMap = dataMap('cal')
-	if not os.path.exists(tmpDir):
-		os.makedirs(tmpDir)
 	rampFile = dataMap.getCalMap('ramp').getFileName()
-	p_ramp_worker = partial(_ramp_worker,tmpDir,inputMap,calMap,
+	p_ramp_worker = partial(_ramp_worker,tmpMap,inputMap,calMap,
 	                        kwargs.get('verbose',0))
 	rampFiles = procmap(p_ramp_worker,dataMap.getCalSequences('zero'))
-	stackFun = bokutil.ClippedMeanStack()
+	stackFun = bokutil.ClippedMeanStack(input_map=tmpMap)
 	stackFun.stack(rampFiles,rampFile)
 
 def balance_gains(dataMap,gainMaskDb,gainBalCfg,**kwargs):
@@ -225,12 +232,19 @@ def balance_gains(dataMap,gainMaskDb,gainBalCfg,**kwargs):
 			continue
 		filt = dataMap.obsDb['filter'][ii]
 		diagfile = os.path.join(dataMap.getDiagDir(), 'gainbal_%s.npz'%utd)
+		# the strip measurements, refitting the gain trends from these
+		# doesn't need to read the images again
+		stripfile = os.path.join(dataMap.getDiagDir(),
+		                         'gainbal_strips_%s.fits'%utd)
 		if os.path.exists(diagfile) and not kwargs.get('debug',False):
 			gainDat = np.load(diagfile)
 			gainCor = gainDat['gainCor']
 			skyV = gainDat['skys']
 		else:
-			gainBalance.process_files(files,filt)
+			if not ( os.path.exists(stripfile) and 
+			           gainBalance.load_table(stripfile,files) ):
+				gainBalance.process_files(files,filt)
+				gainBalance.write_table(stripfile)
 			kwargs = gainBalCfg.get(utd,{})
 			if kwargs.get('verbose',0) > 1:
 				print 'setting gain bal config: ',utd,kwargs
@@ -266,7 +280,8 @@ def files_by_utdfilt(dataMap,imType='object',filt=None):
 def process_all(dataMap,nobiascorr=False,noflatcorr=False,
                 fixpix=False,rampcorr=False,noweightmap=False,
                 nocombine=False,prockey='CCDPROC',
-                gainMaskDb=None,gainBalCfg={},**kwargs):
+                gainMaskDb=None,gainBalCfg={},
+                oscan=None,keep_oscan=False,**kwargs):
 	# 0. before processing, generate data quality masks: the badpix mask is
 	#    updated to include saturated pixels and regions around bright stars
 	#    are flagged.
@@ -287,11 +302,37 @@ def process_all(dataMap,nobiascorr=False,noflatcorr=False,
 	                             bias=bias,flat=flat,ramp=ramp,
 	                             fringe=None,illum=None,skyflat=None,
 	                             fixpix=fixpix,**kwargs)
+	if not noweightmap:
+		# weight maps are constructed starting from raw images, or, when run
+		# separately, from the overscan-subtracted images and saved models
+		# (the fused pass has the raw images in memory already)
+		whmap = bokproc.BokWeightMap(input_map=dataMap('raw'),
+		                   oscan_map=dataMap('oscan') if oscan is None else None,
+		                             output_map=dataMap('weight'),
+		                             oscan_sidecar_map=dataMap('oscanfit'),
+		                             flat=flat,
+		                             _mask_map=dataMap.getCalMap('badpix'),
+		                             **kwargs)
 	files,filesUtdFilt = files_by_utdfilt(dataMap)
 	if files is None or len(files)==0:
 		return
-	dqMask.process_files(files)
-	proc.process_files(filesUtdFilt)
+	if oscan is not None:
+		# fused pass: the overscan subtraction, masks, ccdproc, and weight 
+		# maps are done on each HDU in memory, and the overscan-subtracted
+		# images are only written if requested
+		chainSteps = [oscan,dqMask,proc]
+		writeSteps = [proc]
+		if not noweightmap:
+			chainSteps.append(whmap)
+			writeSteps.append(whmap)
+		if keep_oscan:
+			writeSteps.append(oscan)
+		chain = bokutil.BokProcessChain(chainSteps,write_steps=writeSteps,
+		                                **kwargs)
+		chain.process_files(filesUtdFilt)
+	else:
+		dqMask.process_files(files)
+		proc.process_files(filesUtdFilt)
 	if nocombine:
 		return
 	# 2. balance gains using background counts
@@ -304,12 +345,8 @@ def process_all(dataMap,nobiascorr=False,noflatcorr=False,
 	                     **kwargs)
 	if not noweightmap:
 		# 4. construct weight maps starting from raw images
-		whmap = bokproc.BokWeightMap(input_map=dataMap('raw'),
-		                             output_map=dataMap('weight'),
-		                             flat=flat,
-		                             _mask_map=dataMap.getCalMap('badpix'),
-		                             **kwargs)
-		whmap.process_files(filesUtdFilt)
+		if oscan is None:
+			whmap.process_files(filesUtdFilt)
 		# rescale the gain corrections to inverse variance
 		for f in gainMap['corrections']:
 			gainMap['corrections'][f] = (gainMap['corrections'][f].copy())**-2
@@ -344,7 +381,7 @@ def make_illumcorr_image(dataMap,byUtd=True,filterFun=None,
 			print 'ILLUM: generating %s from %d images' % (outFn,len(files))
 		#
 		tmpFn = 'tmp'+os.path.basename(outFn)
-		tmpSkyFlatFile = os.path.join(dataMap._tmpDir,tmpFn)
+		tmpSkyFlatFile = dataMap.getTmpMap()(tmpFn)
 		stackFun = bokutil.ClippedMeanStack(input_map=dataMap('comb'),
 		                                mask_map=dataMap('imgmask'),
 		                                mask_type='nonzero',
@@ -404,7 +441,7 @@ def make_fringe_masters(dataMap,byUtd=False,
 			outfn = dataMap.storeCalibrator('fringe',frames)
 			fringeStack.stack(files,outfn)
 
-def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
+def make_supersky_flats(dataMap,byUtd=False,interpFill='spline',**kwargs):
 	caldir = dataMap.getCalDir()
 	stackin = dataMap('sky') # XXX
 	statsReg = bokutil.stats_region(None,16)
@@ -453,6 +490,13 @@ def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
 				                structure=growKern,output=m)
 				mask[ccd] = m
 			fits.add_mask(mask)
+			if interpFill in ['rows','cols','twod']:
+				for ccd,data,hdr in fits:
+					data = bokproc.interpolate_masked_pixels(data,
+					                                         along=interpFill)
+					fits.update(data.filled(1.0),hdr)
+				fits.close()
+				continue
 			backfit = bokproc.SplineBackgroundFit(fits,nKnots=50,
 			                                      order=1,nbin=16)
 			for ccd,data,hdr in fits:
@@ -521,7 +565,7 @@ def process_all2(dataMap,noillumcorr=False,noskyflatcorr=False,
 		wtproc.process_files(filesUtdFilt)
 
 def sky_subtract(dataMap,skyArgs,redoskymask=False,
-                 skymaskhack=False,save_sky=False,**kwargs):
+                 skymaskhack=False,save_sky=False,tile_compress=None,**kwargs):
 	# the full list of files to process
 	files,filesUtdFilt = files_by_utdfilt(dataMap)
 	if files is None or len(files)==0:
@@ -530,7 +574,7 @@ def sky_subtract(dataMap,skyArgs,redoskymask=False,
 	if skymaskhack:
 		# XXX needs to have --byutd implementation!
 		tmpFn = 'tmpflat'+os.path.basename(files[0])+'.fits' # yuck
-		tmpSkyFlatFile = os.path.join(dataMap._tmpDir,tmpFn)
+		tmpSkyFlatFile = dataMap.getTmpMap()(tmpFn)
 		print 'output is ',tmpSkyFlatFile
 		stackFun = bokproc.BokNightSkyFlatStack(input_map=dataMap('proc2'),
 	                                    mask_map=dataMap('imgmask'),
@@ -538,6 +582,8 @@ def sky_subtract(dataMap,skyArgs,redoskymask=False,
 		                                **kwargs)
 		stackFun.stack(files,tmpSkyFlatFile)
 		tmpMap = bokio.FileRenameMap(dataMap('proc2'),'.tmp')
+		if 'tmp' in dataMap.storeProducts:
+			tmpMap = bokio.StoreNameMap(dataMap.getFileStore(),tmpMap)
 		tmpFlatProc = bokproc.BokImArith('/',tmpSkyFlatFile,
 		                                 input_map=dataMap('proc2'),
 		                                 output_map=tmpMap,
@@ -562,6 +608,7 @@ def sky_subtract(dataMap,skyArgs,redoskymask=False,
 	                                output_map=dataMap('sky'),
 	                                mask_map=dataMap('skymask'),
 	                                skyfit_map=skyfitmap,
+	                                tile_compress=tile_compress,
 	                                **dict(skyArgs.items()+kwargs.items()))
 	skySub.add_mask(dataMap.getCalMap('badpix4'))
 	skySub.process_files(files)
@@ -639,29 +686,37 @@ def bokpipe(dataMap,**kwargs):
 	processes = kwargs.get('processes',1)
 	procmap = kwargs.get('procmap')
 	maxmem = kwargs.get('maxmem',5)
-	chunkSize = 10
 	if processes > 1:
-		pool = multiprocessing.Pool(processes)
-		# need to test this more to see if it improves efficiency, but
-		# probably need to wrap it in an object
-		#procmap = partial(pool.map,chunksize=chunkSize)
-		procmap = pool.map
+		# workers persist across steps, with dynamic task dispatch and
+		# chunk sizes adapted to the measured task times
+		procmap = bokutil.AdaptiveProcMap(processes,verbose=verbose)
 		if len(dataMap.getUtDates()) > 2*processes:
 			dataMap.groupByUtdFilt = True
 	else:
 		procmap = map
 	pipekwargs = {'clobber':redo,'verbose':verbose,'debug':debug,
 	              'processes':processes,'procmap':procmap,'maxmem':maxmem}
-	# fixpix is sticking nan's into the images in unmasked pixels (???)
-	fixpix = False #True
+	fixpix = kwargs.get('fixpix',False)
 	writeccdims = kwargs.get('calccdims',False)
 	timerLog = bokutil.TimerLog()
 	biasMap = None
+	# fuse the overscan subtraction of object frames into ccdproc
+	fused = kwargs.get('fused',False) and 'oscan' in steps and \
+	          ('proc1' in steps or 'comb' in steps)
+	oscanStep = None
 	if 'oscan' in steps:
-		overscan_subtract(dataMap,
-		                  fixsaturation=kwargs.get('fixsaturation'),
-		                  header_fixes=kwargs.get('header_fixes',{}),
-		                  **pipekwargs)
+		oscanArgs = dict(fixsaturation=kwargs.get('fixsaturation'),
+		                 header_fixes=kwargs.get('header_fixes',{}))
+		files = dataMap.getFiles()
+		if fused:
+			oscanStep = _overscan_process(dataMap,**dict(oscanArgs,
+			                                             **pipekwargs))
+			objFiles = dataMap.getFiles(imType='object')
+			if files is not None and objFiles is not None:
+				files = sorted(set(files) - set(objFiles))
+		if files is not None and len(files) > 0:
+			overscan_subtract(dataMap,files=files,
+			                  **dict(oscanArgs,**pipekwargs))
 		timerLog('overscans')
 	if 'bias2d' in steps:
 		make_2d_biases(dataMap,writeccdim=writeccdims,
@@ -692,6 +747,8 @@ def bokpipe(dataMap,**kwargs):
 		            prockey=kwargs.get('prockey','CCDPROC'),
 		            gainMaskDb=kwargs.get('gainMaskDb'),
 		            gainBalCfg=kwargs.get('gainBalCfg'),
+		            oscan=oscanStep,
+		            keep_oscan=kwargs.get('keeposcan',False),
 		            **pipekwargs)
 		timerLog('ccdproc')
 	if 'illum' in steps:
@@ -710,6 +767,7 @@ def bokpipe(dataMap,**kwargs):
 	if 'skyflat' in steps:
 		make_supersky_flats(dataMap,
 		                    byUtd=not kwargs.get('masterskyflat'),
+		                    interpFill=kwargs.get('skyflatfill','spline'),
 		                    **pipekwargs)
 		timerLog('supersky flats')
 	if 'proc2' in steps:
@@ -729,6 +787,7 @@ def bokpipe(dataMap,**kwargs):
 		             redoskymask=kwargs.get('redoskymask'),
 		             skymaskhack=kwargs.get('flatcorrectbeforeskymask'),
 		             save_sky=kwargs.get('savesky'),
+		             tile_compress=kwargs.get('tilecompress'),
 		             **pipekwargs)
 		timerLog('skysub')
 	if 'wcs' in steps:
@@ -742,7 +801,24 @@ def bokpipe(dataMap,**kwargs):
 		timerLog('catalog')
 	timerLog.dump()
 	if processes > 1:
-		pool.close()
+		if verbose > 0:
+			procmap.dump()
+		procmap.close()
+	if kwargs.get('sharedcals',False):
+		calStore = bokutil.shared_calibration_report()
+		print 'shared calibration store: %d masters, %.1f MB' % \
+		        (len(calStore),sum([n for e,n in calStore])/1024.**2)
+		bokutil.clear_shared_calibrations()
+
+def flush_file_store(dataMap):
+	fileStore = dataMap.getFileStore()
+	if fileStore is not None:
+		# anything still in the store is a product that was kept
+		rep = fileStore.report()
+		print 'file store: writing %d files (%.1f MB) to disk' % \
+		        (rep['nfiles'],rep['nbytes']/1024.**2)
+		fileStore.flush()
+		fileStore.clear()
 
 def make_variance_image(dataMap,f,bpMask,expTime,gains,skyAdu):
 	flatMap = dataMap.getCalMap('flat')
@@ -810,6 +886,40 @@ def make_images(dataMap,imtype='sky',msktype=None,processes=1,redo=False):
 	procmap(p_img_worker,dataMap.getFiles(imType='object'))
 	plt.ion()
 
+class _FpackNameMap(object):
+	def __init__(self,nameMap):
+		self.nameMap = nameMap
+	def __call__(self,f):
+		return self.nameMap(f)+'.fz'
+
+def compress_images(dataMap,imtype='sky',processes=1,verbose=0,**kwargs):
+	'''tile-compress the images from a processing step into .fz files and
+	   delete the uncompressed files (as fpack -D)'''
+	inMap = dataMap(imtype)
+	files = [ f for f in dataMap.getFiles('object') 
+	            if os.path.exists(inMap(f)) ]
+	if len(files) == 0:
+		return
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		procmap = pool.map
+	else:
+		procmap = map
+	compress = bokproc.BokCompressImages(input_map=inMap,
+	                                     output_map=_FpackNameMap(inMap),
+	                                     processes=processes,procmap=procmap,
+	                                     verbose=verbose,**kwargs)
+	compress.process_files(files)
+	if processes > 1:
+		pool.close()
+		pool.join()
+	# only delete the inputs that were completely copied
+	nhdus = lambda fn: len(fitsio.FITS(fn))
+	for f in files:
+		fzFile = inMap(f)+'.fz'
+		if os.path.exists(fzFile) and nhdus(fzFile)==nhdus(inMap(f)):
+			os.unlink(inMap(f))
+
 def init_file_args(parser):
 	parser.add_argument('-b','--band',type=str,default=None,
 	                help='band to process (g or i) [default=both]')
@@ -908,6 +1018,11 @@ def init_pipeline_args(parser):
 	                help='generate CCD-combined images for calibration data')
 	parser.add_argument('--fixsaturation',action='store_true',
 	                help='correct overflowed pixels to have saturation value')
+	parser.add_argument('--fixpix',action='store_true',
+	                help='interpolate over masked pixels in ccdproc')
+	parser.add_argument('--skyflatfill',type=str,default='spline',
+	                help='fill masked pixels in skyflat with '
+	                     '[spline] fit or interpolation along rows|cols|twod')
 	parser.add_argument('--nobiascorr',action='store_true',
 	                help='do not apply bias correction')
 	parser.add_argument('--noflatcorr',action='store_true',
@@ -971,7 +1086,49 @@ def init_pipeline_args(parser):
 	parser.add_argument('--cleancals',action='store_true',
 	                help='delete calibration input files')
 	parser.add_argument('--compress',action='store_true',
-	                help='compress science images using fpack')
+	                help='compress science images (to .fz files, as fpack)')
+	parser.add_argument('--tilecompress',type=str,nargs='?',const='rice',
+	                help='write sky-subtracted images tile-compressed '
+	                     '(rice|hcompress|gzip) [default rice]')
+	parser.add_argument('--clipengine',type=str,default=None,
+	                help='sigma-clipping engine ([astropy]|nan)')
+	parser.add_argument('--fused',action='store_true',
+	                help='overscan subtract, mask, ccdproc, and generate '
+	                     'weight maps for object frames in a single pass')
+	parser.add_argument('--keeposcan',action='store_true',
+	                help='write overscan-subtracted images in fused pass')
+	parser.add_argument('--resident',action='store_true',
+	                help='load process objects once per worker instead of '
+	                     'sending them with each task')
+	parser.add_argument('--sharedcals',action='store_true',
+	                help='share master calibrations between processes '
+	                     'through memory-mapped files')
+	parser.add_argument('--pipelineio',action='store_true',
+	                help='read and write HDUs in background threads '
+	                     'while processing')
+	parser.add_argument('--maxiomem',type=int,default=None,
+	                help='memory cap [MB] for pipelined HDU buffers')
+	parser.add_argument('--tmpfsstore',type=str,default=None,nargs='?',
+	                const='/dev/shm',
+	                help='keep intermediate products in a file store under '
+	                     'this (memory-backed) directory [/dev/shm]')
+	parser.add_argument('--storeproducts',type=str,default='bias,tmp',
+	                help='products kept in the file store [bias,tmp]')
+	parser.add_argument('--storesize',type=int,default=4096,
+	                help='file store capacity in MB [4096]')
+	parser.add_argument('--nospill',action='store_true',
+	                help='write new files to disk when the file store is '
+	                     'full instead of spilling older files')
+	parser.add_argument('--hduthreads',type=int,default=None,
+	                help='number of threads used to process the HDUs '
+	                     'of each image concurrently')
+	parser.add_argument('--modeestimator',type=str,default=None,
+	                help='image mode estimator ([pearson]|histogram|peak)')
+	parser.add_argument('--int16',type=str,default=None,
+	                help='store these products (e.g., oscan,proc1,comb) as '
+	                     'int16 quantized to the noise')
+	parser.add_argument('--quantlevel',type=float,default=4.,
+	                help='noise/step for int16 products [4]')
 	return parser
 
 def run_pipe(dataMap,args,**_kwargs):
@@ -981,6 +1138,26 @@ def run_pipe(dataMap,args,**_kwargs):
 		dataMap.setTmpInput()
 	if args.tmpdirout:
 		dataMap.setTmpOutput()
+	if args.clipengine is not None:
+		# set before the process pool is created so workers inherit it
+		bokutil.set_clip_engine(args.clipengine)
+	if args.modeestimator is not None:
+		bokutil.set_mode_estimator(args.modeestimator)
+	if args.resident:
+		bokutil.set_resident_workers(True)
+	if args.sharedcals:
+		bokutil.set_shared_calibrations(True)
+	if args.pipelineio:
+		bokutil.set_pipelined_io(True,args.maxiomem)
+	if args.hduthreads is not None:
+		bokutil.set_hdu_threads(args.hduthreads)
+	if args.tmpfsstore is not None:
+		storeDir = os.path.join(args.tmpfsstore,'bokstore_%d' % os.getpid())
+		fileStore = bokio.TmpfsFileStore(storeDir,capacity=args.storesize,
+		                                 spill=not args.nospill)
+		dataMap.setFileStore(fileStore,args.storeproducts.split(','))
+	if args.int16 is not None:
+		dataMap.setStorage(args.int16.split(','),'int16',args.quantlevel)
 	if args.steps is None:
 		if args.stepto is None:
 			steps = all_process_steps
@@ -999,31 +1176,31 @@ def run_pipe(dataMap,args,**_kwargs):
 	kwargs['steps'] = steps
 	for k,v in _kwargs.items():
 		kwargs[k] = v
-	# run pipeline processes
-	if args.images:
-		make_images(dataMap,*args.imagetype.split(','),
-		            processes=args.processes,redo=args.redo)
-	elif args.wcscheck:
-		files = map(dataMap('sky'),dataMap.getFiles('object'))
-		bokgnostic.run_scamp_diag(files)
-	elif args.cleancals:
-		for calType in ['zero','flat']:
-			files = dataMap.getFiles(imType=calType)
-			if files is None:
-				continue
-			for f in files:
-				try:
-					os.remove(dataMap('oscan')(f))
-					print 'deleted ',f
-				except:
-					pass
-	elif args.compress:
-		files = map(dataMap('sky'),dataMap.getFiles('object'))
-		for f in files:
-			if os.path.exists(f):
-				cmd = ['nice','fpack','-D','-Y',f]
-				print ' '.join(cmd)
-				subprocess.call(cmd)
-	else:
-		bokpipe(dataMap,**kwargs)
+	# run pipeline processes, products kept in the file store are written
+	# to disk also when a step fails
+	try:
+		if args.images:
+			make_images(dataMap,*args.imagetype.split(','),
+			            processes=args.processes,redo=args.redo)
+		elif args.wcscheck:
+			files = map(dataMap('sky'),dataMap.getFiles('object'))
+			bokgnostic.run_scamp_diag(files)
+		elif args.cleancals:
+			for calType in ['zero','flat']:
+				files = dataMap.getFiles(imType=calType)
+				if files is None:
+					continue
+				for f in files:
+					try:
+						os.remove(dataMap('oscan')(f))
+						print 'deleted ',f
+					except:
+						pass
+		elif args.compress:
+			compress_images(dataMap,processes=args.processes,
+			                verbose=verbose)
+		else:
+			bokpipe(dataMap,**kwargs)
+	finally:
+		flush_file_store(dataMap)
 
@@ -2,18 +2,14 @@
 
 import os,sys
 import re
-import shutil
-import tempfile
 import multiprocessing
 from functools import partial
 import numpy as np
 from scipy.interpolate import LSQBivariateSpline,RectBivariateSpline,griddata
 from scipy.interpolate import LSQUnivariateSpline
-from scipy.interpolate import interp1d,interp2d
 from scipy.signal import spline_filter
 from scipy.ndimage.morphology import binary_dilation,binary_closing
 import scipy.ndimage.measurements as meas
-from skimage import measure
 from astropy.stats import sigma_clip
 from astropy.modeling import models,fitting
 from astropy.convolution.convolve import convolve
@@ -23,7 +19,8 @@ import fitsio
 from .bokio import *
 from . import bokdm
 from . import bokutil
-from .bokoscan import extract_overscan,overscan_subtract
+from .bokoscan import extract_overscan,overscan_subtract,trim_overscan
+from .bokoscan import load_overscan_sidecar
 
 # the order of the amplifiers in the FITS extensions, i.e., HDU1=amp#4
 ampOrder = [ 4,  3,  2,  1,  8,  7,  6,  5,  9, 10, 11, 12, 13, 14, 15, 16 ]
@@ -67,6 +64,7 @@ class OverExposedFlatException(Exception):
 		return repr(self.value)
 
 class BokImArith(bokutil.BokProcess):
+	_hduParallel = True
 	def __init__(self,op,operand,**kwargs):
 		super(BokImArith,self).__init__(**kwargs)
 		ops = {'+':np.add,'-':np.subtract,'*':np.multiply,'/':np.divide}
@@ -80,46 +78,71 @@ class BokImArith(bokutil.BokProcess):
 		return self.op(data,self.operandFits[extName][:,:]),hdr
 
 class BokImStatWithPreProcessing(bokutil.BokImStat):
+	_subsetReads = False
 	def _get_pixels(self,data,hdr):
 		pix = overscan_subtract(data,hdr,method='mean_value',
 		                        reject='sigma_clip',clip_iters=1,
 		                        apply_filter=None)
 		return pix
 
-def interpolate_masked_pixels(data,along='twod',method='linear'):
-	if along=='rows':
-		xx = np.arange(data.shape[1])
-		for i in range(data.shape[0]):
-			row = data.data[i]
-			rowMask = data.mask[i]
-			if rowMask.sum() > len(xx)-20:
-				# less than 20 pixels on this row are not masked, don't
-				# attempt interpolation
-				row[rowMask] = np.nan
-				continue
-			interpFun = interp1d(xx[~rowMask],row[~rowMask],kind=method,
-			                     bounds_error=False,fill_value=None)
-			ii = np.where(rowMask)[0]
-			rowInterp = interpFun(xx[ii])
-			row[ii] = rowInterp
-			## XXX fix extrapolation; for now don't overwrite those pix
-			#good = np.where(~np.isnan(rowInterp))[0]
-			#row[ii[good]] = rowInterp[good]
-	elif along=='twod':
-		y,x = np.indices(data.shape)
-		yy = np.arange(data.shape[0])
-		xx = np.arange(data.shape[1])
-		interpFun = interp2d(x[~data.mask],y[~data.mask],
-		                     data.data[~data.mask],kind='linear',
-		                     bounds_error=False,fill_value=None)
-		data.data[data.mask] = interpFun(x[data.mask],y[data.mask])
-		print interpData.shape
-		#interpData = griddata((y[~data.mask],x[~data.mask]),
-		#                      data.data[~data.mask],
-		#                      (yy,xx),method=method)
+def _interp_runs(im,mask,method,minGood):
+	# fill the runs of masked pixels along the rows of im from the nearest 
+	# unmasked pixels on either side, using the nearest one at the edges.
+	# returns the filled image and the mask of pixels that weren't filled
+	out = im.copy()
+	bad = mask.copy()
+	rows = np.where(mask.any(axis=1) & 
+	                (np.sum(~mask,axis=1) >= max(minGood,1)))[0]
+	if len(rows) == 0:
+		return out,bad
+	m = mask[rows]
+	n = m.shape[1]
+	jj = np.arange(n,dtype=np.int32)
+	left = np.maximum.accumulate(np.where(m,-1,jj),axis=1)
+	right = np.minimum.accumulate(np.where(m,n,jj)[:,::-1],axis=1)[:,::-1]
+	i,j = np.nonzero(m)
+	j1,j2 = left[i,j],right[i,j]
+	j1,j2 = np.where(j1>=0,j1,j2),np.where(j2<n,j2,j1)
+	i = rows[i]
+	v1,v2 = im[i,j1],im[i,j2]
+	if method == 'linear':
+		w = (j-j1) / np.maximum(j2-j1,1).astype(np.float32)
+		out[i,j] = v1 + w*(v2-v1)
+	elif method == 'nearest':
+		out[i,j] = np.where(j-j1 <= j2-j,v1,v2)
 	else:
-		raise ValueError
-	return data
+		raise ValueError('interpolation method %s unrecognized' % method)
+	bad[rows] = False
+	return out,bad
+
+def interpolate_masked_pixels(data,along='rows',method='linear',min_good=20):
+	'''Fill the masked pixels of a masked array by interpolating across
+	   runs of masked pixels along rows, columns ('cols'), or both ('twod',
+	   the average of the two). method is 'linear' or 'nearest'. Rows 
+	   (columns) with fewer than min_good unmasked pixels are filled along
+	   the other axis instead. Returns a masked array where only the pixels
+	   that could not be filled remain masked.'''
+	if along not in ['rows','cols','twod']:
+		raise ValueError('interpolation axis %s unrecognized' % along)
+	mask = np.ma.getmaskarray(data)
+	im = np.ma.getdata(data)
+	interp_rows = lambda: _interp_runs(im,mask,method,min_good)
+	def interp_cols():
+		out,bad = _interp_runs(im.T,mask.T,method,min_good)
+		return out.T,bad.T
+	if along == 'cols':
+		interp_rows,interp_cols = interp_cols,interp_rows
+	out,bad = interp_rows()
+	if along == 'twod' or bad.any():
+		otherOut,otherBad = interp_cols()
+		if along == 'twod':
+			both = ~(bad|otherBad)
+			out[both] = 0.5*(out[both]+otherOut[both])
+		# fall back to the other axis for pixels that couldn't be filled
+		ii = bad & ~otherBad
+		out[ii] = otherOut[ii]
+		bad &= otherBad
+	return np.ma.masked_array(out,mask=bad)
 
 class BackgroundFit(object):
 	def __init__(self,fits,nbin=64,coordsys='sky'):
@@ -279,9 +302,8 @@ class NormalizeFlat(bokutil.BokProcess):
 		if extName == 'IM9':
 			# this one has a long bad strip
 			im.mask[:,:50] = True
-		binnedIm = bokutil.rebin(im,self.nbin)
-		binnedIm = bokutil.array_clip(binnedIm,axis=-1,
-		                    clip_iters=3,clip_sig=2.2).mean(axis=-1)#.filled(1)
+		binnedIm = bokutil.block_reduce(im,self.nbin,'mean',clip=True,
+		                                clip_iters=3,clip_sig=2.2)
 		x = np.arange(self.nbin/2,nx,self.nbin,dtype=np.float32)
 		y = np.arange(self.nbin/2,ny,self.nbin,dtype=np.float32)
 		xx,yy = np.meshgrid(x,y)
@@ -300,6 +322,38 @@ class NormalizeFlat(bokutil.BokProcess):
 			                      extname=extName,header=hdr)
 		return normedIm.astype(np.float32),hdr
 
+def saturated_blobs(saturated,minNSat=1,structure=None):
+	'''Label contiguous saturated regions and yield (box,blob,nsat) for
+	   each one with at least minNSat pixels, where box is the bounding box
+	   from find_objects and blob is the region's mask within the box.'''
+	satObjs,nObjs = meas.label(saturated,structure)
+	nsat = np.bincount(satObjs[satObjs>0],minlength=nObjs+1)
+	for label,box in enumerate(meas.find_objects(satObjs),start=1):
+		if box is None or nsat[label] < minNSat:
+			continue
+		yield box,satObjs[box]==label,nsat[label]
+
+def grow_disk(mask,xc,yc,rad):
+	'''Set mask for pixels within rad of (xc,yc), only computing distances
+	   over the bounding box of the circle.'''
+	if not np.isfinite(xc+yc):
+		return
+	ny,nx = mask.shape
+	y1,y2 = max(0,int(np.floor(yc-rad))),min(ny,int(np.ceil(yc+rad))+1)
+	x1,x2 = max(0,int(np.floor(xc-rad))),min(nx,int(np.ceil(xc+rad))+1)
+	if y2 <= y1 or x2 <= x1:
+		return
+	yi,xi = np.ogrid[y1:y2,x1:x2]
+	R = np.sqrt((xi-xc)**2 + (yi-yc)**2)
+	mask[y1:y2,x1:x2] |= R < rad
+
+def _blob_centroid(im,saturated,box):
+	# intensity-weighted centroid of the unsaturated pixels in the box
+	y,x = np.mgrid[box]
+	good = ~saturated[box]
+	w = im[box][good]
+	return np.average(x[good],weights=w),np.average(y[good],weights=w)
+
 class BokGenerateDataQualityMasks(bokutil.BokProcess):
 	# setting a relatively low value here because in 2016 a couple of the
 	# amps started overflowing around this ADU level, but this could perhaps
@@ -328,38 +382,39 @@ class BokGenerateDataQualityMasks(bokutil.BokProcess):
 		self.hduData = []
 	@staticmethod
 	def _grow_saturated_blobs(ccdIm,saturated,minNsat=1000):
-		yi,xi = np.indices(ccdIm.shape)
 		# identify contiguous blogs associated with saturated pixels 
-		# (i.e., stars) and count the number of saturated pixels in 
-		# each blob, then sort by the largest number (brightest stars)
-		satBlobs = measure.label(saturated,background=0)
-		# create image with nominal mask
-		for blob in range(1,satBlobs.max()+1):
-			nSat = np.sum(satBlobs==blob)
-			if nSat < minNsat:
-				continue
+		# (i.e., stars) and grow a circular mask around each one with a
+		# radius scaled by the number of saturated pixels
+		nx = ccdIm.shape[1]
+		grow = np.zeros(ccdIm.shape,dtype=bool)
+		for box,blob,nSat in saturated_blobs(saturated,minNsat,
+		                                     structure=np.ones((3,3))):
 			# a quick & hokey centering algorithm -- middle of the 
 			# saturated blob!
-			yextent = np.sum(satBlobs==blob,axis=0)
+			yextent = np.zeros(nx,dtype=np.intp)
+			yextent[box[1]] = np.sum(blob,axis=0)
 			# this gets messed up if the bleed trails extend to the end of
 			# the image, leading to an extended pool near the edge
-			xextent = np.sum(np.any(satBlobs==blob,axis=0))
+			xextent = np.sum(yextent>0)
 			if xextent > 4000:
 				yextent[:100] = 0
 				yextent[-100:] = 0
-			jj = np.where(yextent==yextent.max())[0]
-			xc = xi[0,jj].mean()
-			jj = np.where((satBlobs==blob)[:,int(xc)])[0]
-			yc = yi[jj,int(xc)].mean()
-			R = np.sqrt((xi-xc)**2 + (yi-yc)**2)
+			xc = np.where(yextent==yextent.max())[0].mean()
+			jj = np.where(blob[:,int(xc)-box[1].start])[0]
+			yc = (box[0].start + jj).mean()
 			# empirically found to be a reasonable minimum radius
 			rad = pow(10,0.5*(np.log10(nSat)-np.log10(50)) + 1.6)
-			ccdIm[R<rad] = np.ma.masked
+			grow_disk(grow,xc,yc,rad)
+		ccdIm[grow] = np.ma.masked
 		return ccdIm
 	def process_hdu(self,extName,data,hdr):
 		self.hduData.append(data)
 		return data,hdr
 	def _postprocess(self,fits,f):
+		# when run within a BokProcessChain process_file is bypassed,
+		# so an existing mask may still be present
+		if os.path.exists(self.outputNameMap(f)):
+			os.unlink(self.outputNameMap(f))
 		maskOut = fitsio.FITS(self.outputNameMap(f),'rw')
 		maskOut.write(None,header=fits.get_header(0))
 		for ccdNum,extGroup in enumerate(amp_iterator(),start=1):
@@ -383,6 +438,7 @@ class BokGenerateDataQualityMasks(bokutil.BokProcess):
 
 class BokCCDProcess(bokutil.BokProcess):
 	_procMsg = 'ccdproc %s'
+	_hduParallel = True
 	def __init__(self,**kwargs):
 		kwargs.setdefault('header_key','CCDPROC')
 		super(BokCCDProcess,self).__init__(**kwargs)
@@ -403,6 +459,8 @@ class BokCCDProcess(bokutil.BokProcess):
 			if cal is None:
 				cal = bokdm.NullCalibrator()
 			self.calib[imType] = cal
+	def _calibrators(self):
+		return self.calib
 	def _preprocess(self,fits,f):
 		super(BokCCDProcess,self)._preprocess(fits,f)
 		hdrCards = {}
@@ -438,7 +496,9 @@ class BokCCDProcess(bokutil.BokProcess):
 	def process_hdu(self,extName,data,hdr):
 		# XXX hacky way to preserve arithmetic on masked pixels,
 		#     but need to keep mask for fixpix
+		mask = None
 		if type(data) is np.ma.core.MaskedArray:
+			mask = np.ma.getmaskarray(data)
 			data = data.data
 		fscl = None
 		bias = self.calib['bias'].getImage(extName)
@@ -460,10 +520,12 @@ class BokCCDProcess(bokutil.BokProcess):
 					data *= flat**2  # inverse variance
 				else:
 					data /= flat     # image counts
-		if self.fixPix:
-			data = interpolate_masked_pixels(data,along=self.fixPixAlong,
+		if self.fixPix and mask is not None:
+			data = interpolate_masked_pixels(np.ma.array(data,mask=mask),
+			                                 along=self.fixPixAlong,
 			                                 method=self.fixPixMethod)
-			# what should the fill value be?
+			# what should the fill value be? only for pixels that could
+			# not be interpolated
 			data = data.filled(0)
 		if self.fixPix:
 			hdr['FIXPIX'] = self.fixPixAlong
@@ -483,11 +545,38 @@ class BokCCDProcess(bokutil.BokProcess):
 			hdr['GAIN'] *= self.curExpTime
 		return data,hdr
 
+class _WeightMapInput(object):
+	'''input map for weight maps: the overscan-subtracted image if the
+	   overscan models of the raw image were saved and that image has not
+	   been processed further in place (or quantized, which loses the 
+	   integer counts), otherwise the raw image'''
+	def __init__(self,rawMap,oscanMap,sidecarMap):
+		self.rawMap = rawMap
+		self.oscanMap = oscanMap
+		self.sidecarMap = sidecarMap
+	def __call__(self,f):
+		rawFile = self.rawMap(f)
+		oscanFile = bokutil.fits_name(self.oscanMap(f))
+		if os.path.exists(oscanFile) and oscanFile != rawFile:
+			hdr0 = fitsio.read_header(oscanFile,0)
+			if 'OSCNSUB' in hdr0 and 'CCDPROC' not in hdr0 and \
+			     'QLEVEL' not in fitsio.read_header(oscanFile,1) and \
+			     load_overscan_sidecar(self.sidecarMap(f),
+			                           bokutil.fits_name(rawFile)) is not None:
+				return oscanFile
+		return rawFile
+
 class BokWeightMap(bokutil.BokProcess):
+	'''Inverse variance maps from the raw counts. Given oscan_map (the
+	   overscan-subtracted images) and oscan_sidecar_map, the raw counts
+	   are recovered from the overscan-subtracted image and the saved 
+	   overscan models when available, instead of reading the raw image.'''
 	_procMsg = 'weight map %s'
+	_hduParallel = True
 	def __init__(self,**kwargs):
 		kwargs.setdefault('header_key','WHTMAP')
 		super(BokWeightMap,self).__init__(**kwargs)
+		self.rawNameMap = self.inputNameMap
 		self._mask_map = kwargs.get('_mask_map')
 		if isinstance(self._mask_map,fitsio.FITS):
 			self._mask_map = bokutil.FakeFITS(self._mask_map)
@@ -497,6 +586,14 @@ class BokWeightMap(bokutil.BokProcess):
 		self.flat = kwargs.get('flat')
 		if self.flat is None:
 			self.flat = bokdm.NullCalibrator()
+		self.sidecarMap = kwargs.get('oscan_sidecar_map')
+		self.oscanModels = None
+		oscanMap = kwargs.get('oscan_map')
+		if oscanMap is not None and self.sidecarMap is not None:
+			self.inputNameMap = _WeightMapInput(self.rawNameMap,oscanMap,
+			                                    self.sidecarMap)
+	def _calibrators(self):
+		return {'flat':self.flat}
 	def _preprocess(self,fits,f):
 		super(BokWeightMap,self)._preprocess(fits,f)
 		try:
@@ -506,18 +603,39 @@ class BokWeightMap(bokutil.BokProcess):
 		if maskFile != self.maskFile:
 			if isinstance(maskFile,basestring):
 				self.maskFile = self._mask_map(f)
-				self.maskFits = fitsio.FITS(self.maskFile)
+				# in memory, so that HDU threads can share it
+				self.maskFits = bokutil.FakeFITS(self.maskFile)
 			else:
 				self.maskFits = maskFile
 		self.flat.setTarget(f)
 		calFn = self.flat.getFileName()
 		fits.outFits[0].write_keys({'FLATFILE':calFn})
+		if self.sidecarMap is not None:
+			rawFile = bokutil.fits_name(self.rawNameMap(f))
+			self.oscanModels = load_overscan_sidecar(self.sidecarMap(f),
+			                                         rawFile)
 	def process_hdu(self,extName,data,hdr):
-		data,oscan_cols,oscan_rows = extract_overscan(data,hdr)
+		if 'OSCANSUB' in hdr:
+			# overscan-subtracted input, add back the saved overscan models
+			# to recover the raw counts (integers) in the data section
+			if self.oscanModels is None or extName not in self.oscanModels:
+				raise ValueError('no overscan models for %s' % extName)
+			oscanMed,colbias,rowbias,_ = self.oscanModels[extName]
+			data = data + colbias[:,np.newaxis]
+			if rowbias is not None:
+				data += rowbias[np.newaxis,:data.shape[1]]
+			data = np.rint(data).astype(np.float32)
+		elif self.oscanModels is not None and extName in self.oscanModels:
+			# overscan level saved by BokOverscanSubtract
+			data = trim_overscan(data,hdr)
+			oscanMed = self.oscanModels[extName][0]
+		else:
+			data,oscan_cols,oscan_rows = extract_overscan(data,hdr)
+			oscanMed = np.median(oscan_cols)
 		data,mask = bokutil.mask_saturation(extName,data)
 		mask |= ( (self.maskFits[extName][:,:] > 0) |
 		          (data==0) )
-		data -= np.median(oscan_cols)
+		data -= oscanMed
 #		if oscan_rows is not None:
 #			data -= np.median(oscan_rows)
 		flatField = self.flat.getImage(extName)
@@ -584,6 +702,17 @@ class BokSkySubtract(bokutil.BokProcess):
 			self.skyFits.write(skyFit,extname=extName,header=hdr)
 		return data,hdr
 
+class BokCompressImages(bokutil.BokProcess):
+	'''Copies images to tile-compressed files (default Rice), as fpack 
+	   does but within the worker processes'''
+	_procMsg = 'compressing %s'
+	def __init__(self,**kwargs):
+		kwargs.setdefault('tile_compress','rice')
+		super(BokCompressImages,self).__init__(**kwargs)
+		self.noConvert = True
+	def process_hdu(self,extName,data,hdr):
+		return data,hdr
+
 ###############################################################################
 #                                                                             #
 #                               GAIN BALANCE                                  #
@@ -638,6 +767,22 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		self.skyRegion = bokutil.stats_region('amp_central_quadrant',10)
 		self.gainTrendMethod = kwargs.get('gain_trend_meth','spline')
 		assert self.gainTrendMethod in ['median','spline']
+		# only the sky region and the edge strips used for the ratios are
+		# read from each amplifier
+		self.stripsNeeded = [ set() for i in range(16) ]
+		for ccdi in range(4):
+			for ampi,ampj,edgedir in self.ampMap[ccdi]:
+				if ampi != ampj:
+					self.stripsNeeded[4*ccdi+ampi].add(('amp',edgedir))
+					self.stripsNeeded[4*ccdi+ampj].add(('amp',edgedir))
+		for ccdNum,refExt,calExt,edgedir in self.ccdMap:
+			if refExt != calExt:
+				self.stripsNeeded[refExt].add(('ccd',edgedir))
+				self.stripsNeeded[calExt].add(('ccd',edgedir))
+		self.ampProfLen = len(range(*slice(-self.amplen,None,
+		                       self.ampstride).indices(self.amplen)))
+		self.ccdProfLen = len(range(*slice(-self.ccdlen,None,
+		                       self.ccdstride).indices(self.ccdlen)))
 		self.reset()
 		self.maskDb = None
 	def reset(self):
@@ -646,6 +791,8 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		self.ccdRelGains = []
 		self.allSkyVals = []
 		self.allSkyRms = []
+		self.ampProfiles = []
+		self.ccdProfiles = []
 	def _preprocess(self,fits,f):
 		super(BokCalcGainBalanceFactors,self)._preprocess(fits,f)
 		if self.nProc > 1:
@@ -653,15 +800,73 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 			# with duplicates when a subprocess is reused
 			self.reset()
 		self.files.append(f)
-		self.hduData = []
+		self.ampStrips = []
+		self.ampMaskOk = []
 		self.rawSky = []
 		self.rawSkyRms = []
-	def process_hdu(self,extName,data,hdr):
-		self.hduData.append(data)
-		sky = bokutil.array_clip(data[self.skyRegion],clip_iters=2)
+	def process_file(self,f):
+		fits = bokutil.BokMefImage(self.inputNameMap(f),
+		                           mask_file=self.maskNameMap(f),
+		                           mask_type=self.maskType,
+		                           read_only=True,
+		                           extensions=self.extensions)
+		try:
+			for maskIm,maskType in zip(self.masks,self.maskTypes):
+				fits.add_mask(maskIm,maskType)
+			self._preprocess(fits,f)
+			bsMasks = self._load_bright_star_mask(f)
+			for i,extName in enumerate(fits.extensions):
+				self._read_amp(fits,extName,bsMasks.get(i),
+				               self.stripsNeeded[i])
+			self._postprocess(fits,f)
+		except:
+			fits.abort()
+			raise
+		fits.close()
+		return self._getOutput()
+	def _load_bright_star_mask(self,f):
+		'''the bright star mask split into amplifiers, indexed like the 
+		   HDUs'''
+		ampMasks = {}
+		if self.bsMaskNameMap is None:
+			return ampMasks
+		bsMask = fitsio.FITS(self.bsMaskNameMap(f))
+		try:
+			for ccdNum,extGroup in enumerate(amp_iterator(),start=1):
+				ccdMaskIm = bokutil.load_mask(bsMask['CCD%d'%ccdNum].read(),
+				                              self.bsMaskType)
+				ampMasks_ = bokutil.ccd_split(ccdMaskIm,ccdNum)
+				for ampNum,ampMask in zip(extGroup,ampMasks_):
+					ampMasks[ampNum-1] = ampMask
+		finally:
+			bsMask.close()
+		return ampMasks
+	def _read_amp(self,fits,extName,bsMask,strips):
+		'''read the sky region and the edge strips of an amplifier as 
+		   subsets of the image'''
+		sky = bokutil.array_clip(fits.get(extName,self.skyRegion),
+		                         clip_iters=2)
 		self.rawSky.append(sky.mean())
 		self.rawSkyRms.append(sky.std())
-		return data,hdr
+		# the full mask is used to check whether the amp is swamped
+		if len(fits.masks) > 0:
+			mask = fits._load_masks(extName,None)
+		else:
+			mask = np.zeros(fits.fits[extName].get_dims(),dtype=np.bool)
+		if bsMask is not None:
+			mask = mask | bsMask
+		self.ampMaskOk.append(np.count_nonzero(mask)/float(mask.size) < 
+		                        self.maskFracThresh)
+		ampStrips = {}
+		for which,edgedir in strips:
+			if which=='amp':
+				s = self.ampEdgeSlices[edgedir]
+			elif which=='ccd':
+				s = self.ccdEdgeSlices[edgedir]
+			im = fits.get(extName,s)
+			ampStrips[which,edgedir] = np.ma.masked_array(np.ma.getdata(im),
+			                                              mask=mask[s])
+		self.ampStrips.append(ampStrips)
 	def process_files(self,files,filters):
 		self.filters = filters
 		super(BokCalcGainBalanceFactors,self).process_files(files)
@@ -678,42 +883,37 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 			return None
 		return imslice
 	def _get_img_slices(self,refExt,calExt,edgedir,which):
-		if which=='amp':
-			s = self.ampEdgeSlices[edgedir]
-		elif which=='ccd':
-			s = self.ccdEdgeSlices[edgedir]
-		refslice = self._get_img_slice(self.hduData[refExt][s])
-		calslice = self._get_img_slice(self.hduData[calExt][s])
+		refslice = self._get_img_slice(self.ampStrips[refExt][which,edgedir])
+		calslice = self._get_img_slice(self.ampStrips[calExt][which,edgedir])
 		if refslice is None or calslice is None:
 			print 'could not correct ',which,refExt,calExt
 		# also check whether the CCD is swamped, which likely means the
 		# strip along the edge is unreliable
-		n = self.hduData[refExt].size
-		if not ( self._slice_ok(self.hduData[refExt],n) and
-		         self._slice_ok(self.hduData[calExt],n) ):
+		if not ( self.ampMaskOk[refExt] and self.ampMaskOk[calExt] ):
 			print 'could not correct ',which,refExt,calExt
 			refslice,calslice = None,None
 		return refslice,calslice
-	def _get_flux_ratio(self,refExt,calExt,edgedir,which):
+	def _get_strip_profiles(self,refExt,calExt,edgedir,which):
+		'''mean profiles along the edge strips of the reference and 
+		   calibrated amps, masked values are NaN'''
 		refslice,calslice = self._get_img_slices(refExt,calExt,edgedir,which)
 		if refslice is None or calslice is None:
-			return 0.0
+			return None
 		axis = {'x':1,'y':0}[edgedir]
 		refv = refslice.mean(axis=axis)
 		calv = calslice.mean(axis=axis)
+		return np.ma.vstack([refv,calv]).filled(np.nan)
+	def _profile_ratio(self,prof):
+		'''the clipped mean ratio of the reference and calibrated profiles'''
+		if prof is None or np.all(np.isnan(prof)):
+			return 0.0
+		refv,calv = np.ma.masked_invalid(prof)
 		fratio = np.ma.divide(refv,calv)
 		return bokutil.array_clip(fratio,**self.ratioClipArgs).mean()
-	def _apply_bright_star_mask(self,f):
-		bsMask = fitsio.FITS(self.bsMaskNameMap(f))
-		for ccdNum,extGroup in enumerate(amp_iterator(),start=1):
-			ccdMaskIm = bokutil.load_mask(bsMask['CCD%d'%ccdNum].read(),
-			                              self.bsMaskType)
-			ampMasks = bokutil.ccd_split(ccdMaskIm,ccdNum)
-			for ampNum,ampMask in zip(extGroup,ampMasks):
-				self.hduData[ampNum-1].mask |= ampMask
 	def _postprocess(self,fits,f):
-		self._apply_bright_star_mask(f)
 		gains = np.zeros(16,dtype=np.float32)
+		ampProfiles = np.full((16,2,self.ampProfLen),np.nan)
+		ccdProfiles = np.full((4,2,self.ccdProfLen),np.nan)
 		# balance the amps
 		for ccdi,extGroup in enumerate(amp_iterator()):
 			for ampi,ampj,edgedir in self.ampMap[ccdi]:
@@ -723,8 +923,11 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 					# the reference amp
 					gains[calExt] = 1.0
 				else:
-					gains[calExt] = self._get_flux_ratio(refExt,calExt,
-					                                     edgedir,'amp')
+					prof = self._get_strip_profiles(refExt,calExt,
+					                                edgedir,'amp')
+					gains[calExt] = self._profile_ratio(prof)
+					if prof is not None:
+						ampProfiles[calExt,:,:prof.shape[1]] = prof
 		# store the CCD count ratios
 		ccdratios = np.ones(4,dtype=np.float32)
 		for ccdNum,refExt,calExt,edgedir in self.ccdMap:
@@ -732,22 +935,31 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 				# the reference CCD
 				ccdratios[ccdNum-1] = 1.0
 			else:
-				ccdratios[ccdNum-1] = self._get_flux_ratio(refExt,calExt,
-				                                           edgedir,'ccd')
+				prof = self._get_strip_profiles(refExt,calExt,edgedir,'ccd')
+				ccdratios[ccdNum-1] = self._profile_ratio(prof)
+				if prof is not None:
+					ccdProfiles[ccdNum-1,:,:prof.shape[1]] = prof
 		#
 		self.ampRelGains.append(gains)
 		self.ccdRelGains.append(ccdratios)
 		self.allSkyVals.append(np.array(self.rawSky))
 		self.allSkyRms.append(np.array(self.rawSkyRms))
+		self.ampProfiles.append(ampProfiles)
+		self.ccdProfiles.append(ccdProfiles)
+		self.ampStrips = None
 	def _getOutput(self):
-		return (self.files,self.ampRelGains,self.ccdRelGains,self.allSkyVals)
+		return (self.files,self.ampRelGains,self.ccdRelGains,self.allSkyVals,
+		        self.allSkyRms,self.ampProfiles,self.ccdProfiles)
 	def _null_result(self,f):
 		return ([f],[np.zeros(16,dtype=np.float32)],
 		        [np.zeros(4,dtype=np.float32)],
-		        [np.zeros(16,dtype=np.float32)])
+		        [np.zeros(16,dtype=np.float32)],
+		        [np.zeros(16,dtype=np.float32)],
+		        [np.full((16,2,self.ampProfLen),np.nan)],
+		        [np.full((4,2,self.ccdProfLen),np.nan)])
 	def _ingestOutput(self,procOut):
-		self.files,self.ampRelGains,self.ccdRelGains,self.allSkyVals = \
-		              zip(*procOut)
+		( self.files,self.ampRelGains,self.ccdRelGains,self.allSkyVals,
+		  self.allSkyRms,self.ampProfiles,self.ccdProfiles ) = zip(*procOut)
 		# squeeze out the extra axis that occurs since output elements
 		# are in lists of unit length when multiprocessing
 		self.files = np.array(self.files).squeeze()
@@ -755,6 +967,9 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		self.ampRelGains = np.array(self.ampRelGains).squeeze()
 		self.ccdRelGains = np.array(self.ccdRelGains).squeeze()
 		self.allSkyVals = np.array(self.allSkyVals).squeeze()
+		self.allSkyRms = np.array(self.allSkyRms).squeeze()
+		self.ampProfiles = np.concatenate(self.ampProfiles)
+		self.ccdProfiles = np.concatenate(self.ccdProfiles)
 	def _median_gain_trend(self,gc,xtraMsk):
 		gc = np.ma.array(gc,mask=(gc==0),copy=True)
 		gc.mask |= xtraMsk
@@ -886,6 +1101,76 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		         np.array(self.ampGainTrend),
 		         np.array(self.ccdGainTrend),
 		         np.array(self.allSkyVals) )
+	def _strip_params(self):
+		j1,j2 = self.ccdwid
+		return {'AMPLEN':self.amplen,'AMPWID':self.ampwid,
+		        'AMPSTRD':self.ampstride,'CCDLEN':self.ccdlen,
+		        'CCDWID1':j1,'CCDWID2':j2,'CCDSTRD':self.ccdstride}
+	def write_table(self,tableFile):
+		'''Save the per-file measurements (raw ratios, sky levels, and
+		   strip profiles) so that the gain trends can be refit with
+		   calc_mean_corrections without reading the images again.'''
+		nfile = len(self.files)
+		tab = np.zeros(nfile,dtype=[('file','S80'),('filter','S10'),
+		                     ('ampGain','f4',(16,)),('ccdGain','f4',(4,)),
+		                     ('skyVal','f8',(16,)),('skyRms','f8',(16,)),
+		                     ('ampProf','f8',(16,2,self.ampProfLen)),
+		                     ('ccdProf','f8',(4,2,self.ccdProfLen))])
+		tab['file'] = [ os.path.basename(f) for f in self.files ]
+		tab['filter'] = np.array(self.filters).reshape(nfile)
+		tab['ampGain'] = np.array(self.ampRelGains).reshape(nfile,16)
+		tab['ccdGain'] = np.array(self.ccdRelGains).reshape(nfile,4)
+		tab['skyVal'] = np.array(self.allSkyVals).reshape(nfile,16)
+		tab['skyRms'] = np.array(self.allSkyRms).reshape(nfile,16)
+		tab['ampProf'] = np.array(self.ampProfiles)
+		tab['ccdProf'] = np.array(self.ccdProfiles)
+		tmpFile = tableFile+'.tmp%d' % os.getpid()
+		fitsio.write(tmpFile,tab,extname='GAINBAL',
+		             header=self._strip_params(),clobber=True)
+		os.rename(tmpFile,tableFile)
+	def load_table(self,tableFile,files=None):
+		'''Load the measurements saved by write_table in place of 
+		   process_files. Returns False if the table was made with other
+		   strip parameters or for a different list of files.'''
+		tab,hdr = fitsio.read(tableFile,ext='GAINBAL',header=True)
+		for k,v in self._strip_params().items():
+			if hdr.get(k) != v:
+				return False
+		tabFiles = [ f.strip() for f in tab['file'] ]
+		if files is not None and \
+		     tabFiles != [ os.path.basename(f) for f in files ]:
+			return False
+		self.reset()
+		self.files = list(files) if files is not None else tabFiles
+		self.filters = np.array([ f.strip() for f in tab['filter'] ])
+		self.ampRelGains = list(tab['ampGain'])
+		self.ccdRelGains = list(tab['ccdGain'])
+		self.allSkyVals = list(tab['skyVal'])
+		self.allSkyRms = list(tab['skyRms'])
+		self.ampProfiles = list(tab['ampProf'])
+		self.ccdProfiles = list(tab['ccdProf'])
+		return True
+	def calc_strip_ratios(self,**kwargs):
+		'''Recompute the raw amp and CCD ratios from the strip profiles, 
+		   e.g., after changing the ratio clipping.'''
+		self.ratioClipArgs.update(kwargs)
+		for k,(ampProf,ccdProf) in enumerate(zip(self.ampProfiles,
+		                                         self.ccdProfiles)):
+			gains = np.zeros(16,dtype=np.float32)
+			for ccdi in range(4):
+				for ampi,ampj,edgedir in self.ampMap[ccdi]:
+					calExt = 4*ccdi + ampj
+					if ampi==ampj:
+						gains[calExt] = 1.0
+					else:
+						gains[calExt] = self._profile_ratio(ampProf[calExt])
+			ccdratios = np.ones(4,dtype=np.float32)
+			for ccdNum,refExt,calExt,edgedir in self.ccdMap:
+				if refExt!=calExt:
+					ccdratios[ccdNum-1] = self._profile_ratio(
+					                                  ccdProf[ccdNum-1])
+			self.ampRelGains[k] = gains
+			self.ccdRelGains[k] = ccdratios
 
 ###############################################################################
 #                                                                             #
@@ -896,7 +1181,10 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 
 def _orient_mosaic(hdr,ims,ccdNum,origin):
 	outIm = bokutil.ccd_join(ims,ccdNum,origin=origin)
-	ny,nx = outIm.shape
+	return outIm,_mosaic_header(hdr,outIm.shape,ccdNum,origin)
+
+def _mosaic_header(hdr,shape,ccdNum,origin):
+	ny,nx = shape
 	det_i = (ccdNum-1) // 2
 	det_j = ccdNum % 2
 	hdr['DATASEC'] = '[1:%d,1:%d]' % (nx,ny)
@@ -942,7 +1230,7 @@ def _orient_mosaic(hdr,ims,ccdNum,origin):
 			hdr['CRPIX2'] = ny - crpix1
 		else:
 			hdr['CRPIX2'] = crpix1
-	return outIm,hdr
+	return hdr
 
 # XXX should fit this into a BokProcess even if it requires some mungeing
 #     of the way extensions are combined into ccds
@@ -957,13 +1245,13 @@ def _combine_ccds(f,**kwargs):
 	# of each channel at the CCD centers to be unity
 	flatNorm = kwargs.get('apply_flat_norm',False)
 	ignoreExisting = kwargs.get('ignore_existing',True)
+	storage = bokutil.check_storage_type(kwargs.get('storage',
+	                         getattr(outputFileMap,'storage','float32')))
+	quantLevel = kwargs.get('quant_level',
+	                        getattr(outputFileMap,'quantLevel',4.))
 	# another hacky entry point for preprocessing of per-amp images
 	# before combining
 	_preprocess_ims = kwargs.get('_preprocess_function')
-	# fitsio doesn't accept file descriptors, but tempfile opens files...
-	tmpFile = tempfile.NamedTemporaryFile()
-	tmpFileName = tmpFile.name
-	tmpFile.close()
 	# do the extensions in numerical order, instead of HDU list order
 	extns = np.array(['IM%d' % ampNum for ampNum in range(1,17)])
 	#
@@ -988,7 +1276,9 @@ def _combine_ccds(f,**kwargs):
 				                    '%s already exists'%outputFile)
 		outFits = fitsio.FITS(outputFile,'rw')
 	else:
-		# have to use a temporary file to change format
+		# have to use a temporary file to change format, put it next to
+		# the input so that it can be renamed into place
+		tmpFileName = '%s.tmp%d' % (outputFile,os.getpid())
 		if os.path.exists(tmpFileName):
 			os.unlink(tmpFileName)
 		outFits = fitsio.FITS(tmpFileName,'rw')
@@ -998,15 +1288,21 @@ def _combine_ccds(f,**kwargs):
 	hdr['CCDJOIN'] = bokutil.get_timestamp()
 	outFits.write(None,header=hdr)
 	refSkyCounts = None
+	# each CCD image is preallocated and the amplifiers are written 
+	# directly into their oriented slices
 	for ccdNum,extGroup in enumerate(np.hsplit(extns,4),start=1):
 		hdr = inFits[bokCenterAmps[ccdNum-1]].read_header()
-		ccdIms = []
 		satvals = []
 		for j,ext in enumerate(extGroup):
-			im = inFits[ext].read() 
 			hext = inFits[ext].read_header()
+			im = bokutil.read_image(inFits[ext],header=hext)
 			if _preprocess_ims is not None:
 				im = _preprocess_ims(im,hext,ext)
+			if j==0:
+				outIm,ampIms = bokutil.ccd_join_buffer(im.shape,ccdNum,
+				                                       im.dtype,origin=origin)
+			ampIm = ampIms[j]
+			gain = 1.0
 			try:
 				# copy in the nominal gain values from per-amp headers
 				gainKey = 'GAIN%02dA' % int(ext[2:])
@@ -1026,27 +1322,35 @@ def _combine_ccds(f,**kwargs):
 						satvals.append(hdr['SATUR']*gc1*gc2)
 					except ValueError:
 						pass
-				im *= gc1 * gc2
+				gain = gc1 * gc2
 				# the final gain factor
 				hdr['GAIN%02d'%int(ext[2:])] = g0 * gc1 * gc2
+			# scale the freshly read (contiguous) array and copy it into 
+			# the CCD image; multiplying into the transposed view directly 
+			# is much slower
+			if gain != 1.0:
+				im *= gain
+			np.copyto(ampIm,np.ma.getdata(im))
 			if flatNorm:
 				_s = bokutil.stats_region('amp_corner_ccdcenter_128')
-				_a = bokutil.array_stats(im[_s],method='mode')
-				im /= _a
-			ccdIms.append(im)
-		# orient the channel images into a mosaic of CCDs and
-		# modify WCS & mosaic keywords
-		outIm,hdr = _orient_mosaic(hdr,ccdIms,ccdNum,origin)
+				if np.ma.isMaskedArray(im):
+					_im = np.ma.masked_array(ampIm,mask=im.mask)
+				else:
+					_im = ampIm
+				_a = bokutil.array_stats(_im[_s],method='mode')
+				ampIm /= _a
+		# modify WCS & mosaic keywords for the orientation of the CCD
+		hdr = _mosaic_header(hdr,outIm.shape,ccdNum,origin)
 		if len(satvals)>0:
 			hdr['SATUR'] = np.min(satvals)
-		if True:
-			# For some reason this results in a segfault when running
-			# on NERSC unless the image is copied...
-			outIm = outIm.copy()
+		bokutil.strip_quantization(hdr)
+		if storage == 'int16':
+			outIm,hdr = bokutil.quantize_hdu(outIm,hdr,quantLevel)
 		outFits.write(outIm,extname='CCD%d'%ccdNum,header=hdr)
 	outFits.close()
+	inFits.close()
 	if outputFile == inputFile:
-		shutil.move(tmpFileName,inputFile)
+		os.rename(tmpFileName,inputFile)
 
 def _combine_ccds_exc(f,**kwargs):
 	try:
@@ -1071,40 +1375,19 @@ def combine_ccds(fileList,**kwargs):
 ###############################################################################
 
 def find_bright_stars(im,saturation,minNSat=100):
-	y,x = np.indices(im.shape)
 	saturated = im >= saturation
-	satObjs,nObjs = meas.label(saturated)#,np.ones((3,3)))
-	nsat = meas.labeled_comprehension(saturated,satObjs,
-	                                  np.arange(1,nObjs+1),np.sum,int,-1)
-	ii = np.where(nsat > minNSat)[0]
-	# no way to only measure by index?
-	blobs = meas.find_objects(satObjs)
-	cntrx = [ np.average(x[blobs[i]][~saturated[blobs[i]]],
-	                     weights=im[blobs[i]][~saturated[blobs[i]]])
-	            for i in ii ]
-	cntry = [ np.average(y[blobs[i]][~saturated[blobs[i]]],
-	                     weights=im[blobs[i]][~saturated[blobs[i]]])
-	            for i in ii ]
-	return np.array([cntrx,cntry]).astype(int)
+	cntr = [ _blob_centroid(im,saturated,box)
+	           for box,blob,nsat in saturated_blobs(saturated,minNSat+1) ]
+	return np.array(zip(*cntr)).reshape(2,-1).astype(int)
 
 def mask_bright_stars(im,saturation,minNSat=50):
-	y,x = np.indices(im.shape)
 	mask = np.zeros(im.shape,dtype=bool)
 	saturated = im >= saturation
-	satObjs,nObjs = meas.label(saturated)#,np.ones((3,3)))
-	nsat = meas.labeled_comprehension(saturated,satObjs,
-	                                  np.arange(1,nObjs+1),np.sum,int,-1)
-	ii = np.where(nsat > minNSat)[0]
-	# no way to only measure by index?
-	blobs = meas.find_objects(satObjs)
-	for i in ii:
-		cntrx = np.average(x[blobs[i]][~saturated[blobs[i]]],
-		                   weights=im[blobs[i]][~saturated[blobs[i]]])
-		cntry = np.average(y[blobs[i]][~saturated[blobs[i]]],
-		                   weights=im[blobs[i]][~saturated[blobs[i]]])
+	for box,blob,nsat in saturated_blobs(saturated,minNSat+1):
+		cntrx,cntry = _blob_centroid(im,saturated,box)
 		cntrx = int(cntrx)
 		cntry = int(cntry)
-		xextent = np.max(np.abs(x[blobs[i]]-cntrx))
+		xextent = max(abs(box[1].start-cntrx),abs(box[1].stop-1-cntrx))
 		mask[(cntry-xextent):(cntry+xextent),
 		     (cntrx-xextent):(cntrx+xextent)] = True
 	return mask
@@ -1139,10 +1422,9 @@ class BokGenerateSkyFlatMasks(bokutil.BokProcess):
 		sky,rms = bokutil.array_stats(data[self.statsPix],
 		                              method='mode',rms=True,
 		                              **self.clipArgs)
-		binnedIm = bokutil.rebin(data,self.nBin)
 		# propagate the mask if too many sub-pixels are masked
 		#mask = binnedIm.sum(axis=-1) > self.nBin**2/2
-		binnedIm = binnedIm.mean(axis=-1)
+		binnedIm = bokutil.block_reduce(data,self.nBin,'mean')
 		mask = binnedIm.mask.copy()
 		# divide by RMS to make a SNR image
 		snr = (binnedIm.data-sky) / (rms/self.nBin)
@@ -1199,13 +1481,15 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 	def _getnorm(self,f):
 		fits = bokutil.BokMefImage(self.inputNameMap(f),
 		                           mask_file=self.maskNameMap(f),
-		                           read_only=True)
+		                           read_only=True,
+		                           read_region=(self.statsRegion,self.nSample))
 		meanVals = []
 		for extn,data,hdr in fits:
-			meanVal = bokutil.array_stats(data[self.statsPix],
+			meanVal = bokutil.array_stats(data,
 			                              method=self.statsMethod,
 			                              **self.clipArgs)
 			meanVals.append(meanVal)
+		fits.close()
 		try:
 			pid = multiprocessing.current_process().name.split('-')[1]
 		except:
@@ -1280,11 +1564,11 @@ class BokNightSkyFlatStack(bokutil.ClippedMeanStack):
 		fits = bokutil.BokMefImage(self.inputNameMap(f),
 		                           mask_file=self.maskNameMap(f),
 		                           read_only=True)
-		# XXX have the get the full image and then subsample, because
-		#     fitsio doesn't handle negative slice boundaries
-		normpix = fits.get(self.normCCD)[self.statsPix]
+		normpix = fits.get(self.normCCD,
+		                   fits.region_bounds(self.normCCD,self.statsRegion,8))
 		meanVal = bokutil.array_stats(normpix,method=self.statsMethod,
 		                              **self.clipArgs)
+		fits.close()
 		norm = 1/meanVal
 		try:
 			pid = multiprocessing.current_process().name.split('-')[1]
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+
+'''NaN-native image statistics. Masked pixels are represented as NaNs in
+   a floating point array instead of carrying a separate np.ma mask, which
+   allows the clipping to be done in place and avoids the full-size copies
+   made by np.ma and astropy.stats.sigma_clip on every iteration.'''
+
+import warnings
+import numpy as np
+
+_nan_cenfuncs = {
+  'mean':np.nanmean, 'median':np.nanmedian,
+  np.ma.mean:np.nanmean, np.ma.median:np.nanmedian,
+  np.mean:np.nanmean, np.median:np.nanmedian,
+  np.nanmean:np.nanmean, np.nanmedian:np.nanmedian,
+}
+
+def nan_cenfunc(cenfunc):
+	try:
+		return _nan_cenfuncs[cenfunc]
+	except (KeyError,TypeError):
+		raise ValueError('clip center function %s unrecognized' % cenfunc)
+
+def to_nan_array(arr,dtype=None,copy=True):
+	'''Convert an array (masked or not) to a floating point array with
+	   masked elements set to NaN. Integer input is converted to float32,
+	   floating point input keeps its precision unless dtype is given.'''
+	if dtype is None:
+		dtype = np.result_type(arr.dtype,np.float32)
+	if isinstance(arr,np.ma.MaskedArray):
+		data = np.array(arr.data,dtype=dtype,copy=True)
+		mask = np.ma.getmaskarray(arr)
+		if mask.any():
+			data[mask] = np.nan
+	else:
+		data = np.array(arr,dtype=dtype,copy=copy)
+	# infs are treated as masked, as in sigma_clip
+	isinf = np.isinf(data)
+	if isinf.any():
+		data[isinf] = np.nan
+	return data
+
+def nan_clip(arr,axis=None,clip_sig=2.5,clip_iters=2,clip_cenfunc='mean',
+             inplace=True):
+	'''Sigma clip a NaN-masked floating point array along the given axis.
+	   Rejected values are replaced with NaN in place (unless inplace=False)
+	   and the clipped array is returned. clip_iters=None iterates until
+	   no further values are rejected. Same algorithm as
+	   astropy.stats.sigma_clip with symmetric limits.'''
+	if not inplace:
+		arr = arr.copy()
+	cenfunc = nan_cenfunc(clip_cenfunc)
+	if axis is not None and axis < 0:
+		axis += arr.ndim
+	dev = np.empty_like(arr)
+	bad = np.empty(arr.shape,dtype=np.bool_)
+	niter = 0
+	with warnings.catch_warnings():
+		# all-NaN slices and comparisons against NaN are expected
+		warnings.simplefilter('ignore',RuntimeWarning)
+		with np.errstate(invalid='ignore'):
+			while clip_iters is None or niter < clip_iters:
+				cen = cenfunc(arr,axis=axis,keepdims=True)
+				sig = np.nanstd(arr,axis=axis,keepdims=True)
+				sig *= clip_sig
+				np.subtract(arr,cen,out=dev)
+				np.abs(dev,out=dev)
+				np.greater(dev,sig,out=bad)
+				niter += 1
+				if not bad.any():
+					break
+				arr[bad] = np.nan
+	return arr
+
+def nan_stats(arr,axis=None,methods=('mean','median','mode','rms')):
+	'''Compute several statistics from a NaN-masked array in one call,
+	   sharing the intermediate mean and median. Returns a dict.'''
+	rv = {}
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore',RuntimeWarning)
+		if any([m in methods for m in ['mean','mode','rms']]):
+			rv['mean'] = np.nanmean(arr,axis=axis)
+		if any([m in methods for m in ['median','mode']]):
+			rv['median'] = np.nanmedian(arr,axis=axis)
+		if 'mode' in methods:
+			rv['mode'] = 3*rv['median'] - 2*rv['mean']
+		if 'rms' in methods or 'std' in methods:
+			rv['rms'] = rv['std'] = np.nanstd(arr,axis=axis)
+		if 'ngood' in methods:
+			rv['ngood'] = np.sum(np.isfinite(arr),axis=axis)
+	return { k:rv[k] for k in methods }
+
+def _parse_percentile(field):
+	# 'p10','p99.5' -> 10.,99.5
+	try:
+		q = float(field[1:])
+	except ValueError:
+		q = -1
+	if not field.startswith('p') or not 0 <= q <= 100:
+		raise ValueError('stats field %s unrecognized' % field)
+	return q
+
+value_stat_fields = ['mean','median','mode','std','rms','min','max','npix']
+
+def value_stats(v,fields,mode_estimator='pearson',mean=None):
+	'''Compute all of the requested statistics from a 1-d array of valid
+	   values in one pass. Fields are any of value_stat_fields or pNN for
+	   the NN-th percentile (interpolated as np.percentile). The median
+	   and percentiles share a single partition of the values, and the
+	   mean (which can be passed in) is shared by the mode. Returns a
+	   dict.'''
+	v = np.asarray(v).ravel()
+	n = v.size
+	rv = {'npix':n}
+	pct = {}
+	for k in fields:
+		if k.startswith('p'):
+			pct[k] = _parse_percentile(k)
+		elif k not in value_stat_fields:
+			raise ValueError('stats field %s unrecognized' % k)
+	if n == 0:
+		return { k:(0 if k=='npix' else np.nan) for k in fields }
+	needMedian = 'median' in fields or \
+	               ('mode' in fields and mode_estimator=='pearson')
+	if needMedian or pct:
+		# order statistics needed by the median and all percentiles
+		pos = { k:q*(n-1)/100. for k,q in pct.items() }
+		kth = set([(n-1)//2,n//2]) if needMedian else set()
+		for x in pos.values():
+			kth.update([int(np.floor(x)),min(int(np.floor(x))+1,n-1)])
+		s = np.partition(v,sorted(kth))
+		if needMedian:
+			rv['median'] = np.mean(s[[(n-1)//2,n//2]])
+		for k,x in pos.items():
+			i1 = int(np.floor(x))
+			i2 = min(i1+1,n-1)
+			rv[k] = s[i1] + (x-i1)*(s[i2]-s[i1])
+	if mean is not None:
+		rv['mean'] = mean
+	elif 'mean' in fields or 'mode' in fields:
+		rv['mean'] = v.mean(dtype=np.float64)
+	if 'std' in fields or 'rms' in fields:
+		rv['rms'] = rv['std'] = v.std(dtype=np.float64)
+	if 'min' in fields:
+		rv['min'] = v.min()
+	if 'max' in fields:
+		rv['max'] = v.max()
+	if 'mode' in fields:
+		if mode_estimator == 'pearson':
+			rv['mode'] = 3*rv['median'] - 2*rv['mean']
+		else:
+			rv['mode'] = nan_mode(v,mode_estimator,mean=rv['mean'])
+	return { k:rv[k] for k in fields }
+
+##############################################################################
+#                                                                            #
+# Histogram estimators                                                       #
+#   O(N) median and mode estimates from binned counts, in place of the full  #
+#   sort needed by np.median. Integer data is binned at unit width, which    #
+#   makes the estimates exact; for floating point data each refinement pass  #
+#   re-bins the pixels in the selected bin, so the error is bounded by       #
+#   (max-min)/nbins**npass.                                                  #
+#                                                                            #
+##############################################################################
+
+def _finite_values(arr):
+	if isinstance(arr,np.ma.MaskedArray):
+		# NaN can only stand in for the masked values of float arrays
+		arr = np.ma.filled(arr,np.nan) if arr.dtype.kind == 'f' \
+		         else arr.compressed()
+	else:
+		arr = np.asarray(arr)
+	arr = arr.ravel()
+	if arr.dtype.kind in 'iub':
+		return arr
+	arr = arr[np.isfinite(arr)]
+	# float images of raw counts are binned as integers (exact estimates)
+	if arr.size > 0 and arr.max()-arr.min() < 2**24 and \
+	     np.array_equal(arr,np.floor(arr)):
+		return arr.astype(np.int64)
+	return arr
+
+def _int_order_stat(v,k):
+	# exact k-th smallest (0-based) value of integer data via unit bins,
+	# unless there would be more bins than values (sparse, wide-range data)
+	vmin = v.min()
+	if v.max() - vmin > v.size:
+		return np.partition(v,k)[k]
+	counts = np.bincount((v - vmin).astype(np.intp))
+	b = np.searchsorted(np.cumsum(counts),k,side='right')
+	return vmin + b
+
+def _float_order_stat(v,k,nbins,npass):
+	# approximate k-th smallest value by iteratively re-binning the bin
+	# that contains it; the value is interpolated within the final bin
+	lo,hi = v.min(),v.max()
+	for n in range(npass):
+		binsize = (hi - lo) / float(nbins)
+		if binsize == 0:
+			return lo
+		idx = ((v - lo) / binsize).astype(np.intp)
+		np.clip(idx,0,nbins-1,out=idx)
+		counts = np.bincount(idx,minlength=nbins)
+		cum = np.cumsum(counts)
+		b = np.searchsorted(cum,k,side='right')
+		nbelow = cum[b] - counts[b]
+		if n < npass-1:
+			v = v[idx==b]
+			k -= nbelow
+			lo,hi = lo + b*binsize,lo + (b+1)*binsize
+	frac = (k - nbelow + 0.5) / counts[b]
+	return lo + (b + frac)*binsize
+
+def hist_median(arr,nbins=1024,npass=2):
+	'''O(N) median of the finite values of arr. Exact for integer data,
+	   otherwise accurate to (max-min)/nbins**npass.'''
+	v = _finite_values(arr)
+	n = v.size
+	if n == 0:
+		return np.nan
+	if v.dtype.kind in 'iub':
+		orderstat = lambda k: _int_order_stat(v,k)
+	else:
+		orderstat = lambda k: _float_order_stat(v,k,nbins,npass)
+	k1,k2 = (n-1)//2,n//2
+	m1 = orderstat(k1)
+	m2 = m1 if k2==k1 else orderstat(k2)
+	return 0.5*(m1+m2)
+
+def hist_peak(arr,binsize=None,nbins=None,hwidth=5):
+	'''Mode as the peak of the histogram of finite values, refined with a
+	   parabola fit to the 2*hwidth+1 bins around the peak bin. The bin size
+	   defaults to 1/10 of the rms (or (max-min)/nbins if nbins is given),
+	   rounded to a whole number of counts for integer data.'''
+	v = _finite_values(arr)
+	if v.size == 0:
+		return np.nan
+	lo = v.min()
+	if binsize is None:
+		if nbins is not None:
+			binsize = (v.max() - lo) / float(nbins)
+		else:
+			binsize = 0.1*v.std()
+		if v.dtype.kind in 'iub':
+			binsize = max(1,int(round(binsize)))
+			# center the integer values in the bins
+			lo = lo - 0.5
+	if binsize == 0:
+		return v[0]
+	counts = np.bincount(((v - lo) / binsize).astype(np.intp))
+	b = np.argmax(counts)
+	i1,i2 = max(0,b-hwidth),min(len(counts),b+hwidth+1)
+	x = np.arange(i1,i2) - b
+	peak = 0.
+	if len(x) >= 3:
+		c2,c1,c0 = np.polyfit(x,counts[i1:i2],2)
+		if c2 < 0:
+			peak = np.clip(-0.5*c1/c2,x[0],x[-1])
+	return lo + (b + 0.5 + peak)*binsize
+
+mode_estimators = ['pearson','histogram','peak']
+
+def nan_mode(arr,estimator='pearson',mean=None):
+	'''Mode of a NaN-masked array. 'pearson' is 3*median-2*mean (as used
+	   by bokutil.array_stats), 'histogram' is the same with the median
+	   from hist_median, and 'peak' is the histogram peak.'''
+	if estimator == 'peak':
+		return hist_peak(arr)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore',RuntimeWarning)
+		if mean is None:
+			mean = np.nanmean(arr)
+		if estimator == 'histogram':
+			median = hist_median(arr)
+		elif estimator == 'pearson':
+			median = np.nanmedian(arr)
+		else:
+			raise ValueError('mode estimator %s unrecognized' % estimator)
+	return 3*median - 2*mean
+
+def _clipped_masked_array(arr,work):
+	# masked array with the original data values and the clipped mask
+	return np.ma.masked_array(np.ma.getdata(arr),mask=np.isnan(work))
+
+def nan_array_clip(arr,axis=None,**kwargs):
+	'''Drop-in equivalent of bokutil.array_clip using nan_clip. Returns a
+	   masked array that shares the input data values.'''
+	work = to_nan_array(arr)
+	nan_clip(work,axis=axis,
+	         clip_sig=kwargs.pop('clip_sig',2.5),
+	         clip_iters=kwargs.pop('clip_iters',2),
+	         clip_cenfunc=kwargs.pop('clip_cenfunc',np.ma.mean))
+	if len(kwargs) > 0:
+		print 'WARNING: extra args to array_clip: ',kwargs
+	return _clipped_masked_array(arr,work)
+
+def nan_array_stats(arr,axis=None,method='median',clip=True,rms=False,
+                    retArray=False,mode_estimator='pearson',**kwargs):
+	'''Drop-in equivalent of bokutil.array_stats using the NaN engine.
+	   mode_estimator selects how method='mode' is computed when axis is
+	   None (see nan_mode).'''
+	if method not in ['median','mean','mode']:
+		raise ValueError('array stats method %s unrecognized' % method)
+	work = to_nan_array(arr)
+	if clip:
+		nan_clip(work,axis=axis,
+		         clip_sig=kwargs.pop('clip_sig',2.5),
+		         clip_iters=kwargs.pop('clip_iters',2),
+		         clip_cenfunc=kwargs.pop('clip_cenfunc',np.ma.mean))
+	if len(kwargs) > 0:
+		print 'WARNING: extra args to array_stats: ',kwargs
+	methods = (method,'rms') if rms else (method,)
+	if method == 'mode' and axis is None and mode_estimator != 'pearson':
+		stats = nan_stats(work,methods=('mean','rms'))
+		stats['mode'] = nan_mode(work,mode_estimator,mean=stats['mean'])
+	else:
+		stats = nan_stats(work,axis=axis,methods=methods)
+	rv = [stats[method]]
+	if rms:
+		rv.append(stats['rms'])
+	if axis is not None:
+		rv = [ np.ma.masked_invalid(v) for v in rv ]
+	if retArray:
+		rv.append(_clipped_masked_array(arr,work))
+	if len(rv)>1:
+		return tuple(rv)
+	else:
+		return rv[0]
+
+##############################################################################
+#                                                                            #
+# Stacking kernels                                                           #
+#   operate on NaN-masked image cubes along the last axis (i.e., cubes       #
+#   ordered as (rows,cols,images) like bokutil.build_cube) and return the    #
+#   combined image along with the number of valid values for each pixel.     #
+#                                                                            #
+##############################################################################
+
+def _gather(s,idx):
+	# s[...,idx] elementwise for an index array with the shape of s[...,0]
+	ii = np.ogrid[tuple(slice(0,n) for n in idx.shape)]
+	return s[tuple(ii)+(idx,)]
+
+def _sorted_quantile(s,n,q):
+	'''q-quantile (linear interpolation, as np.percentile) of each pixel
+	   in a cube sorted along the last axis with NaNs at the end, where n
+	   is the number of valid values per pixel.'''
+	pos = q * (np.maximum(n,1) - 1)
+	i1 = np.floor(pos).astype(np.intp)
+	i2 = np.minimum(i1+1,np.maximum(n-1,0))
+	frac = (pos - i1).astype(s.dtype)
+	v1 = _gather(s,i1)
+	v2 = _gather(s,i2)
+	rv = v1 + frac*(v2-v1)
+	rv[n==0] = np.nan
+	return rv
+
+def count_valid(cube):
+	return np.sum(~np.isnan(cube),axis=-1)
+
+def nan_median_cube(cube):
+	'''Median along the last axis of a NaN-masked cube. Uses np.partition
+	   when no values are masked and a single sort otherwise; both avoid
+	   the per-pixel python loops of np.nanmedian and np.ma.median.'''
+	n = count_valid(cube)
+	nimg = cube.shape[-1]
+	if np.all(n == nimg):
+		k = [(nimg-1)//2,nimg//2]
+		p = np.partition(cube,k,axis=-1)
+		return 0.5*(p[...,k[0]]+p[...,k[1]]),n
+	s = np.sort(cube,axis=-1)
+	return _sorted_quantile(s,n,0.5),n
+
+def nan_mean_cube(cube,weights=None):
+	n = count_valid(cube)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore',RuntimeWarning)
+		if weights is None:
+			return np.nanmean(cube,axis=-1),n
+		w = np.where(np.isnan(cube),0,weights)
+		with np.errstate(invalid='ignore',divide='ignore'):
+			return np.nansum(cube*w,axis=-1) / w.sum(axis=-1),n
+
+def minmax_reject_mask(cube,nlow=1,nhigh=1):
+	'''Boolean mask of the nlow lowest and nhigh highest valid values of
+	   each pixel along the last axis.'''
+	n = count_valid(cube)
+	order = np.argsort(cube,axis=-1)
+	rank = np.arange(cube.shape[-1])
+	rej = (rank < nlow) | (rank >= (n-nhigh)[...,np.newaxis])
+	rej &= rank < n[...,np.newaxis]
+	mask = np.empty(cube.shape,dtype=np.bool_)
+	ii = np.ogrid[tuple(slice(0,_n) for _n in order.shape)]
+	mask[tuple(ii[:-1])+(order,)] = rej
+	return mask
+
+def percentile_reject_mask(cube,plow=10.,phigh=90.):
+	'''Boolean mask of values outside the [plow,phigh] percentile range
+	   of each pixel along the last axis.'''
+	n = count_valid(cube)
+	s = np.sort(cube,axis=-1)
+	lo = _sorted_quantile(s,n,plow/100.)[...,np.newaxis]
+	hi = _sorted_quantile(s,n,phigh/100.)[...,np.newaxis]
+	with np.errstate(invalid='ignore'):
+		return (cube < lo) | (cube > hi)
+
+def minmax_mean_cube(cube,nlow=1,nhigh=1,weights=None):
+	cube = cube.copy()
+	cube[minmax_reject_mask(cube,nlow,nhigh)] = np.nan
+	return nan_mean_cube(cube,weights)
+
+def percentile_mean_cube(cube,plow=10.,phigh=90.,weights=None):
+	cube = cube.copy()
+	cube[percentile_reject_mask(cube,plow,phigh)] = np.nan
+	return nan_mean_cube(cube,weights)
+
+def clipped_mean_cube(cube,weights=None,**kwargs):
+	cube = nan_clip(cube,axis=-1,inplace=False,
+	                clip_sig=kwargs.get('clip_sig',2.5),
+	                clip_iters=kwargs.get('clip_iters',2),
+	                clip_cenfunc=kwargs.get('clip_cenfunc','mean'))
+	return nan_mean_cube(cube,weights)
+
+stack_kernels = {
+  'mean':nan_mean_cube,
+  'median':nan_median_cube,
+  'minmax':minmax_mean_cube,
+  'percentile':percentile_mean_cube,
+  'clipped_mean':clipped_mean_cube,
+}
+
+reject_kernels = {
+  'minmax':minmax_reject_mask,
+  'percentile':percentile_reject_mask,
+}
+
+def stack_cube(cube,method='median',**kwargs):
+	'''Combine a NaN-masked cube along the last axis with the named kernel.
+	   Returns (image,nvalid).'''
+	try:
+		kernel = stack_kernels[method]
+	except KeyError:
+		raise ValueError('stack method %s unrecognized' % method)
+	return kernel(cube,**kwargs)
+
+_kernel_arg_names = {
+  'mean':['weights'],
+  'median':[],
+  'minmax':['nlow','nhigh','weights'],
+  'percentile':['plow','phigh','weights'],
+  'clipped_mean':['clip_sig','clip_iters','clip_cenfunc','weights'],
+}
+
+def kernel_args(method,kwargs):
+	'''Select the keyword arguments accepted by the named stack or reject
+	   kernel from a larger set of options.'''
+	return { k:v for k,v in kwargs.items() 
+	           if k in _kernel_arg_names.get(method,[]) }
@@ -1,18 +1,36 @@
 #!/usr/bin/env python
 
 import os,sys
+import shutil
+import hashlib
 import types
+import inspect
+import warnings
+import tempfile
+import cPickle as pickle
+from functools import partial
 from time import time
 from datetime import datetime
-from collections import OrderedDict,defaultdict
+from collections import OrderedDict,defaultdict,deque
+from copy import deepcopy
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import Queue
 import fitsio
 import numpy as np
-from scipy.ndimage.morphology import binary_closing
+from scipy.ndimage.morphology import binary_closing,binary_dilation
+from scipy.ndimage.morphology import distance_transform_cdt
+from scipy.ndimage.measurements import label,find_objects
 from astropy.stats import sigma_clip
 from astropy.table import Table
 
 from bokio import *
+from bokstats import nan_array_clip,nan_array_stats,to_nan_array
+from bokstats import nan_clip,nan_stats,nan_mode
+from bokstats import mode_estimators,value_stats,value_stat_fields
+from bokstats import stack_kernels,reject_kernels,kernel_args
+from bokstats import nan_median_cube
 
 def fits_name(f):
 	for sfx in ['','.fz','.gz']:
@@ -20,8 +38,73 @@ def fits_name(f):
 			return f+sfx
 	return f # push failure upstream
 
+# row stride from which strided subsets are read a row at a time, below
+# it reading the bounding box and striding in memory is faster
+_rowReadMinStride = 6
+
+def read_subset(hdu,s):
+	'''Read the subset s (a pair of slices, possibly with negative bounds
+	   and steps) of an image HDU. fitsio ignores the step of a slice, so 
+	   the bounding box of the subset is read and then sliced in memory,
+	   or for large row strides it is read a row at a time so that skipped
+	   rows are never read. Empty subsets give empty arrays. Arrays and 
+	   in-memory HDUs are simply sliced.'''
+	if isinstance(hdu,(np.ndarray,_ChainHDU)) or \
+	     not all([ isinstance(sl,slice) for sl in s ]):
+		return hdu[s]
+	ny,nx = hdu.get_dims()
+	yr,xr = [ xrange(*sl.indices(n)) for sl,n in zip(s,(ny,nx)) ]
+	if len(yr) == 0 or len(xr) == 0:
+		# fitsio can't read an empty box, read a pixel for the type
+		return np.empty((len(yr),len(xr)),dtype=hdu[0:1,0:1].dtype)
+	(y1,y2),(x1,x2) = [ (min(r[0],r[-1]),max(r[0],r[-1])+1) 
+	                       for r in (yr,xr) ]
+	# the subset relative to the bounding box
+	ystep,xstep = [ sl.indices(n)[2] for sl,n in zip(s,(ny,nx)) ]
+	xs = slice(xr[0]-x1,None,xstep)
+	if abs(ystep) < _rowReadMinStride:
+		return hdu[y1:y2,x1:x2][yr[0]-y1::ystep,xs]
+	out = None
+	for i,y in enumerate(yr):
+		row = hdu[y:y+1,x1:x2][0,xs]
+		if out is None:
+			out = np.empty((len(yr),len(row)),dtype=row.dtype)
+		out[i] = row
+	return out
+
+# the engine used by array_clip/array_stats: 'astropy' (sigma_clip on
+# masked arrays) or 'nan' (in-place clipping of NaN-masked float arrays)
+_clip_engines = ['astropy','nan']
+_clip_engine = os.environ.get('BOKPIPE_CLIP_ENGINE','astropy')
+
+def set_clip_engine(engine):
+	global _clip_engine
+	if engine not in _clip_engines:
+		raise ValueError('clip engine %s unrecognized' % engine)
+	_clip_engine = engine
+	# propagate to subprocesses that don't inherit module state
+	os.environ['BOKPIPE_CLIP_ENGINE'] = engine
+
+def get_clip_engine():
+	return _clip_engine
+
+# estimator used by array_stats(method='mode'), see bokstats.nan_mode
+_mode_estimator = os.environ.get('BOKPIPE_MODE_ESTIMATOR','pearson')
+
+def set_mode_estimator(estimator):
+	global _mode_estimator
+	if estimator not in mode_estimators:
+		raise ValueError('mode estimator %s unrecognized' % estimator)
+	_mode_estimator = estimator
+	os.environ['BOKPIPE_MODE_ESTIMATOR'] = estimator
+
+def get_mode_estimator():
+	return _mode_estimator
+
 # just translates the kwargs
 def array_clip(arr,axis=None,**kwargs):
+	if _clip_engine == 'nan':
+		return nan_array_clip(arr,axis=axis,**kwargs)
 	# for some reason in newer version of astropy (>1.1) axis=-1 
 	# no longer works ...
 	if axis is not None and axis < 0:
@@ -36,6 +119,11 @@ def array_clip(arr,axis=None,**kwargs):
 
 def array_stats(arr,axis=None,method='median',clip=True,rms=False,
                 retArray=False,**kwargs):
+	if _clip_engine == 'nan' or \
+	     (method=='mode' and axis is None and _mode_estimator!='pearson'):
+		return nan_array_stats(arr,axis=axis,method=method,clip=clip,
+		                       rms=rms,retArray=retArray,
+		                       mode_estimator=_mode_estimator,**kwargs)
 	if clip:
 		arr = array_clip(arr,axis=axis,**kwargs)
 	if method=='median':
@@ -65,10 +153,130 @@ def array_stats(arr,axis=None,method='median',clip=True,rms=False,
 		rv = rv[0]
 	return rv
 
+# the fields of array_multi_stats taken from the array_stats computations
+_array_stats_fields = ['mean','median','mode','std','rms']
+
+def _squeeze_stat(val):
+	# as array_stats does for axis=None
+	try:
+		val = val.compressed()
+	except:
+		pass
+	return val.squeeze()
+
+def _ma_multi_stats(arr,fields,clip,kwargs):
+	# the astropy engine of array_stats
+	if clip:
+		arr = array_clip(arr,**kwargs)
+	elif not isinstance(arr,np.ma.MaskedArray):
+		arr = np.ma.masked_invalid(arr)
+	v = arr.compressed()
+	if v.dtype.kind == 'f':
+		v = v[np.isfinite(v)]
+	rv = value_stats(v,[ k for k in fields if k not in _array_stats_fields ])
+	if v.size == 0:
+		rv.update({ k:np.nan for k in fields if k in _array_stats_fields })
+		return rv,arr
+	if 'mean' in fields:
+		rv['mean'] = np.ma.mean(arr)
+	if 'median' in fields:
+		rv['median'] = _squeeze_stat(np.ma.median(arr))
+	if 'mode' in fields:
+		rv['mode'] = _squeeze_stat(3*np.ma.median(arr) - 2*np.ma.mean(arr))
+	if 'std' in fields or 'rms' in fields:
+		rv['rms'] = rv['std'] = np.ma.std(arr)
+	return rv,arr
+
+def _nan_multi_stats(arr,fields,clip,kwargs):
+	# the nan engine of array_stats (see bokstats.nan_array_stats)
+	work = to_nan_array(arr)
+	if clip:
+		nan_clip(work,clip_sig=kwargs.pop('clip_sig',2.5),
+		         clip_iters=kwargs.pop('clip_iters',2),
+		         clip_cenfunc=kwargs.pop('clip_cenfunc',np.ma.mean))
+	v = work[np.isfinite(work)]
+	rv = value_stats(v,[ k for k in fields if k not in _array_stats_fields ])
+	methods = [ k for k in ['mean','median','rms'] 
+	              if k in fields or (k != 'rms' and 'mode' in fields) or
+	                 (k == 'rms' and 'std' in fields) ]
+	rv.update(nan_stats(work,methods=methods))
+	if 'mode' in fields:
+		if _mode_estimator == 'pearson':
+			rv['mode'] = 3*rv['median'] - 2*rv['mean']
+		else:
+			rv['mode'] = nan_mode(work,_mode_estimator,mean=rv['mean'])
+	if 'rms' in rv:
+		rv['std'] = rv['rms']
+	return rv,np.ma.masked_array(np.ma.getdata(arr),mask=np.isnan(work))
+
+def array_multi_stats(arr,fields,clip=True,retArray=False,**kwargs):
+	'''Compute several statistics of an array (over all axes), see 
+	   bokstats.value_stats for the fields. The fields are computed from
+	   a single clipping pass, and the mean, median, mode and rms are 
+	   identical to those of array_stats (with rms=True). As in array_stats,
+	   with the astropy engine a mode estimator other than pearson is 
+	   computed by the nan engine, which then takes a second clipping pass.
+	   Returns a dict, and the clipped array if retArray is True.'''
+	if _clip_engine == 'nan':
+		rv,clipped = _nan_multi_stats(arr,fields,clip,dict(kwargs))
+	else:
+		nanMode = 'mode' in fields and _mode_estimator != 'pearson'
+		maFields = [ k for k in fields if not (nanMode and k == 'mode') ]
+		rv,clipped = _ma_multi_stats(arr,maFields,clip,dict(kwargs))
+		if nanMode:
+			rv['mode'] = _nan_multi_stats(arr,['mode'],clip,
+			                              dict(kwargs))[0]['mode']
+	rv = { k:rv[k] for k in fields }
+	if retArray:
+		return rv,clipped
+	return rv
+
 def rebin(im,nbin):
 	s = np.array(im.shape) / nbin
 	return im.reshape(s[0],nbin,s[1],nbin).swapaxes(1,2).reshape(s[0],s[1],-1)
 
+def block_reduce(im,nbin,method='mean',clip=False,maxbad=None,**kwargs):
+	'''Reduce an image by nbin x nbin blocks. Masked and NaN pixels are
+	   ignored, and partial blocks at the upper edges are reduced from the
+	   pixels they contain (the output has ceil(shape/nbin) pixels). The
+	   blocks are optionally sigma clipped (kwargs are passed to 
+	   array_clip), and those with more than maxbad rejected pixels are 
+	   masked. method is 'mean', 'median', 'mode' (3*median-2*mean), or a
+	   function taking a masked array and axis=-1.'''
+	data = np.ma.getdata(im)
+	mask = np.ma.getmaskarray(im)
+	if data.dtype.kind == 'f':
+		mask = mask | np.isnan(data)
+	ny,nx = data.shape
+	py,px = -ny % nbin,-nx % nbin
+	if py > 0 or px > 0:
+		data = np.pad(data,((0,py),(0,px)),'constant')
+		mask = np.pad(mask,((0,py),(0,px)),'constant',constant_values=True)
+	cube = np.ma.masked_array(rebin(data,nbin),mask=rebin(mask,nbin))
+	if clip:
+		cube = array_clip(cube,axis=-1,**kwargs)
+	if maxbad is not None:
+		nbad = np.ma.getmaskarray(cube).sum(axis=-1)
+	if callable(method):
+		rv = method(cube,axis=-1)
+	elif method not in ['mean','median','mode']:
+		raise ValueError('block reduce method %s unrecognized' % method)
+	else:
+		if method != 'median':
+			rv = mean = np.ma.mean(cube,axis=-1)
+		if method != 'mean':
+			# much faster than np.ma.median along an axis
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore',RuntimeWarning)
+				median = np.nanmedian(cube.filled(np.nan),axis=-1)
+			rv = median = np.ma.masked_invalid(median)
+		if method == 'mode':
+			rv = 3*median - 2*mean
+	rv = np.ma.asarray(rv)
+	if maxbad is not None:
+		rv[nbad>maxbad] = np.ma.masked
+	return rv
+
 def magnify(im,nmag):
 	n1,n2 = im.shape
 	return np.tile(im.reshape(n1,1,n2,1),
@@ -99,7 +307,8 @@ def bok_getxy(hdr,coordsys='image',coord=None):
 
 # be careful - these slices can't be applied to read a subregion using fitsio.
 # i.e., fitsio.FITS(f)[extn][slice] will not work (reads to end of image),
-# but fitsio.FITS(f)[extn].read()[slice] will
+# but fitsio.FITS(f)[extn].read()[slice] will. Use stats_region_bounds or
+# read_stats_region to read only the region.
 def stats_region(statreg,stride=None):
 	if statreg is None:
 		return np.s_[::stride,::stride]
@@ -124,6 +333,17 @@ def stats_region(statreg,stride=None):
 		raise ValueError
 	return np.s_[y1:y2:stride,x1:x2:stride]
 
+def stats_region_bounds(statreg,shape,stride=None):
+	'''stats_region resolved to slices with absolute bounds for an image
+	   of the given shape (ny,nx)'''
+	return tuple([ slice(*sl.indices(n)) 
+	                 for sl,n in zip(stats_region(statreg,stride),shape) ])
+
+def read_stats_region(hdu,statreg,stride=None):
+	'''read the pixels of a stats region (see stats_region) from an image
+	   HDU without reading the full image'''
+	return read_image(hdu,stats_region_bounds(statreg,hdu.get_dims(),stride))
+
 def _write_stack_header_cards(fileList,cardPrefix):
 	hdr = fitsio.read_header(fileList[0])
 	for num,f in enumerate(fileList,start=1):
@@ -194,10 +414,20 @@ def ccd_split(ccdIm,ccdNum,origin='center'):
 	im3 = np.rot90(np.fliplr(im3),-1)
 	return [im1,im2,im3,im4]
 
+def ccd_join_buffer(ampShape,ccdNum,dtype=np.float32,origin='center'):
+	'''Preallocate a CCD image for amplifiers of shape ampShape. Returns 
+	   the image and the views into it of the 4 amplifiers in their 
+	   original orientation (see ccd_split), so that filling the views is 
+	   equivalent to ccd_join without the intermediate copies.'''
+	ny,nx = ampShape
+	ccdIm = np.empty((2*nx,2*ny),dtype=dtype)
+	return ccdIm,ccd_split(ccdIm,ccdNum,origin=origin)
+
 def build_cube(fileList,extn,masks=None,rows=None,badKey=None,
                maskType='gtzero'):
 	s = rows2slice(rows)
-	cube = np.dstack( [ fitsio.FITS(f)[extn][s] for f in fileList ] )
+	cube = np.dstack( [ read_image(fitsio.FITS(f)[extn],s) 
+	                      for f in fileList ] )
 	_masks = []
 	if masks is not None:
 		if isinstance(masks,FileNameMap):
@@ -206,7 +436,7 @@ def build_cube(fileList,extn,masks=None,rows=None,badKey=None,
 			maskFiles = masks
 		for f in maskFiles:
 			hdu = fitsio.FITS(f)[extn]
-			_masks.append(load_mask(hdu[s],maskType))
+			_masks.append(load_mask(read_image(hdu,s),maskType))
 			# hacky to put this special case here...
 			if badKey is not None:
 				hdr = hdu.read_header()
@@ -218,6 +448,129 @@ def build_cube(fileList,extn,masks=None,rows=None,badKey=None,
 	cube = np.ma.masked_array(cube,mask)
 	return cube
 
+class CubeBandReader(object):
+	'''Streams row bands of a set of MEF files (and optionally their masks
+	   and weights) into preallocated float32 cube buffers, ordered as
+	   (rows,cols,files) like build_cube. Each input is opened once. With
+	   nbuf=2 the next band is read in a background thread while the
+	   current one is being combined.'''
+	def __init__(self,inputFiles,masks=None,weights=None,badKey=None,
+	             maskType='gtzero',nbuf=2):
+		self.nFiles = len(inputFiles)
+		self.badKey = badKey
+		self.maskType = maskType
+		self.nBuf = nbuf
+		self.fits = [ fitsio.FITS(f) for f in inputFiles ]
+		self.maskFits = self._open(masks)
+		self.weightFits = self._open(weights)
+		self.withMask = self.maskFits is not None
+		self.withWeights = self.weightFits is not None
+		self._shapes = {}
+		self._headers = {}
+	def _open(self,files):
+		if files is None:
+			return None
+		return [ fitsio.FITS(f) if isinstance(f,basestring) else f
+		           for f in files ]
+	def get_shape(self,extn):
+		if extn not in self._shapes:
+			hdr = self.fits[0][extn].read_header()
+			self._shapes[extn] = (int(hdr['NAXIS2']),int(hdr['NAXIS1']))
+		return self._shapes[extn]
+	def bytes_per_pixel(self):
+		'''bytes per (pixel,file) held in a single band buffer'''
+		nbytes = np.dtype(np.float32).itemsize
+		if self.withMask:
+			nbytes += 1
+		if self.withWeights:
+			nbytes += np.dtype(np.float32).itemsize
+		return nbytes
+	def _alloc(self,nrows,ncols):
+		shape = (nrows,ncols,self.nFiles)
+		buf = { 'im':np.empty(shape,dtype=np.float32) }
+		if self.withMask:
+			buf['mask'] = np.empty(shape,dtype=np.bool)
+		if self.withWeights:
+			buf['wt'] = np.empty(shape,dtype=np.float32)
+		return buf
+	def _read_band(self,fits,extn,rows):
+		hdu = fits[extn]
+		if isinstance(hdu,np.ndarray):
+			return hdu[rows[0]:rows[1],:]
+		# the headers are only needed for restoring BLANKs, read them once
+		k = (id(fits),extn)
+		if k not in self._headers:
+			self._headers[k] = hdu.read_header()
+		return read_image(hdu,np.s_[rows[0]:rows[1],:],self._headers[k])
+	def _fill(self,buf,extn,rows):
+		r1,r2 = rows
+		im = buf['im'][:r2-r1]
+		for i,fits in enumerate(self.fits):
+			im[:,:,i] = self._read_band(fits,extn,rows)
+		if self.withMask:
+			msk = buf['mask'][:r2-r1]
+			for i,fits in enumerate(self.maskFits):
+				hdu = fits[extn]
+				msk[:,:,i] = load_mask(self._read_band(fits,extn,rows),
+				                       self.maskType)
+				# hacky to put this special case here...
+				if self.badKey is not None and \
+				     isinstance(fits,fitsio.FITS) and \
+				       self.badKey in hdu.read_header():
+					msk[:,:,i] = True
+		if self.withWeights:
+			wt = buf['wt'][:r2-r1]
+			for i,fits in enumerate(self.weightFits):
+				wt[:,:,i] = self._read_band(fits,extn,rows)
+	def _reader(self,bands,freeq,readyq):
+		try:
+			for extn,rows in bands:
+				bufnum = freeq.get()
+				if bufnum is None:
+					# consumer stopped early
+					return
+				self._fill(self.bufs[bufnum],extn,rows)
+				readyq.put((bufnum,None))
+		except Exception,e:
+			readyq.put((None,e))
+	def iter_bands(self,bands):
+		'''bands is a list of (extn,(row1,row2)). Yields
+		   (extn,rows,cube,mask,weights) where cube is a masked array view
+		   of the band buffer, valid only until the next band is requested.'''
+		nrows = max([ r2-r1 for extn,(r1,r2) in bands ])
+		ncols = max([ self.get_shape(extn)[1] for extn in
+		                set([extn for extn,rows in bands]) ])
+		self.bufs = [ self._alloc(nrows,ncols)
+		                for i in range(min(self.nBuf,len(bands))) ]
+		freeq = Queue.Queue()
+		readyq = Queue.Queue()
+		for i in range(len(self.bufs)):
+			freeq.put(i)
+		reader = threading.Thread(target=self._reader,
+		                          args=(bands,freeq,readyq))
+		reader.daemon = True
+		reader.start()
+		try:
+			for extn,rows in bands:
+				bufnum,err = readyq.get()
+				if err is not None:
+					raise err
+				buf = self.bufs[bufnum]
+				n1,n2 = rows[1]-rows[0],self.get_shape(extn)[1]
+				mask = buf['mask'][:n1,:n2] if self.withMask else None
+				cube = np.ma.masked_array(buf['im'][:n1,:n2],mask=mask)
+				w = buf['wt'][:n1,:n2] if self.withWeights else None
+				yield extn,rows,cube,mask,w
+				freeq.put(bufnum)
+		finally:
+			freeq.put(None)
+			reader.join()
+			self.bufs = None
+	def close(self):
+		for fitsList in [self.fits,self.maskFits,self.weightFits]:
+			for fits in (fitsList or []):
+				fits.close()
+
 class OutputExistsError(Exception):
 	def __init__(self,value):
 		self.value = value
@@ -255,11 +608,155 @@ class TimerLog():
 			print '%20s %8.3f %8.3f %8.3f' % t
 		print
 
+def _timed_task(func,arg):
+	i,item = arg
+	t0 = time()
+	rv = func(item)
+	return i,rv,time()-t0
+
+def _task_key(func):
+	# name the task by the underlying function, so that timings carry
+	# over between calls with different bound objects or partial args
+	while isinstance(func,partial):
+		func = func.func
+	if isinstance(func,_ResidentTask):
+		return '%s.%s' % (func.className,func.method)
+	try:
+		return '%s.%s' % (func.im_class.__name__,func.__name__)
+	except AttributeError:
+		return getattr(func,'__name__',repr(func))
+
+def _item_key(item):
+	if isinstance(item,(list,tuple)):
+		item = tuple(item)
+	try:
+		hash(item)
+	except TypeError:
+		return None
+	return item
+
+class AdaptiveProcMap(object):
+	'''A drop-in replacement for multiprocessing.Pool.map that keeps one
+	   pool of workers for the life of the object and hands out tasks
+	   dynamically (imap_unordered), so that a slow task only holds up
+	   its own worker. Chunk sizes are set from the observed time per
+	   task of each function, aiming for chunks of target_time seconds
+	   while leaving several chunks per worker. Tasks are dispatched
+	   longest-first, using the cost hint if given or otherwise the time
+	   the same item took in previous calls (e.g., the previous step).'''
+	def __init__(self,processes,**kwargs):
+		self.processes = processes
+		self.pool = multiprocessing.Pool(processes)
+		self.targetTime = kwargs.get('target_time',1.0)
+		self.maxChunk = kwargs.get('max_chunk',16)
+		self.cost = kwargs.get('cost')
+		self.verbose = kwargs.get('verbose',0)
+		self.taskTime = {}
+		self.itemTime = {}
+		self.log = []
+	def chunksize(self,func,nitems):
+		t = self.taskTime.get(_task_key(func))
+		if t is None:
+			# first call, measure
+			return 1
+		chunk = int(self.targetTime / max(t,1e-3))
+		# keep enough chunks per worker to balance the load
+		chunk = min(chunk,self.maxChunk,nitems//(4*self.processes))
+		return max(1,chunk)
+	def _order(self,items,cost):
+		if cost is None:
+			cost = lambda item: self.itemTime.get(_item_key(item),0)
+		costs = [ cost(item) for item in items ]
+		# stable, so items without a cost keep their order
+		return sorted(range(len(items)),key=lambda i: -costs[i])
+	def __call__(self,func,items,cost=None):
+		items = list(items)
+		if len(items) == 0:
+			return []
+		if cost is None:
+			cost = self.cost
+		key = _task_key(func)
+		chunk = self.chunksize(func,len(items))
+		tasks = [ (i,items[i]) for i in self._order(items,cost) ]
+		rv = [None] * len(items)
+		dt = np.zeros(len(items))
+		t0 = time()
+		for i,res,t in self.pool.imap_unordered(partial(_timed_task,func),
+		                                        tasks,chunksize=chunk):
+			rv[i] = res
+			dt[i] = t
+		wall = time() - t0
+		for item,t in zip(items,dt):
+			k = _item_key(item)
+			if k is not None:
+				self.itemTime[k] = t
+		# use the median so that a few slow frames don't inflate the chunks
+		self.taskTime[key] = np.median(dt)
+		self.log.append((key,len(items),chunk,wall,dt.sum(),dt.max()))
+		if self.verbose > 0:
+			print '%s: %d tasks chunksize %d wall %.2fs ' \
+			      'busy %.0f%% max %.2fs' % (key,len(items),chunk,wall,
+			        100*dt.sum()/max(wall*self.processes,1e-6),dt.max())
+		return rv
+	def map(self,func,items,chunksize=None):
+		return self(func,items)
+	def dump(self):
+		print '%30s %6s %6s %8s %8s %8s' % ('task','ntask','chunk','wall',
+		                                     'busy','max')
+		for key,n,chunk,wall,busy,tmax in self.log:
+			print '%30s %6d %6d %8.2f %7.0f%% %8.2f' % \
+			        (key[-30:],n,chunk,wall,
+			         100*busy/max(wall*self.processes,1e-6),tmax)
+		print
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+	def terminate(self):
+		self.pool.terminate()
+
+def _close_window(mask,niter):
+	# pad with the zero border that binary_closing uses outside the array
+	m = np.pad(mask,1,'constant')
+	# niter dilations (erosions) by the cross structure are equivalent to
+	# a taxicab distance to the nearest masked (unmasked) pixel <= niter
+	dilated = distance_transform_cdt(~m,metric='taxicab') <= niter
+	dilated[[0,-1],:] = False
+	dilated[:,[0,-1]] = False
+	closed = distance_transform_cdt(dilated,metric='taxicab') > niter
+	return closed[1:-1,1:-1]
+
+def closed_mask(mask,niter=20):
+	'''Same result as binary_closing(mask,iterations=niter), but computed
+	   from distance transforms over windows around the masked regions.
+	   The closing only adds pixels within niter of the mask, and those 
+	   only depend on the mask within 3*niter, so the regions are grouped
+	   on a coarse grid of niter-sized cells padded by three cells. When
+	   the windows cover most of the array (e.g., many scattered hot
+	   pixels) the full-array closing is faster.'''
+	closed = np.zeros(mask.shape,dtype=bool)
+	if not mask.any():
+		return closed
+	ny,nx = mask.shape
+	n = niter
+	cells = np.zeros((-(-ny//n)*n,-(-nx//n)*n),dtype=bool)
+	cells[:ny,:nx] = mask
+	cells = cells.reshape(cells.shape[0]//n,n,-1,n).any(axis=3).any(axis=1)
+	cells = binary_dilation(cells,np.ones((3,3)),iterations=3)
+	windows = [ (slice(sy.start*n,min(sy.stop*n,ny)),
+	             slice(sx.start*n,min(sx.stop*n,nx)))
+	              for sy,sx in find_objects(label(cells)[0]) ]
+	if sum([ (sy.stop-sy.start)*(sx.stop-sx.start)
+	           for sy,sx in windows ]) > mask.size//2:
+		return binary_closing(mask,iterations=niter)
+	for win in windows:
+		closed[win] |= _close_window(mask[win],niter)
+	return closed
+
 def mask_saturation(extName,data,correct_inverted=True):
 	satVal = {'IM5':55000,'IM7':55000}.get(extName,62000)
 	mask = data > satVal
 	if correct_inverted:
-		filledmask = binary_closing(mask,iterations=20)
+		filledmask = closed_mask(mask,20)
 		data[filledmask&~mask] = 65535
 		mask = filledmask
 	return data,mask
@@ -278,11 +775,156 @@ def load_mask(maskIm,maskType):
 	else:
 		raise ValueError
 
+_fitsioWriteArgs = inspect.getargspec(fitsio.FITS.write).args
+
+def tile_compress_args(compress,tile_dims=None,qlevel=None,qmethod=None):
+	'''Keyword arguments for fitsio to write tile-compressed image HDUs,
+	   compress is 'rice', 'hcompress', 'gzip', or None for no compression.
+	   Floating point images are quantized with the cfitsio defaults, which
+	   are also fpack's (noise/4 with subtractive dithering), qlevel and
+	   qmethod can only override them with fitsio versions that take them.'''
+	if compress is None:
+		return {}
+	fitsio.fitslib.get_compress_type(compress) # raises on unknown types
+	args = {'compress':compress}
+	if tile_dims is not None:
+		args['tile_dims'] = tile_dims
+	for k,v in [('qlevel',qlevel),('qmethod',qmethod)]:
+		if v is not None:
+			if k not in _fitsioWriteArgs:
+				raise ValueError('fitsio %s does not support %s' % 
+				                 (fitsio.__version__,k))
+			args[k] = v
+	return args
+
+# storage types for floating point products. int16 stores the values 
+# scaled (BSCALE/BZERO) with a step of noise/quant_level chosen per HDU, 
+# like fpack's quantization of floats. float16 is not offered: it has no
+# FITS BITPIX, and its 11-bit mantissa gives steps of 32 ADU at 50000 ADU,
+# well above the noise of the background at those levels.
+storage_types = ['float32','int16']
+_int16Blank = -32768
+
+def check_storage_type(storage):
+	if storage not in storage_types:
+		if storage == 'float16':
+			raise ValueError('float16 is not a FITS data type, use int16')
+		raise ValueError('storage must be one of %s' % storage_types)
+	return storage
+
+def estimate_noise(data,stride=4):
+	'''robust pixel noise from the differences of neighbouring pixels in
+	   every stride-th row, insensitive to gradients and sources'''
+	d = np.diff(data[::stride],axis=-1).ravel()
+	d = d[np.isfinite(d)]
+	if d.size == 0:
+		return 0.
+	return 1.4826 * np.median(np.abs(d-np.median(d))) / np.sqrt(2)
+
+def quantize_image(data,quant_level=4.):
+	'''Scale a float image to int16 with a step of noise/quant_level, 
+	   widened if needed so that the full range of values fits. Non-finite 
+	   values go to BLANK. Returns (qdata,bscale,bzero,noise).'''
+	data = np.ma.getdata(data)
+	good = np.isfinite(data)
+	allGood = good.all()
+	vals = data if allGood else data[good]
+	noise = estimate_noise(data)
+	if vals.size == 0:
+		return np.full(data.shape,_int16Blank,np.int16),1.,0.,noise
+	vmin,vmax = float(vals.min()),float(vals.max())
+	# the step is kept well above the float32 resolution of the values, so
+	# that the codes (and BLANK) are recovered from the scaled values that
+	# fitsio returns (see restore_blanks)
+	bscale = max(noise/quant_level,(vmax-vmin)/65534.,
+	             max(abs(vmin),abs(vmax))*2**-20)
+	if bscale == 0:
+		bscale = 1.0 # constant image
+	bzero = 0.5*(vmin+vmax)
+	qdata = np.subtract(data,bzero,dtype=np.float64)
+	qdata /= bscale
+	np.rint(qdata,out=qdata)
+	np.clip(qdata,-32767,32767,out=qdata)
+	if not allGood:
+		qdata[~good] = _int16Blank
+	return qdata.astype(np.int16),bscale,bzero,noise
+
+def quantize_hdu(data,header,quant_level=4.):
+	'''int16 data and header cards for storing an HDU quantized'''
+	qdata,bscale,bzero,noise = quantize_image(data,quant_level)
+	header = _copy_header(header) if header is not None else {}
+	header['BSCALE'] = bscale
+	header['BZERO'] = bzero
+	header['BLANK'] = _int16Blank
+	header['QNOISE'] = float(noise)
+	header['QLEVEL'] = float(quant_level)
+	header['QNBLANK'] = int(np.sum(qdata==_int16Blank))
+	return qdata,header
+
+def strip_quantization(header):
+	'''remove the scaling keywords of a (quantized) integer HDU'''
+	for k in ['BZERO','BSCALE','BLANK','QNOISE','QLEVEL','QNBLANK']:
+		header.delete(k)
+	return header
+
+def _is_quantized(fileName):
+	try:
+		return 'QLEVEL' in fitsio.read_header(fits_name(fileName),1)
+	except (IOError,ValueError):
+		return False
+
+def restore_blanks(data,hdr):
+	'''set the BLANK pixels of a quantized HDU (read as floats) to NaN'''
+	if hdr is not None and hdr.get('QNBLANK',0) > 0:
+		# fitsio does not always keep the BLANK card
+		blank = hdr['BLANK'] if 'BLANK' in hdr else _int16Blank
+		# BLANK is the one code below the clipped range of quantize_image,
+		# so compare the codes halfway between it and the lowest valid one
+		data[data < (blank+0.5)*hdr['BSCALE']+hdr['BZERO']] = np.nan
+	return data
+
+def read_image(hdu,subset=None,header=None):
+	'''Read an image HDU, or the subset of it (see read_subset), with the
+	   BLANK pixels of quantized HDUs set to NaN. All readers of pipeline
+	   products should go through here. header is read from the HDU if not
+	   given; arrays (e.g., FakeFITS data) are simply sliced.'''
+	if isinstance(hdu,np.ndarray):
+		return hdu if subset is None else hdu[subset]
+	if subset is None:
+		data = hdu.read()
+	else:
+		data = read_subset(hdu,subset)
+	if header is None:
+		header = hdu.read_header()
+	return restore_blanks(data,header)
+
+def quantization_report(data,quant_level=4.):
+	'''worst-case and rms error of int16 storage relative to the noise'''
+	data = np.ma.getdata(data).astype(np.float32)
+	qdata,bscale,bzero,noise = quantize_image(data,quant_level)
+	restored = (qdata*bscale+bzero).astype(np.float32)
+	good = np.isfinite(data)
+	err = (restored-data)[good]
+	noise = noise if noise > 0 else np.nan
+	return dict(noise=noise,bscale=bscale,bzero=bzero,
+	            maxerr=np.abs(err).max()/noise if err.size else 0.,
+	            rmserr=err.std()/noise if err.size else 0.,
+	            stepnoise=bscale/noise,
+	            nclip=int(np.sum(np.abs(qdata[good])==32767)),
+	            nblank=int(np.sum(~good)))
+
+# number of pixels in the bands of rows read by make_fov_image
+_fovBandPix = 2**20
+
 class BokMefImage(object):
 	'''A wrapper around fitsio that allows the MEF files to be iterated
 	   over while updating the data arrays and headers either in-place or
 	   to a new file. Also allows for an arbitrary number of masks to be
-	   carried with the data.'''
+	   carried with the data. With tile_compress the output HDUs are 
+	   tile-compressed as they are written, and with storage='int16' 
+	   float data is stored quantized (see quantize_image). In-place 
+	   updates then go to a temporary file that replaces the input on 
+	   close.'''
 	def __init__(self,fileName,**kwargs):
 		self.fileName = fileName
 		self.outFileName = kwargs.get('output_file')
@@ -295,11 +937,29 @@ class BokMefImage(object):
 		maskType = kwargs.get('mask_type','gtzero')
 		headerCards = kwargs.get('add_header',{})
 		self.headerFixes = kwargs.get('header_fixes',[])
+		self.compressArgs = tile_compress_args(kwargs.get('tile_compress'),
+		                                       kwargs.get('tile_dims'),
+		                                       kwargs.get('qlevel'),
+		                                       kwargs.get('qmethod'))
+		self.storage = check_storage_type(kwargs.get('storage','float32'))
+		self.quantLevel = kwargs.get('quant_level',4.)
+		# (stats_region,stride) to only read that region of each HDU
+		self.readRegion = kwargs.get('read_region')
+		if self.readRegion is not None and not self.readOnly:
+			raise ValueError('read_region requires read_only')
 		self.closeFiles = []
+		self.tmpOutFile = None
 		if self.readOnly:
-			self.fits = fitsio.FITS(self.fileName)
+			self.fits = fitsio.FITS(fits_name(self.fileName))
+			self.closeFiles.append(self.fits)
 		else:
-			if self.outFileName == self.fileName:
+			if self.outFileName == self.fileName and \
+			     ( self.compressArgs or self.storage != 'float32' or
+			       _is_quantized(self.fileName) ):
+				# compressed or rescaled HDUs can't be rewritten in place
+				self._check_header_key(self.fileName)
+				self.tmpOutFile = '%s.tmp%d' % (self.outFileName,os.getpid())
+			if self.outFileName == self.fileName and self.tmpOutFile is None:
 				self._check_header_key(self.fileName)
 				self.outFits = self.fits = fitsio.FITS(self.fileName,'rw')
 				self.closeFiles.append(self.fits)
@@ -311,16 +971,20 @@ class BokMefImage(object):
 				if self.headerKey is not None:
 					self.outFits[0].write_key(self.headerKey,get_timestamp())
 			else:
-				if os.path.exists(self.outFileName):
+				if self.tmpOutFile is not None:
+					outFileName = self.tmpOutFile
+				else:
+					outFileName = self.outFileName
+				if os.path.exists(outFileName):
 					# first see if the output file has already generated
-					if not self.clobber:
+					if not self.clobber and self.tmpOutFile is None:
 						self._check_header_key(self.outFileName)
 					# can't seem to overwrite extension 0 with fitsio, so
 					# for now just deleting the existing file
-					os.unlink(self.outFileName)
+					os.unlink(outFileName)
 				self.clobberHdus = False
-				self.fits = fitsio.FITS(self.fileName)
-				self.outFits = fitsio.FITS(self.outFileName,'rw')
+				self.fits = fitsio.FITS(fits_name(self.fileName))
+				self.outFits = fitsio.FITS(outFileName,'rw')
 				self.closeFiles.extend([self.fits,self.outFits])
 				if self.keepHeaders:
 					hdr = self.fits[0].read_header()
@@ -335,6 +999,12 @@ class BokMefImage(object):
 				if self.headerKey is not None:
 					hdr[self.headerKey] = get_timestamp()
 				self.outFits.write(None,header=hdr)
+		self._init_masks(maskFits,maskType)
+		if self.extensions is None:
+			self.extensions = [ h.get_extname().upper() 
+			                     for h in self.fits[1:] ]
+		self.curExtName = None
+	def _init_masks(self,maskFits,maskType):
 		self.masks = []
 		self.maskTypes = []
 		if maskFits is not None:
@@ -342,14 +1012,10 @@ class BokMefImage(object):
 				m = maskFits
 			else:
 				try:
-					m = maskFits(fileName)
+					m = maskFits(self.fileName)
 				except:
 					m = FakeFITS(maskFits)
 			self.add_mask(m,maskType)
-		if self.extensions is None:
-			self.extensions = [ h.get_extname().upper() 
-			                     for h in self.fits[1:] ]
-		self.curExtName = None
 	def _check_header_key(self,fileName):
 		if self.headerKey is not None:
 			hdr0 = fitsio.read_header(fileName,0)
@@ -364,79 +1030,110 @@ class BokMefImage(object):
 		#	return ValueError
 		self.masks.append(maskFits)
 		self.maskTypes.append(maskType)
-	def update(self,data,header=None,noconvert=False):
+	def update(self,data,header=None,noconvert=False,extName=None):
 		if self.readOnly:
 			return
+		if extName is None:
+			extName = self.curExtName
 		if not noconvert:
 			# should probably instead track down all the upcasts
 			data = data.astype(np.float32)
 		# apply any header fixes
 		if header is not None:
 			for extNum,hdrfix in self.headerFixes:
-				if extNum == self.curExtName:
+				if extNum == extName:
 					for k,v in hdrfix.items():
 						header[k] = v
-			# NOAO archive adds these keywords
-			header.delete('BZERO')
-			header.delete('BSCALE')
+			# NOAO archive adds BZERO/BSCALE, and quantized inputs
+			strip_quantization(header)
+		self._write_hdu(extName,data,header)
+	def _write_hdu(self,extName,data,header):
+		if self.storage == 'int16' and data.dtype.kind == 'f':
+			data,header = quantize_hdu(data,header,self.quantLevel)
 		# I thought this was overwriting existing HDUs, but doesn't seem to..
 		#self.outFits.write(data,extname=self.curExtName,header=header,
 		#                   clobber=self.clobberHdus)
 		if self.clobberHdus:
-			self.outFits[self.curExtName].write(data)
-			self.outFits[self.curExtName].write_keys(header)
+			self.outFits[extName].write(data)
+			self.outFits[extName].write_keys(header)
 		else:
-			self.outFits.write(data,extname=self.curExtName,header=header,
-			                   clobber=False)
+			self.outFits.write(data,extname=extName,header=header,
+			                   clobber=False,**self.compressArgs)
 	def _load_masks(self,extName,subset):
 		if subset is None:
 			subset = np.s_[:,:]
-		mask = load_mask(self.masks[0][extName][subset],self.maskTypes[0])
+		mask = load_mask(read_image(self.masks[0][extName],subset),
+		                 self.maskTypes[0])
 		for m,mtyp in zip(self.masks[1:],self.maskTypes[1:]):
-			mask |= load_mask(m[extName][subset],mtyp)
+			mask |= load_mask(read_image(m[extName],subset),mtyp)
 		return mask
+	def _read_hdu(self,extName):
+		if self.readRegion is not None:
+			return self.get(extName,self.region_bounds(extName,
+			                                           *self.readRegion),
+			                header=True)
+		hdr = self.fits[extName].read_header()
+		data = read_image(self.fits[extName],header=hdr)
+		if len(self.masks) > 0:
+			mask = self._load_masks(extName,None)
+			data = np.ma.masked_array(data,mask=mask)
+		return data,hdr
 	def __iter__(self):
 		for self.curExtName in self.extensions:
-			data = self.fits[self.curExtName].read()
-			hdr = self.fits[self.curExtName].read_header()
-			if len(self.masks) > 0:
-				mask = self._load_masks(self.curExtName,None)
-				data = np.ma.masked_array(data,mask=mask)
+			data,hdr = self._read_hdu(self.curExtName)
 			yield self.curExtName,data,hdr
 	def get(self,extName,subset=None,header=False):
 		if subset is None:
 			subset = np.s_[:,:]
-		data = self.fits[extName][subset]
+		hdr = self.fits[extName].read_header()
+		data = read_image(self.fits[extName],subset,hdr)
 		if len(self.masks) > 0:
 			mask = self._load_masks(extName,subset)
 			data = np.ma.masked_array(data,mask=mask)
 		if header:
-			return data,self.fits[extName].read_header()
+			return data,hdr
 		else:
 			return data
 	def get_header(self,extName):
 		return self.fits[extName].read_header()
+	def region_bounds(self,extName,statreg,stride=None):
+		'''a stats region resolved to absolute bounds for this HDU, to be
+		   used as a subset with get()'''
+		return stats_region_bounds(statreg,self.fits[extName].get_dims(),
+		                           stride)
 	def get_xy(self,extName,coordsys='image'):
 		hdr = self.fits[extName].read_header()
 		return bok_getxy(hdr,coordsys)
 	def make_fov_image(self,nbin=1,coordsys='sky',
 	                   binfunc=None,binclip=False,single=False,mingood=0):
+		'''binned images of each HDU with their coordinates. The HDUs are
+		   read in bands of rows that are reduced with block_reduce (using
+		   binfunc, default mean), with the blocks optionally clipped and
+		   masked when more than mingood pixels are rejected.'''
 		rv = OrderedDict()
 		hdr0 = self.fits[0].read_header()
-		for extName,im,hdr in self:
-			x,y = bok_getxy(hdr,coordsys)
+		if binfunc is None:
+			binfunc = 'mean'
+		for extName in self.extensions:
+			hdr = self.get_header(extName)
 			if nbin > 1:
-				im = rebin(im,nbin)
-				if binclip:
-					im = array_clip(im,axis=-1)
-				if mingood > 0:
-					nbad = im.mask.sum(axis=-1)
-				if binfunc is not None:
-					im = binfunc(im,axis=-1)
-				if mingood > 0:
-					im[nbad>mingood] = np.ma.masked
-				x = x[nbin//2::nbin,nbin//2::nbin]
-				y = y[nbin//2::nbin,nbin//2::nbin]
+				ny,nx = self.fits[extName].get_dims()
+				nrows = max(1,_fovBandPix//(nbin*nx)) * nbin
+				bands = [ np.s_[y1:min(y1+nrows,ny),:]
+				            for y1 in range(0,ny,nrows) ]
+				im = np.ma.concatenate([ 
+				        block_reduce(self.get(extName,band),nbin,binfunc,
+				                     clip=binclip,
+				                     maxbad=mingood if mingood > 0 else None)
+				          for band in bands ])
+				# block centers, including partial blocks at the edges
+				ctr = lambda n: [ i + (min(i+nbin,n)-i)//2 
+				                    for i in range(0,n,nbin) ]
+				x,y = np.meshgrid(ctr(nx),ctr(ny))
+				x,y = bok_getxy(hdr,coordsys,coord=(x,y))
+			else:
+				im = self.get(extName)
+				x,y = bok_getxy(hdr,coordsys)
 			rv[extName] = {'x':x,'y':y,'im':im}
 		if single:
 			_rv = {}
@@ -455,6 +1152,139 @@ class BokMefImage(object):
 	def close(self):
 		for fits in self.closeFiles:
 			fits.close()
+		if self.tmpOutFile is not None:
+			os.rename(self.tmpOutFile,self.outFileName)
+			self.tmpOutFile = None
+	def abort(self):
+		'''close the files after a failure, an in-place update through a 
+		   temporary file leaves the input untouched'''
+		for fits in self.closeFiles:
+			try:
+				fits.close()
+			except Exception:
+				pass
+		if self.tmpOutFile is not None:
+			if os.path.exists(self.tmpOutFile):
+				os.unlink(self.tmpOutFile)
+			self.tmpOutFile = None
+
+class PipelinedMefImage(BokMefImage):
+	'''A BokMefImage that overlaps I/O with computation: a reader thread
+	   prefetches the upcoming HDUs (with masks) while the current one is
+	   processed, and a writer thread flushes the updated HDUs. The queues
+	   are bounded so that the HDUs in flight fit within max_io_mem MB. 
+	   All output is flushed when the iteration finishes, before any
+	   _postprocess step sees the file.'''
+	def __init__(self,fileName,**kwargs):
+		super(PipelinedMefImage,self).__init__(fileName,**kwargs)
+		self.maxIoMem = kwargs.get('max_io_mem',512) * 1024**2
+		# in-place updates share a single fitsio handle between threads
+		if self.fits is getattr(self,'outFits',None):
+			self.ioLock = threading.Lock()
+		else:
+			self.ioLock = None
+		self.writer = None
+		self.writeErr = None
+	def _locked(self,fun,*args):
+		if self.ioLock is None:
+			return fun(*args)
+		with self.ioLock:
+			return fun(*args)
+	def _queue_depth(self):
+		# size HDUs from the first header, counting masks and float32 copies
+		hdr = self.fits[self.extensions[0]].read_header()
+		npix = hdr['NAXIS1'] * hdr['NAXIS2']
+		nbytes = npix * (abs(hdr['BITPIX'])//8 + len(self.masks) + 4)
+		return int(max(1,min(len(self.extensions),
+		                     self.maxIoMem // max(1,2*nbytes))))
+	def _reader(self,readq):
+		try:
+			for extName in self.extensions:
+				if self.stopReading:
+					break
+				data,hdr = self._locked(self._read_hdu,extName)
+				readq.put((extName,data,hdr))
+		except Exception,e:
+			readq.put(e)
+	def _writer_loop(self,writeq):
+		while True:
+			item = writeq.get()
+			if item is None:
+				writeq.task_done()
+				break
+			try:
+				if self.writeErr is None:
+					self._locked(super(PipelinedMefImage,self)._write_hdu,
+					             *item)
+			except Exception,e:
+				self.writeErr = e
+			writeq.task_done()
+	def _write_hdu(self,extName,data,header):
+		if self.writeErr is not None:
+			raise self.writeErr
+		if self.writer is None:
+			self.writeq = Queue.Queue(self.nbuf)
+			self.writer = threading.Thread(target=self._writer_loop,
+			                               args=(self.writeq,))
+			self.writer.daemon = True
+			self.writer.start()
+		self.writeq.put((extName,data,header))
+	def _stop_writer(self):
+		if self.writer is not None:
+			self.writeq.put(None)
+			self.writer.join()
+			self.writer = None
+	def flush(self):
+		'''wait for the writer to finish all pending HDUs'''
+		self._stop_writer()
+		if self.writeErr is not None:
+			raise self.writeErr
+	def __iter__(self):
+		self.nbuf = self._queue_depth()
+		self.stopReading = False
+		readq = Queue.Queue(self.nbuf)
+		reader = threading.Thread(target=self._reader,args=(readq,))
+		reader.daemon = True
+		reader.start()
+		try:
+			for i in range(len(self.extensions)):
+				item = readq.get()
+				if isinstance(item,Exception):
+					raise item
+				self.curExtName,data,hdr = item
+				yield self.curExtName,data,hdr
+		finally:
+			# if processing stopped early, unblock the reader so it can exit
+			self.stopReading = True
+			while reader.is_alive():
+				try:
+					readq.get(timeout=0.1)
+				except Queue.Empty:
+					pass
+			reader.join()
+			self._stop_writer()
+		self.flush()
+	def close(self):
+		self.flush()
+		super(PipelinedMefImage,self).close()
+	def abort(self):
+		self._stop_writer()
+		super(PipelinedMefImage,self).abort()
+
+def prefetch_file(fileName,blockSize=8*1024**2):
+	'''read through a file in a background thread to pull it into the
+	   page cache ahead of use'''
+	def _read():
+		try:
+			with open(fits_name(fileName),'rb') as f:
+				while f.read(blockSize):
+					pass
+		except IOError:
+			pass
+	t = threading.Thread(target=_read)
+	t.daemon = True
+	t.start()
+	return t
 
 # make the instance methods pickleable using code from 
 # https://gist.github.com/bnyeggen/1086393
@@ -481,6 +1311,80 @@ def _unpickle_method(func_name, obj, cls):
 import copy_reg
 copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
+# worker-resident process objects: with multiprocessing, the process object
+# is written once to a pickle file and loaded by each worker on its first
+# task, instead of being pickled along with every task
+
+_residentWorkers = os.environ.get('BOKPIPE_RESIDENT','0') == '1'
+_residentProcs = {}
+
+def set_resident_workers(resident=True):
+	global _residentWorkers
+	_residentWorkers = resident
+	os.environ['BOKPIPE_RESIDENT'] = '1' if resident else '0'
+
+# pipelined I/O: HDUs are prefetched and written in background threads
+# (see PipelinedMefImage), with max_io_mem MB of HDUs in flight
+
+_pipelinedIo = os.environ.get('BOKPIPE_PIPELINED','0') == '1'
+_maxIoMem = int(os.environ.get('BOKPIPE_MAX_IO_MEM',512))
+
+def set_pipelined_io(pipelined=True,maxIoMem=None):
+	global _pipelinedIo,_maxIoMem
+	_pipelinedIo = pipelined
+	os.environ['BOKPIPE_PIPELINED'] = '1' if pipelined else '0'
+	if maxIoMem is not None:
+		_maxIoMem = maxIoMem
+		os.environ['BOKPIPE_MAX_IO_MEM'] = str(maxIoMem)
+
+# per-HDU threads: the HDUs of a single file are processed concurrently
+# by processes that declare _hduParallel (numpy releases the GIL)
+
+_hduThreads = int(os.environ.get('BOKPIPE_HDU_THREADS',1))
+_hduPools = {}
+
+def set_hdu_threads(nthreads):
+	global _hduThreads
+	_hduThreads = nthreads
+	os.environ['BOKPIPE_HDU_THREADS'] = str(nthreads)
+
+def _hdu_thread_pool(nthreads):
+	# a thread pool doesn't survive a fork, so keep one per process
+	k = (os.getpid(),nthreads)
+	if k not in _hduPools:
+		_hduPools[k] = ThreadPool(nthreads)
+	return _hduPools[k]
+
+def close_hdu_thread_pools():
+	'''shuts down the HDU thread pools of this process (the pools of pool
+	   workers are terminated when the workers exit)'''
+	for k in _hduPools.keys():
+		pool = _hduPools.pop(k)
+		# copies inherited through a fork have no threads behind them
+		if k[0] == os.getpid():
+			pool.close()
+			pool.join()
+
+def _resident_call(residentFile,method,arg):
+	try:
+		proc = _residentProcs[residentFile]
+	except KeyError:
+		# only keep the object for the current process_files call
+		_residentProcs.clear()
+		with open(residentFile,'rb') as pf:
+			proc = _residentProcs[residentFile] = pickle.load(pf)
+	return getattr(proc,method)(arg)
+
+class _ResidentTask(object):
+	'''a task calling method of the process object in residentFile, also
+	   carrying the class name to identify the task'''
+	def __init__(self,residentFile,className,method):
+		self.residentFile = residentFile
+		self.className = className
+		self.method = method
+	def __call__(self,arg):
+		return _resident_call(self.residentFile,self.method,arg)
+
 def mplog(msg,nProc=None):
 	if nProc != 1:
 		pname = multiprocessing.current_process().name
@@ -501,7 +1405,7 @@ class FakeFITS(object):
 		self.data = [None] # empty first extension, like FITS MEF
 		self.extMap = {}
 		for extNum,hdu in enumerate(fits[1:],start=1):
-			self.data.append(hdu.read())
+			self.data.append(read_image(hdu))
 			self.extMap[hdu.get_extname().upper()] = extNum
 	def __getitem__(self,extn):
 		'''index either by extension number or name'''
@@ -512,7 +1416,143 @@ class FakeFITS(object):
 		'''need to provide hook for this because fits.close() is used often'''
 		pass
 
+# shared calibration store: master calibrations are unpacked once into
+# .npy files on a memory-backed filesystem and opened as read-only memory
+# maps, so that all pool workers share a single copy of the pixel data.
+# Unless a directory is given, each run gets a private directory under 
+# /dev/shm, so that concurrent runs don't count or clear each other's 
+# entries; it is created before the pool so the workers inherit it.
+
+_sharedCals = os.environ.get('BOKPIPE_SHARED_CALS','0') == '1'
+_sharedCalDir = os.environ.get('BOKPIPE_SHARED_CAL_DIR')
+_sharedCalRunDir = None
+
+def set_shared_calibrations(shared=True,cacheDir=None):
+	global _sharedCals,_sharedCalDir
+	_sharedCals = shared
+	os.environ['BOKPIPE_SHARED_CALS'] = '1' if shared else '0'
+	if cacheDir is not None:
+		_sharedCalDir = cacheDir
+		os.environ['BOKPIPE_SHARED_CAL_DIR'] = cacheDir
+	if shared:
+		shared_calibration_dir()
+
+def _shared_cal_base():
+	if os.path.isdir('/dev/shm'):
+		return '/dev/shm'
+	return tempfile.gettempdir()
+
+def shared_calibration_dir():
+	global _sharedCalDir,_sharedCalRunDir
+	if _sharedCalDir is None:
+		_sharedCalDir = _sharedCalRunDir = \
+		       tempfile.mkdtemp(prefix='bokcals_%d_'%os.getpid(),
+		                        dir=_shared_cal_base())
+		os.environ['BOKPIPE_SHARED_CAL_DIR'] = _sharedCalDir
+	return _sharedCalDir
+
+class SharedFakeFITS(FakeFITS):
+	'''A FakeFITS whose image data are read-only memory maps of .npy files
+	   in the shared calibration store (by default in /dev/shm). The first
+	   process to open a FITS file unpacks it into the store, subsequent
+	   opens (including from other processes) map the same pages. Pickles 
+	   as the path to the store entry.'''
+	def __init__(self,fits,cacheDir=None):
+		if not isinstance(fits,basestring):
+			fits = fits._filename
+		self._filename = fits
+		if cacheDir is None:
+			cacheDir = shared_calibration_dir()
+		self.storeDir = self._store_entry(fits_name(fits),cacheDir)
+		self._map_store()
+	@staticmethod
+	def _store_entry(fileName,cacheDir):
+		st = os.stat(fileName)
+		key = '%s:%d:%d' % (os.path.abspath(fileName),st.st_size,
+		                    int(st.st_mtime))
+		entry = os.path.join(cacheDir,'bokcal_%s_%s' % 
+		                       (os.path.basename(fileName).split('.')[0],
+		                        hashlib.md5(key).hexdigest()[:12]))
+		if os.path.exists(entry):
+			return entry
+		# unpack into a private directory and then rename it, so that other
+		# processes never see a partially written entry
+		tmpDir = tempfile.mkdtemp(prefix='.bokcal_',dir=cacheDir)
+		fits = fitsio.FITS(fileName)
+		extNames = []
+		for extNum,hdu in enumerate(fits[1:],start=1):
+			np.save(os.path.join(tmpDir,'%d.npy'%extNum),read_image(hdu))
+			extNames.append(hdu.get_extname().upper())
+		fits.close()
+		with open(os.path.join(tmpDir,'extnames.txt'),'w') as f:
+			f.write('\n'.join(extNames)+'\n')
+		try:
+			os.rename(tmpDir,entry)
+		except OSError:
+			# another process got there first
+			shutil.rmtree(tmpDir)
+		return entry
+	def _map_store(self):
+		with open(os.path.join(self.storeDir,'extnames.txt')) as f:
+			extNames = f.read().split()
+		self.data = [None]
+		self.extMap = {}
+		for extNum,extName in enumerate(extNames,start=1):
+			im = np.load(os.path.join(self.storeDir,'%d.npy'%extNum),
+			             mmap_mode='r')
+			# plain ndarray views keep memmap semantics out of the math
+			self.data.append(im.view(np.ndarray))
+			self.extMap[extName] = extNum
+	@property
+	def nbytes(self):
+		return sum([ im.nbytes for im in self.data[1:] ])
+	def __getstate__(self):
+		return {'_filename':self._filename,'storeDir':self.storeDir}
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		self._map_store()
+
+def open_calibration(fileName):
+	'''open a master calibration image, from the shared calibration store
+	   if enabled'''
+	if _sharedCals:
+		return SharedFakeFITS(fileName)
+	return FakeFITS(fileName)
+
+def shared_calibration_report(cacheDir=None):
+	'''returns a list of (entry,nbytes) for the shared calibration store,
+	   since it lives on tmpfs this is the memory it occupies'''
+	if cacheDir is None:
+		cacheDir = shared_calibration_dir()
+	rv = []
+	if not os.path.isdir(cacheDir):
+		return rv
+	for entry in sorted(os.listdir(cacheDir)):
+		if not entry.startswith('bokcal_'):
+			continue
+		d = os.path.join(cacheDir,entry)
+		nbytes = sum([ os.path.getsize(os.path.join(d,f)) 
+		                 for f in os.listdir(d) ])
+		rv.append((entry,nbytes))
+	return rv
+
+def clear_shared_calibrations(cacheDir=None):
+	'''removes the entries of the shared calibration store, and the store
+	   itself if it is the private directory of this run'''
+	global _sharedCalDir,_sharedCalRunDir
+	if cacheDir is None:
+		cacheDir = shared_calibration_dir()
+	for entry,nbytes in shared_calibration_report(cacheDir):
+		shutil.rmtree(os.path.join(cacheDir,entry),ignore_errors=True)
+	if cacheDir == _sharedCalRunDir:
+		shutil.rmtree(cacheDir,ignore_errors=True)
+		_sharedCalDir = _sharedCalRunDir = None
+		os.environ.pop('BOKPIPE_SHARED_CAL_DIR',None)
+
 class BokProcess(object):
+	# process_hdu only depends on the HDU it is given, so the HDUs of a
+	# file can be processed concurrently (see hdu_threads)
+	_hduParallel = False
 	_procMsg = '<BokProcess> %s'
 	def __init__(self,**kwargs):
 		self.inputNameMap = kwargs.get('input_map',IdentityNameMap)
@@ -538,7 +1578,27 @@ class BokProcess(object):
 		self.debug = kwargs.get('debug',False)
 		self.nProc = kwargs.get('processes',1)
 		self.procMap = kwargs.get('procmap',map)
+		self.resident = kwargs.get('resident',_residentWorkers)
+		self.pipelined = kwargs.get('pipelined',_pipelinedIo)
+		self.maxIoMem = kwargs.get('max_io_mem',_maxIoMem)
+		self.hduThreads = kwargs.get('hdu_threads',_hduThreads)
+		self.compressKwargs = { k:kwargs[k] for k in ['tile_compress',
+		                                               'tile_dims',
+		                                               'qlevel','qmethod']
+		                                      if k in kwargs }
+		self.compressArgs = tile_compress_args(kwargs.get('tile_compress'),
+		                                       kwargs.get('tile_dims'),
+		                                       kwargs.get('qlevel'),
+		                                       kwargs.get('qmethod'))
+		# storage type of the output, can be set per product by the map
+		self.storage = check_storage_type(kwargs.get('storage',
+		                    getattr(self.outputNameMap,'storage','float32')))
+		self.quantLevel = kwargs.get('quant_level',
+		                    getattr(self.outputNameMap,'quantLevel',4.))
 		self.noConvert = False
+		# set to (stats_region,stride) by processes that only need a
+		# region of each HDU (read_only)
+		self.readRegion = None
 	def add_mask(self,maskFits,maskType='gtzero'):
 		if not isinstance(maskFits,FakeFITS):
 			try:
@@ -564,8 +1624,9 @@ class BokProcess(object):
 	       of individual files before finishing.'''
 		pass
 	def process_file(self,f):
+		mefImage = PipelinedMefImage if self.pipelined else BokMefImage
 		try:
-			fits = BokMefImage(self.inputNameMap(f),
+			fits = mefImage(self.inputNameMap(f),
 			                   output_file=self.outputNameMap(f),
 			                   mask_file=self.maskNameMap(f),
 			                   mask_type=self.maskType,
@@ -574,7 +1635,12 @@ class BokProcess(object):
 			                   header_key=self.headerKey,
 			                   header_fixes=self.headerFixes.get(f,{}),
 			                   read_only=self.readOnly,
-			                   extensions=self.extensions)
+			                   extensions=self.extensions,
+			                   max_io_mem=self.maxIoMem,
+			                   storage=self.storage,
+			                   quant_level=self.quantLevel,
+			                   read_region=self.readRegion,
+			                   **self.compressKwargs)
 		except OutputExistsError,msg:
 			if self.ignoreExisting:
 				if self.verbose > 0:
@@ -583,15 +1649,39 @@ class BokProcess(object):
 				return
 			else:
 				raise OutputExistsError(msg)
-		for maskIm,maskType in zip(self.masks,self.maskTypes):
-			fits.add_mask(maskIm,maskType)
-		self._preprocess(fits,f)
-		for extName,data,hdr in fits:
-			data,hdr = self.process_hdu(extName,data,hdr)
-			fits.update(data,hdr,noconvert=self.noConvert)
-		self._postprocess(fits,f)
+		try:
+			for maskIm,maskType in zip(self.masks,self.maskTypes):
+				fits.add_mask(maskIm,maskType)
+			self._preprocess(fits,f)
+			if self._hduParallel and self.hduThreads > 1:
+				self._process_hdus_threaded(fits)
+			else:
+				for extName,data,hdr in fits:
+					data,hdr = self.process_hdu(extName,data,hdr)
+					fits.update(data,hdr,noconvert=self.noConvert)
+			self._postprocess(fits,f)
+		except:
+			fits.abort()
+			raise
 		fits.close()
 		return self._getOutput()
+	def _process_hdus_threaded(self,fits):
+		'''process the HDUs in a thread pool, writing them out in the
+		   input order. Reads stay in this thread and at most hduThreads
+		   HDUs are in flight.'''
+		pool = _hdu_thread_pool(self.hduThreads)
+		pending = deque()
+		def _write_next():
+			extName,res = pending.popleft()
+			data,hdr = res.get()
+			fits.update(data,hdr,noconvert=self.noConvert,extName=extName)
+		for extName,data,hdr in fits:
+			res = pool.apply_async(self.process_hdu,(extName,data,hdr))
+			pending.append((extName,res))
+			if len(pending) >= self.hduThreads:
+				_write_next()
+		while pending:
+			_write_next()
 	def _null_result(self,f):
 		return None
 	def _process_file_exc(self,f):
@@ -605,24 +1695,414 @@ class BokProcess(object):
 				                       (self.inputNameMap(f),e))
 				return self._null_result(f)
 	def _process_file_group(self,fgrp):
-		return map(self._process_file_exc,fgrp)
+		if not self.pipelined:
+			return map(self._process_file_exc,fgrp)
+		# read ahead the next input file while the current one is processed
+		procOut = []
+		for i,f in enumerate(fgrp):
+			if i+1 < len(fgrp):
+				prefetch_file(self.inputNameMap(fgrp[i+1]))
+			procOut.append(self._process_file_exc(f))
+		return procOut
+	def _calibrators(self):
+		'''calibrators (bokdm.BokCalibrator) used by the process, keyed by
+		   calibration type'''
+		return {}
+	def _calibration_key(self,f):
+		'''files with the same key use the same calibration images'''
+		calibs = self._calibrators()
+		return tuple([ calibs[k].getCalKey(f) for k in sorted(calibs) ])
+	def _process_cal_group(self,fgrp):
+		'''processes a group of files sharing calibrations, also returning
+		   the number of times calibrations were loaded'''
+		calibs = self._calibrators()
+		nLoads = { k:c.nLoads for k,c in calibs.items() }
+		procOut = self._process_file_group(fgrp)
+		nLoads = { k:c.nLoads-nLoads[k] for k,c in calibs.items() }
+		return procOut,nLoads
+	def _schedule(self,fileList):
+		'''group the files by calibration key, with large groups split to
+		   keep all the processes busy, and return the groups as lists of
+		   indices into fileList, largest first'''
+		groups = OrderedDict()
+		for i,f in enumerate(fileList):
+			groups.setdefault(self._calibration_key(f),[]).append(i)
+		maxLen = max(1,-(-len(fileList)//self.nProc))
+		schedule = [ ii[j:j+maxLen] for ii in groups.values()
+		                              for j in range(0,len(ii),maxLen) ]
+		schedule.sort(key=len,reverse=True)
+		return schedule
+	def _write_resident(self):
+		fd,residentFile = tempfile.mkstemp(prefix='bokproc_',suffix='.pkl')
+		with os.fdopen(fd,'wb') as pf:
+			pickle.dump(self,pf,pickle.HIGHEST_PROTOCOL)
+		return residentFile
+	def task_pickle_size(self):
+		'''number of bytes pickled for each task sent to the pool, either
+		   carrying the process object or with resident workers'''
+		procMap = self.procMap
+		self.procMap = None
+		nbytes = lambda obj: len(pickle.dumps(obj,pickle.HIGHEST_PROTOCOL))
+		rv = {'per_task':nbytes(self._process_file_exc),
+		      'resident_task':nbytes(_ResidentTask(
+		                                     os.path.join(tempfile.gettempdir(),
+		                                                 'bokproc_XXXXXX.pkl'),
+		                                     self.__class__.__name__,
+		                                     '_process_file_exc')),
+		      'resident_once':nbytes(self)}
+		self.procMap = procMap
+		return rv
+	def _map_files(self,procMap,taskFun,fileList):
+		'''maps the files to the process, grouped as the process needs'''
+		if len(self._calibrators()) > 0:
+			# schedule by calibration set so that each worker loads the
+			# calibrations for a group of files once
+			if not isinstance(fileList[0],types.StringTypes):
+				fileList = [ f for fgrp in fileList for f in fgrp ]
+			schedule = self._schedule(fileList)
+			grpOut = procMap(taskFun('_process_cal_group'),
+			                 [ [ fileList[i] for i in ii ] for ii in schedule ])
+			procOut = [None] * len(fileList)
+			self.calLoads = defaultdict(int)
+			for ii,(outgrp,nLoads) in zip(schedule,grpOut):
+				for i,out in zip(ii,outgrp):
+					procOut[i] = out
+				for k,n in nLoads.items():
+					self.calLoads[k] += n
+			if self.verbose > 0:
+				print '%s: %d calibration groups, loads: %s' % \
+				   (self.__class__.__name__,len(schedule),
+				    ' '.join(['%s=%d'%kv for kv in sorted(self.calLoads.items())
+				                         if kv[1] > 0]))
+		elif isinstance(fileList[0],types.StringTypes):
+			procOut = procMap(taskFun('_process_file_exc'),fileList)
+		else:
+			procOut = procMap(taskFun('_process_file_group'),fileList)
+			procOut = [ out for outgrp in procOut for out in outgrp ]
+		return procOut
 	def process_files(self,fileList):
 		# pool objects can't be pickled so have to save it, remove it from
 		# object, then restore it
 		procMap = self.procMap
+		if self.verbose > 1 and self.nProc > 1:
+			sz = self.task_pickle_size()
+			print '%s: pickled bytes per task %d, resident %d (once %d)' % \
+			        (self.__class__.__name__,sz['per_task'],
+			         sz['resident_task'],sz['resident_once'])
 		self.procMap = None
-		if isinstance(fileList[0],types.StringTypes):
-			procOut = procMap(self._process_file_exc,fileList)
+		residentFile = None
+		if self.resident and self.nProc > 1:
+			# ship the process object to the workers once through a pickle
+			# file, tasks then only carry the file names
+			residentFile = self._write_resident()
+			taskFun = lambda m: _ResidentTask(residentFile,
+			                                  self.__class__.__name__,m)
 		else:
-			procOut = procMap(self._process_file_group,fileList)
-			procOut = [ out for outgrp in procOut for out in outgrp ]
+			taskFun = lambda m: getattr(self,m)
+		try:
+			procOut = self._map_files(procMap,taskFun,fileList)
+		finally:
+			if residentFile is not None:
+				os.unlink(residentFile)
+			self.procMap = procMap
+			close_hdu_thread_pools()
 		procOut = filter(lambda p: p is not None,procOut)
 		if self.nProc > 1:
 			self._ingestOutput(procOut)
-		self.procMap = procMap
 		self._finish()
 
+def _copy_header(hdr):
+	# rebuilding from the records also clears the stale keyword indices
+	# that FITSHDR.delete leaves behind in some fitsio versions
+	if isinstance(hdr,fitsio.FITSHDR):
+		return fitsio.FITSHDR([ dict(r) for r in hdr.records() ])
+	return deepcopy(hdr)
+
+class _ChainHDU(object):
+	'''A single HDU held in memory by _ChainFITS'''
+	def __init__(self,extName,data,header,loader=None,source=None):
+		self.extName = extName
+		self.data = data
+		self.header = header
+		self.loader = loader
+		self.source = source
+		self.nreads = 0
+	def read(self):
+		if self.data is None and self.loader is not None:
+			self.data = self.loader()
+		# readers that come before the last one get a copy, since the
+		# processes are free to modify their input in place
+		self.nreads -= 1
+		if self.nreads > 0:
+			return self.data.copy()
+		return self.data
+	def read_header(self):
+		return _copy_header(self.header)
+	def write_keys(self,cards):
+		if isinstance(cards,fitsio.FITSHDR):
+			cards = { r['name']:r['value'] for r in cards.records() }
+		for k,v in cards.items():
+			self.header[k] = v
+	def get_extname(self):
+		return self.extName
+	def get_dims(self):
+		if self.data is None and self.source is not None:
+			return self.source.get_dims()
+		if self.data is None and self.loader is not None:
+			self.data = self.loader()
+		return list(self.data.shape)
+	def __getitem__(self,subset):
+		if self.data is None and self.source is not None:
+			# subset read from the file without loading the HDU
+			return read_subset(self.source,subset)
+		return self.data[subset]
+
+class _ChainFITS(object):
+	'''In-memory stand-in for a fitsio.FITS MEF that passes HDUs between
+	   the steps of a BokProcessChain. If srcFits is given, HDUs are read 
+	   from it (once) on demand. If outFits is given, HDUs are also written
+	   to it as they arrive.'''
+	def __init__(self,fileName,srcFits=None,outFits=None,storage='float32',
+	             quant_level=4.):
+		self._filename = fileName
+		self.srcFits = srcFits
+		self.outFits = outFits
+		self.storage = storage
+		self.quantLevel = quant_level
+		self.nReaders = 0
+		self.hdus = OrderedDict()
+		if srcFits is not None:
+			self.hdus[0] = _ChainHDU('',None,srcFits[0].read_header())
+	def extensions(self):
+		return [ h.get_extname().upper() for h in self.srcFits[1:] ]
+	def __getitem__(self,extn):
+		if isinstance(extn,basestring):
+			extn = extn.upper()
+		if extn not in self.hdus:
+			if self.srcFits is None:
+				raise KeyError('HDU %s not in chain' % extn)
+			hdu = self.srcFits[extn]
+			self.hdus[extn] = _ChainHDU(extn,None,hdu.read_header(),
+			                            loader=hdu.read,source=hdu)
+		hdu = self.hdus[extn]
+		if hdu.nreads <= 0:
+			hdu.nreads = self.nReaders
+		return hdu
+	def write(self,data,extname=None,header=None,clobber=False,**kwargs):
+		if self.outFits is not None:
+			if self.storage == 'int16' and data is not None and \
+			     data.dtype.kind == 'f':
+				qdata,qhdr = quantize_hdu(data,header,self.quantLevel)
+				self.outFits.write(qdata,extname=extname,header=qhdr,
+				                   clobber=clobber,**kwargs)
+			else:
+				self.outFits.write(data,extname=extname,header=header,
+				                   clobber=clobber,**kwargs)
+		if data is None:
+			self.hdus[0] = _ChainHDU('',None,header)
+		else:
+			if self.nReaders == 0:
+				data = None # only the header is needed downstream
+			else:
+				data = np.ma.getdata(data)
+			self.hdus[extname.upper()] = _ChainHDU(extname.upper(),data,
+			                                       _copy_header(header))
+	def write_keys(self,cards):
+		if self.outFits is not None:
+			self.outFits[0].write_keys(cards)
+		self.hdus[0].write_keys(cards)
+	def release(self,extName):
+		'''drop the data for an HDU once all steps are done with it'''
+		if extName in self.hdus:
+			self.hdus[extName].data = None
+	def close(self):
+		if self.outFits is not None:
+			self.outFits.close()
+
+class _ChainPrimaryHDU(object):
+	# routes write_keys to both memory and disk for steps that annotate
+	# the primary header in _preprocess
+	def __init__(self,chainFits):
+		self.chainFits = chainFits
+	def read_header(self):
+		return self.chainFits.hdus[0].read_header()
+	def write_keys(self,cards):
+		self.chainFits.write_keys(cards)
+
+class _ChainOutput(_ChainFITS):
+	def __getitem__(self,extn):
+		if extn == 0:
+			return _ChainPrimaryHDU(self)
+		return super(_ChainOutput,self).__getitem__(extn)
+
+class _ChainImage(BokMefImage):
+	'''BokMefImage that reads from and writes to _ChainFITS objects, set up
+	   from the attributes of a BokProcess.'''
+	def __init__(self,proc,f,inFits,outFits):
+		self.fileName = inFits._filename
+		self.outFileName = None if outFits is None else outFits._filename
+		self.readOnly = proc.readOnly
+		self.extensions = proc.extensions
+		self.headerFixes = proc.headerFixes.get(f,{})
+		self.closeFiles = []
+		self.clobberHdus = False
+		self.compressArgs = proc.compressArgs
+		# quantized storage is applied to the disk copy by _ChainFITS
+		self.storage = 'float32'
+		# the HDUs are passed in memory
+		self.readRegion = None
+		self.tmpOutFile = None
+		self.fits = inFits
+		self.outFits = outFits
+		if not self.readOnly:
+			if proc.keepHeaders:
+				hdr = inFits[0].read_header()
+			else:
+				hdr = {}
+			for extNum,hdrfix in self.headerFixes:
+				if extNum == 0:
+					for k,v in hdrfix.items():
+						hdr[k] = v
+			if proc.headerKey is not None:
+				hdr[proc.headerKey] = get_timestamp()
+			outFits.write(None,header=hdr)
+		self._init_masks(proc.maskNameMap(f),proc.maskType)
+		for maskIm,maskType in zip(proc.masks,proc.maskTypes):
+			self.add_mask(maskIm,maskType)
+		self.curExtName = None
+
+class BokProcessChain(BokProcess):
+	'''Runs a sequence of BokProcess steps in a single pass over each file.
+	   Each HDU is read once and handed through the process_hdu methods of
+	   the steps in memory. A step takes its input from the latest previous
+	   step whose output file name matches its input file name, otherwise 
+	   from disk. Only the outputs of the steps in write_steps are written
+	   (default is any output not consumed by a later step); read-only steps
+	   (e.g., data quality masks) still write their own products.
+	   The steps must do all their work in _preprocess/process_hdu/
+	   _postprocess, i.e., not overload process_file.
+	   The HDUs are processed serially: hdu_threads is not used, even when
+	   all the steps are _hduParallel, since the steps share the in-memory
+	   HDUs and the open fitsio files. Use processes to run files in 
+	   parallel instead.'''
+	_procMsg = 'chain %s'
+	def __init__(self,steps,**kwargs):
+		super(BokProcessChain,self).__init__(**kwargs)
+		self.steps = steps
+		self.writeSteps = kwargs.get('write_steps')
+		if self.extensions is None:
+			self.extensions = steps[0].extensions
+	def _get_write_steps(self,f):
+		if self.writeSteps is not None:
+			return [ s for s in self.steps 
+			           if s in self.writeSteps and not s.readOnly ]
+		writeSteps = []
+		for i,step in enumerate(self.steps):
+			if step.readOnly:
+				continue
+			outf = step.outputNameMap(f)
+			if not any([ s.inputNameMap(f)==outf for s in self.steps[i+1:] ]):
+				writeSteps.append(step)
+		return writeSteps
+	def _check_outputs(self,f,writeSteps):
+		'''returns False if all outputs have been generated already,
+		   otherwise clears the outputs to be regenerated'''
+		done = []
+		for step in writeSteps:
+			outf = step.outputNameMap(f)
+			isDone = False
+			if os.path.exists(outf) and not self.clobber and \
+			     step.headerKey is not None:
+				isDone = step.headerKey in fitsio.read_header(outf,0)
+			done.append(isDone)
+		if len(done) > 0 and all(done):
+			return False
+		for step in writeSteps:
+			outf = step.outputNameMap(f)
+			if os.path.exists(outf):
+				os.unlink(outf)
+		return True
+	def process_file(self,f):
+		writeSteps = self._get_write_steps(f)
+		if not self._check_outputs(f,writeSteps):
+			if self.verbose > 0:
+				print '%s already processed by chain' % f
+			return
+		self._proclog(f)
+		chainFits = {}
+		images = []
+		for step in self.steps:
+			inf = step.inputNameMap(f)
+			if inf not in chainFits:
+				chainFits[inf] = _ChainFITS(inf,
+				                           srcFits=fitsio.FITS(fits_name(inf)))
+			inFits = chainFits[inf]
+			inFits.nReaders += 1
+			if step.readOnly:
+				outFits = None
+			else:
+				outf = step.outputNameMap(f)
+				if step in writeSteps:
+					diskFits = fitsio.FITS(outf,'rw')
+				else:
+					diskFits = None
+				outFits = chainFits[outf] = _ChainOutput(outf,
+				                                        outFits=diskFits,
+				                                  storage=step.storage,
+				                               quant_level=step.quantLevel)
+			images.append(_ChainImage(step,f,inFits,outFits))
+		extensions = self.extensions
+		if extensions is None:
+			extensions = chainFits[self.steps[0].inputNameMap(f)].extensions()
+		for step,fits in zip(self.steps,images):
+			step._preprocess(fits,f)
+		for extName in extensions:
+			for step,fits in zip(self.steps,images):
+				fits.curExtName = extName
+				data,hdr = fits._read_hdu(extName)
+				data,hdr = step.process_hdu(extName,data,hdr)
+				fits.update(data,hdr,noconvert=step.noConvert)
+			for fits in chainFits.values():
+				fits.release(extName)
+		for step,fits in zip(self.steps,images):
+			step._postprocess(fits,f)
+		for fits in chainFits.values():
+			if fits.srcFits is not None:
+				fits.srcFits.close()
+			fits.close()
+		return self._getOutput()
+	def process_files(self,fileList):
+		# the steps hold their own procmaps which also can't be pickled
+		procMaps = [ step.procMap for step in self.steps ]
+		for step in self.steps:
+			step.procMap = None
+		try:
+			super(BokProcessChain,self).process_files(fileList)
+		finally:
+			for step,procMap in zip(self.steps,procMaps):
+				step.procMap = procMap
+	def _calibrators(self):
+		calibs = {}
+		for i,step in enumerate(self.steps):
+			for k,cal in step._calibrators().items():
+				if k in calibs and calibs[k] is not cal:
+					k = '%s%d' % (k,i)
+				calibs[k] = cal
+		return calibs
+	def _getOutput(self):
+		return [ step._getOutput() for step in self.steps ]
+	def _ingestOutput(self,procOut):
+		for i,step in enumerate(self.steps):
+			step._ingestOutput(filter(lambda p: p is not None,
+			                          [ out[i] for out in procOut ]))
+	def _finish(self):
+		for step in self.steps:
+			step._finish()
+
 class BokImStat(BokProcess):
+	# only the stats region is read from each HDU, unless _get_pixels
+	# needs the full image
+	_subsetReads = True
 	def __init__(self,fields=['mean'],**kwargs):
 		kwargs.setdefault('read_only',True)
 		super(BokImStat,self).__init__(**kwargs)
@@ -632,6 +2112,11 @@ class BokImStat(BokProcess):
 		self.clipArgs = kwargs.get('clip_args',{})
 		self.checkbad = kwargs.get('checkbad',False)
 		self.fields = fields
+		# fail before reading any data on an unknown field
+		value_stats([],fields)
+		if self._subsetReads and self.readOnly and not self.checkbad:
+			self.readRegion = (kwargs.get('stats_region'),
+			                   kwargs.get('stats_stride'))
 		self.reset()
 	def _preprocess(self,fits,f):
 		if self.nProc > 1:
@@ -640,6 +2125,8 @@ class BokImStat(BokProcess):
 			self.reset()
 		self.imgData = defaultdict(list)
 		self.imgBad = []
+		# in a chain the full HDUs are passed in memory
+		self.regionRead = getattr(fits,'readRegion',None) is not None
 	def _get_pixels(self,data,hdr):
 		return data
 	def process_hdu(self,extName,data,hdr):
@@ -649,40 +2136,51 @@ class BokImStat(BokProcess):
 			#zero = np.ma.less_equal(data,0)
 			self.imgBad.append(xy[:,data.mask])
 		pix = self._get_pixels(data,hdr)
-		pix = pix[self.statSec]
+		if not self.regionRead:
+			pix = pix[self.statSec]
 		if self.normIm is not None:
 			pix /= self.normIm[extName][self.statSec]
-		v,pix = array_stats(pix,method=self.fields[0],
-		                    retArray=True,clip=True,**self.clipArgs)
-		self.imgData[self.fields[0]].append(v)
-		for k in self.fields[1:]:
-			if k=='std':
-				self.imgData[k].append(pix.std())
-			elif k in ['mean','median','mode']:
-				v = array_stats(pix,method=k)
-				self.imgData[k].append(v)
+		# the same values as array_stats, from one clipping pass
+		stats = array_multi_stats(pix,self.fields,clip=True,**self.clipArgs)
+		for k in self.fields:
+			self.imgData[k].append(stats[k])
 		return data,hdr
 	def _postprocess(self,fits,f):
+		self.data['file'].append(f)
 		for k in self.fields:
 			self.data[k].append(self.imgData[k])
 		self.badVals.append(self.imgBad)
 	def _finish(self):
-		self.data = Table(self.data)
+		names = ['file'] + list(self.fields)
+		self.data = Table([ self.data[k] for k in names ],names=names)
 	def _getOutput(self):
 		return self.data
 	def _ingestOutput(self,procOut):
 		for p in procOut:
-			for k in self.fields:
+			for k in ['file']+list(self.fields):
 				self.data[k].extend(p[k])
 	def reset(self):
 		self.data = defaultdict(list)
 		self.badVals = []
 
 class BokMefImageCube(object):
+	# bytes per (pixel,file) of cube-sized temporaries created by the
+	# rescale/reject/combine steps (roughly three float32+mask copies)
+	_cubeWorkBytes = 15
 	def __init__(self,**kwargs):
 		self.withVariance = kwargs.get('with_variance',False)
 		self.scale = kwargs.get('scale')
 		self.reject = kwargs.get('reject','sigma_clip')
+		# optionally combine with one of the named bokstats kernels
+		# (mean|median|minmax|percentile|clipped_mean) instead of the
+		# class's _stack_cube
+		self.stackMethod = kwargs.get('stack_method')
+		if self.stackMethod is not None and \
+		     self.stackMethod not in stack_kernels:
+			raise ValueError('stack method %s unrecognized' % 
+			                 self.stackMethod)
+		if self.reject not in [None,'sigma_clip']+reject_kernels.keys():
+			raise ValueError('reject method %s unrecognized' % self.reject)
 		self.inputNameMap = kwargs.get('input_map',IdentityNameMap)
 		self.outputNameMap = kwargs.get('output_map',IdentityNameMap)
 		self.maskNameMap = kwargs.get('mask_map',NullNameMap)
@@ -695,6 +2193,8 @@ class BokMefImageCube(object):
 		self.statsPix = stats_region(self.statsRegion,self.statsStride)
 		self.clipArgs = { k:v for k,v in kwargs.items()
 		                        if k.startswith('clip_') }
+		self.kernelArgs = { k:v for k,v in kwargs.items()
+		                      if k in ['nlow','nhigh','plow','phigh'] }
 		self.fillValue = kwargs.get('fill_value',np.nan)
 		self.procmap = kwargs.get('procmap',map)
 		self.processes = kwargs.get('processes',1)
@@ -760,10 +2260,12 @@ class BokMefImageCube(object):
 	def _reject_pixels(self,imCube):
 		if self.reject == 'sigma_clip':
 			imCube = array_clip(imCube,axis=-1,**self.clipArgs)
-		elif self.reject == 'minmax':
-			imCube = np.ma.masked_array(imCube)
-			imCube[:,:,imCube.argmax(axis=-1)] = np.ma.masked
-			imCube[:,:,imCube.argmin(axis=-1)] = np.ma.masked
+		elif self.reject in reject_kernels:
+			rejfun = reject_kernels[self.reject]
+			rej = rejfun(to_nan_array(imCube),
+			             **kernel_args(self.reject,self.kernelArgs))
+			imCube = np.ma.masked_array(imCube,
+			                            mask=np.ma.getmaskarray(imCube)|rej)
 		return imCube
 	def _load_weights(self,weights,fileList,extn,rows):
 		# if it's a map convert it to a list of files
@@ -776,6 +2278,48 @@ class BokMefImageCube(object):
 		return weights
 	def _stack_cube(self,imCube,weights=None,**kwargs):
 		raise NotImplementedError
+	def _kernel_stack(self,imCube,weights=None):
+		args = dict(self.kernelArgs,weights=weights,**self.clipArgs)
+		stack,nvalid = stack_kernels[self.stackMethod](to_nan_array(imCube),
+		                          **kernel_args(self.stackMethod,args))
+		return np.ma.masked_array(stack.astype(np.float32),mask=(nvalid==0))
+	def _combine(self,imCube,weights=None,**kwargs):
+		if self.stackMethod is not None:
+			return self._kernel_stack(imCube,weights)
+		return self._stack_cube(imCube,weights,**kwargs)
+	def _exposure_time(self,imCube,expTimes):
+		# accumulate one plane at a time to avoid a cube-sized temporary
+		mask = np.ma.getmaskarray(imCube)
+		expTime = np.zeros(imCube.shape[:2],dtype=np.float32)
+		for i,t in enumerate(expTimes):
+			expTime += t * ~mask[:,:,i]
+		return expTime
+	def _get_row_chunks(self,reader,extn):
+		'''Split an extension into row bands that fit within maxmem. The
+		   budget covers the band buffers (data, masks, and weights for each
+		   input, double-buffered), the cube-sized temporaries made while
+		   rescaling/rejecting/combining, and the full-size output images
+		   (stack, exposure time, variance) accumulated for the extension.'''
+		numRows,numCols = reader.get_shape(extn)
+		if self.maxMemBytes is None:
+			return [(0,numRows)]
+		nbytes = np.dtype(np.float32).itemsize
+		nFiles = reader.nFiles
+		rowBytes = numCols * nFiles * ( reader.nBuf*reader.bytes_per_pixel()
+		                                + self._cubeWorkBytes )
+		outBytes = numRows * numCols * (nbytes + 1)
+		if self.withExpTimeMap:
+			outBytes += numRows * numCols * nbytes
+		if self.withVariance:
+			outBytes += numRows * numCols * (nbytes + 1)
+		availBytes = int(self.maxMemBytes) - outBytes
+		nrows = max(1,min(numRows,availBytes // rowBytes))
+		if availBytes < rowBytes:
+			print 'WARNING: maxmem=%.1fGB too small to stack %s' % \
+			          (self.maxMemGB,extn)
+		rowsplits = range(0,numRows,nrows) + [numRows]
+		return [ (row1,row2) 
+		           for row1,row2 in zip(rowsplits[:-1],rowsplits[1:]) ]
 	def _preprocess(self,fileList,outFits):
 		pass
 	def _postprocess(self,extName,stack,hdr):
@@ -812,7 +2356,8 @@ class BokMefImageCube(object):
 			expTimes = [ fitsio.read_header(_f,ext=0)['EXPTIME']
 			                 for _f in inputFiles]
 			expTimes = np.array(expTimes).astype(np.float32)
-			expTimes = expTimes[np.newaxis,np.newaxis,:]
+		else:
+			expTimes = None
 		if self.withVariance:
 			varFn = outputFile.replace('.fits','_var.fits')
 			try:
@@ -825,19 +2370,24 @@ class BokMefImageCube(object):
 		if extensions is None:
 			_fits = fitsio.FITS(inputFiles[0])
 			extensions = [ h.get_extname() for h in _fits[1:] ]
-		if self.maxMemBytes is None:
-			nsplits = 1
+			_fits.close()
+		if self.maskNameMap == NullNameMap:
+			# argh, this is a hacky way to check for masks
+			masks = None
 		else:
-			numRows,numCols = 4032,4096
-			nbytes = np.dtype(np.float32).itemsize
-			stacksize = nbytes * numRows * numCols * len(inputFiles)
-			nsplits = stacksize // int(self.maxMemBytes) + 1
-		if nsplits == 1:
-			rowChunks = [None,]
+			masks = [ self.maskNameMap(f) for f in fileList ]
+		# weight images given as files are streamed along with the data
+		if isinstance(weights,FileNameMap):
+			weights = [ weights(f) for f in fileList ]
+		if type(weights) is list:
+			weightFiles,weights = weights,None
 		else:
-			rowsplits = np.linspace(0,numRows,nsplits+1,dtype=np.int32)
-			rowChunks = [ (row1,row2) 
-			         for row1,row2 in zip(rowsplits[:-1],rowsplits[1:]) ]
+			weightFiles = None
+		reader = CubeBandReader(inputFiles,masks=masks,weights=weightFiles,
+		                        badKey=self.badKey,maskType=self.maskType)
+		rowChunks = { extn:self._get_row_chunks(reader,extn)
+		                for extn in extensions }
+		nsplits = max([ len(chunks) for chunks in rowChunks.values() ])
 		self._preprocess(fileList,outFits)
 		if ( scales is None and nsplits > 1 and 
 		      self.scale is not None and 
@@ -847,56 +2397,66 @@ class BokMefImageCube(object):
 			all_scales = self._getscales(inputFiles)
 		else:
 			all_scales = None
-		if self.maskNameMap == NullNameMap:
-			# argh, this is a hacky way to check for masks
-			masks = None
-		else:
-			masks = [ self.maskNameMap(f) for f in fileList ]
-		for ext_j,extn in enumerate(extensions):
-			stack = []
-			if self.withExpTimeMap:
-				expTime = []
-			if self.withVariance:
-				var = []
-			if all_scales is not None:
-				scales = all_scales[:,ext_j]
-			for rows in rowChunks:
-				print '::: %s extn %s <%s>' % (outputFile,extn,rows)
-				imCube = build_cube(inputFiles,extn,masks=masks,rows=rows,
-				                    badKey=self.badKey,maskType=self.maskType)
-				imCube = self._rescale(imCube,scales=scales)
-				imCube = self._reject_pixels(imCube)
-				w = self._load_weights(weights,fileList,extn,rows)
-				_stack = self._stack_cube(imCube,w,**kwargs)
-				if self.badPixelMask is not None:
-					bpmsk = self.badPixelMask[extn][rows2slice(rows)]
-					_stack.mask |= load_mask(bpmsk,'gtzero')
-				if self.minNexp is not None:
-					nexp = np.sum(~imCube.mask,axis=-1)
-					_stack.mask |= nexp < self.minNexp
-				stack.append(_stack)
+		bands = [ (extn,rows) for extn in extensions 
+		                        for rows in rowChunks[extn] ]
+		bandIter = reader.iter_bands(bands)
+		try:
+			for ext_j,extn in enumerate(extensions):
+				stack = []
 				if self.withExpTimeMap:
-					expTime.append(np.sum(~imCube.mask*expTimes,axis=-1))
+					expTime = []
 				if self.withVariance:
-					# XXX this isn't the right variance for a weighted sum,
-					#     really the var calculation needs to happen in 
-					#     _stack_cube since it is implementation-dependent
-					var.append(np.ma.var(imCube,axis=-1))
-			stack = np.ma.vstack(stack)
-			hdr = fitsio.read_header(inputFiles[0],extn)
-			stack,hdr = self._postprocess(extn,stack,hdr)
-			try:
-				finalStack = stack.filled(self.fillValue).astype(np.float32)
-			except AttributeError:
-				finalStack = stack.astype(np.float32)
-			outFits.write(finalStack,extname=extn,header=hdr)
-			if self.withExpTimeMap:
-				expTime = np.ma.vstack(expTime)
-				expTimeFits.write(expTime,extname=extn,header=hdr)
-			if self.withVariance:
-				var = np.ma.vstack(var)
-				var = var.filled(0).astype(np.float32)
-				varFits.write(var,extname=extn,header=hdr)
+					var = []
+				if all_scales is not None:
+					scales = all_scales[:,ext_j]
+				for rows in rowChunks[extn]:
+					print '::: %s extn %s <%s>' % (outputFile,extn,rows)
+					_extn,_rows,imCube,_mask,w = next(bandIter)
+					imCube = self._rescale(imCube,scales=scales)
+					imCube = self._reject_pixels(imCube)
+					if weightFiles is None:
+						w = self._load_weights(weights,fileList,extn,rows)
+					_stack = self._combine(imCube,w,**kwargs)
+					if self.badPixelMask is not None:
+						bpmsk = self.badPixelMask[extn][rows2slice(rows)]
+						_stack.mask |= load_mask(bpmsk,'gtzero')
+					if self.minNexp is not None:
+						nexp = np.sum(~imCube.mask,axis=-1)
+						_stack.mask |= nexp < self.minNexp
+					stack.append(_stack)
+					if self.withExpTimeMap:
+						expTime.append(self._exposure_time(imCube,expTimes))
+					if self.withVariance:
+						# XXX this isn't the right variance for a weighted sum,
+						#     really the var calculation needs to happen in 
+						#     _stack_cube since it is implementation-dependent
+						var.append(np.ma.var(imCube,axis=-1))
+					# release references to the band buffer before the reader
+					# is allowed to refill it
+					del imCube,_mask,w
+				stack = np.ma.vstack(stack)
+				# the stack is float, not the scaled int16 of the inputs
+				hdr = strip_quantization(fitsio.read_header(inputFiles[0],
+				                                            extn))
+				stack,hdr = self._postprocess(extn,stack,hdr)
+				try:
+					finalStack = stack.filled(self.fillValue)
+					finalStack = finalStack.astype(np.float32)
+				except AttributeError:
+					finalStack = stack.astype(np.float32)
+				outFits.write(finalStack,extname=extn,header=hdr)
+				if self.withExpTimeMap:
+					expTime = np.ma.vstack(expTime)
+					expTimeFits.write(expTime,extname=extn,header=hdr)
+				if self.withVariance:
+					var = np.ma.vstack(var)
+					var = var.filled(0).astype(np.float32)
+					varFits.write(var,extname=extn,header=hdr)
+		finally:
+			# stops the reader thread and closes the inputs also when
+			# combining fails
+			bandIter.close()
+			reader.close()
 		outFits.close()
 		if self.withExpTimeMap:
 			expTimeFits.close()
@@ -915,5 +2475,6 @@ class ClippedMeanStack(BokMefImageCube):
 
 class MedianStack(BokMefImageCube):
 	def _stack_cube(self,imCube,weights=None):
-		return np.ma.median(imCube,axis=-1).astype(np.float32)
+		stack,nvalid = nan_median_cube(to_nan_array(imCube))
+		return np.ma.masked_array(stack.astype(np.float32),mask=(nvalid==0))
 
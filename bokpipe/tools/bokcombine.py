@@ -21,12 +21,24 @@ parser = argparse.ArgumentParser()
 parser.add_argument("inputFiles",type=str,nargs='+',
                     help="input FITS images")
 parser.add_argument("-m","--method",type=str,default="mean",
-                    help="stacking method (mean|median|mode)")
+                    help="stacking method "
+                         "(mean|median|minmax|percentile|clipped_mean)")
 parser.add_argument("-o","--output",type=str,default="bokstack.fits",
                     help="output image")
 parser.add_argument("-r","--reject",action='store_true',
 #                    default="sigma_clip",
                     help="apply rejection")
+parser.add_argument("--rejectmethod",type=str,default="sigma_clip",
+                    help="rejection method when -r is set "
+                         "([sigma_clip]|minmax|percentile)")
+parser.add_argument("--nlow",type=int,default=1,
+                    help="number of low values to reject for minmax [1]")
+parser.add_argument("--nhigh",type=int,default=1,
+                    help="number of high values to reject for minmax [1]")
+parser.add_argument("--plow",type=float,default=10.,
+                    help="lower percentile limit for percentile [10]")
+parser.add_argument("--phigh",type=float,default=90.,
+                    help="upper percentile limit for percentile [90]")
 parser.add_argument("-s","--scale",action='store_true',
 #                    default="normalize_median",
                     help="scale images before combining")
@@ -58,7 +70,9 @@ stackPars = {}
 if args.scale:
 	stackPars['scale'] = 'normalize_mean'
 if args.reject:
-	stackPars['reject'] = 'sigma_clip'
+	stackPars['reject'] = args.rejectmethod
+for k in ['nlow','nhigh','plow','phigh']:
+	stackPars[k] = getattr(args,k)
 if args.clip_iters:
 	stackPars['clip_iters'] = args.clip_iters
 if args.clip_sig:
@@ -83,6 +97,8 @@ if args.method == 'mean':
 	stackFun = bokutil.ClippedMeanStack(**stackPars)
 elif args.method == 'median':
 	stackFun = bokutil.MedianStack(**stackPars)
+else:
+	stackFun = bokutil.ClippedMeanStack(stack_method=args.method,**stackPars)
 
 inputFiles = _read_file_list(args.inputFiles)
 print 'input: ',inputFiles
@@ -15,7 +15,9 @@ parser.add_argument("inputFiles",type=str,nargs='+',
 parser.add_argument("-e","--ext",type=str,default="all",
                     help="select FITS extension(s) [default=all]")
 parser.add_argument("-f","--fields",type=str,default="mean,std",
-                    help="which stats to calculate [default: mean,std]")
+                    help="which stats to calculate, any of mean,median,"
+                         "mode,std,min,max,npix or pNN for percentiles "
+                         "[default: mean,std]")
 parser.add_argument("-s","--statsreg",type=str,
                     help="image region to calculate stats on")
 parser.add_argument("--stride",type=int,
@@ -28,6 +30,8 @@ parser.add_argument("--checkbad",action="store_true",
                     help="check for bad values in the image")
 parser.add_argument("--showbad",action="store_true",
                     help="dump coordinates of bad values")
+parser.add_argument("-o","--output",type=str,
+                    help="save the stats table to a FITS file")
 args = parser.parse_args()
 
 if args.ext=='all':
@@ -49,6 +53,9 @@ imstat = BokImStat(extensions=extns,fields=fields,
                    processes=args.processes,procmap=procmap)
 imstat.process_files(args.inputFiles)
 
+if args.output:
+	imstat.data.write(args.output,overwrite=True)
+
 #np.set_printoptions(precision=2,suppress=True)
 np.set_printoptions(threshold=np.inf)
 
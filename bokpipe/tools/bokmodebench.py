@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import os,sys
+import time
+import numpy as np
+import fitsio
+
+from bokpipe import bokutil
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument("inputFiles",type=str,nargs='+',
+                    help="input FITS images")
+parser.add_argument("-e","--ext",type=str,default="all",
+                    help="select FITS extension(s) [default=all]")
+parser.add_argument("-s","--statsreg",type=str,
+                    help="image region to calculate stats on")
+parser.add_argument("--stride",type=int,
+                    help="stride to use in stats region")
+parser.add_argument("-n","--nrepeat",type=int,default=3,
+                    help="number of timing repeats [default=3]")
+parser.add_argument("--clipengine",type=str,default='astropy',
+                    help="sigma-clipping engine ([astropy]|nan)")
+args = parser.parse_args()
+
+bokutil.set_clip_engine(args.clipengine)
+
+estimators = bokutil.mode_estimators
+reg = bokutil.stats_region(args.statsreg,args.stride)
+
+def time_mode(im,estimator):
+	bokutil.set_mode_estimator(estimator)
+	t = []
+	for i in range(args.nrepeat):
+		t1 = time.time()
+		v = bokutil.array_stats(im,method='mode')
+		t.append(time.time()-t1)
+	return v,min(t)
+
+print '%-20s %-5s %8s ' % ('file','ext','npix'),
+print ' '.join(['%10s %7s' % (e,'t[ms]') for e in estimators]),
+print ' %8s %8s' % ('dhist','dpeak')
+tot = np.zeros(len(estimators))
+for f in args.inputFiles:
+	fits = bokutil.BokMefImage(f,read_only=True)
+	for extn,data,hdr in fits:
+		if args.ext != 'all' and extn not in args.ext.split(','):
+			continue
+		im = np.ma.masked_array(data,mask=~np.isfinite(data))[reg]
+		res = [ time_mode(im,e) for e in estimators ]
+		tot += [ r[1] for r in res ]
+		print '%-20s %-5s %8d ' % (os.path.basename(f)[:20],extn,im.size),
+		print ' '.join(['%10.2f %7.1f' % (v,1e3*t) for v,t in res]),
+		print ' %8.3f %8.3f' % (res[1][0]-res[0][0],res[2][0]-res[0][0])
+	fits.close()
+
+print 'total time [s]: ',
+print ' '.join(['%s=%.3f' % (e,t) for e,t in zip(estimators,tot)])
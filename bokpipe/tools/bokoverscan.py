@@ -27,6 +27,10 @@ parser.add_argument("--oscan_cols_file",type=str,default="oscan_cols",
                     help="")
 parser.add_argument("--oscan_rows_file",type=str,default="oscan_rows",
                     help="")
+parser.add_argument("--oscan_history",action="store_true",
+                    help="add to the existing overscan history")
+parser.add_argument("--oscan_image_format",type=str,
+                    help="format of overscan image ([fits]|npz)")
 parser.add_argument("--row_apply_filter",
                     help="([median]|none")
 parser.add_argument("--row_method",type=str,
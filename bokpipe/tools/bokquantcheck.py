@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import os,sys
+import numpy as np
+
+from bokpipe import bokutil
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument("inputFiles",type=str,nargs='+',
+                    help="input FITS images")
+parser.add_argument("-e","--ext",type=str,default="all",
+                    help="select FITS extension(s) [default=all]")
+parser.add_argument("-q","--quantlevel",type=str,default="4",
+                    help="noise/step level(s) to test, comma-separated "
+                         "[default=4]")
+args = parser.parse_args()
+
+qlevels = [ float(q) for q in args.quantlevel.split(',') ]
+
+print '%-20s %-5s %5s %9s %9s %7s %7s %7s %6s %6s' % \
+        ('file','ext','qlev','noise','bscale','step','maxerr','rmserr',
+         'nclip','nblank')
+worst = dict((q,0.) for q in qlevels)
+for f in args.inputFiles:
+	fits = bokutil.BokMefImage(f,read_only=True)
+	for extn,data,hdr in fits:
+		if args.ext != 'all' and extn not in args.ext.split(','):
+			continue
+		for q in qlevels:
+			r = bokutil.quantization_report(data,q)
+			worst[q] = max(worst[q],r['maxerr'])
+			print '%-20s %-5s %5.1f %9.3f %9.4f %7.3f %7.3f %7.3f %6d %6d' % \
+			        (os.path.basename(f)[:20],extn,q,r['noise'],r['bscale'],
+			         r['stepnoise'],r['maxerr'],r['rmserr'],
+			         r['nclip'],r['nblank'])
+	fits.close()
+
+print 'worst-case error [sigma]: ',
+print ' '.join(['q=%.1f:%.3f' % (q,worst[q]) for q in qlevels])
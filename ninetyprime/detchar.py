@@ -11,6 +11,7 @@ from astropy.stats import sigma_clip
 from astropy.table import Table,vstack
 
 from bokpipe.bokoscan import extract_overscan,fit_overscan,overscan_subtract
+from bokpipe.bokoscan import load_overscan_sidecar,subtract_overscan_fit
 from bokpipe.bokproc import ampOrder
 from bokpipe.bokutil import stats_region,array_clip,array_stats
 
@@ -29,6 +30,10 @@ def _open_fits(f):
 		return fitsio.FITS(f+'.fz')
 
 def calc_gain_rdnoise(biases,flats):
+	# the gain and read noise come from the pixel statistics of the image
+	# region of bias and flat pairs, no overscan fits are involved, so 
+	# the overscan sidecars have nothing to offer here and the raw frames
+	# are always read
 	rv = []
 	s = stats_region('amp_corner_ccdcenter_1024')
 	for files in zip(biases[:-1],biases[1:],flats[:-1],flats[1:]):
@@ -201,7 +206,7 @@ def find_cal_sequences(log,min_len=5):
 				calseqs['zero_and_flat'].append((bs,calseqs['flat'][j]))
 	return calseqs
 
-def bias_checks(bias,overscan=False):
+def bias_checks(bias,overscan=False,sidecar_map=None):
 	i = 0
 	rv = np.zeros(1,dtype=[('fileName','S35'),
 	                       ('sliceMeanAdu','f4',(16,)),
@@ -217,6 +222,13 @@ def bias_checks(bias,overscan=False):
 	if len(fits[1:]) != 16:
 		print 'ERROR: %s has %d img extensions' % (fn,len(fits[1:]))
 		return rv
+	# overscan models saved by the pipeline, if available and fit with the
+	# defaults of overscan_subtract (otherwise the residuals are refit, so
+	# that they have the same definition with or without the sidecars)
+	oscanModels = None
+	if sidecar_map is not None:
+		oscanModels = load_overscan_sidecar(sidecar_map(bias),bias,
+		                                    fit_args={})
 	for j,hdu in enumerate(fits[1:]):
 		imNum = 'IM%d' % ampOrder[j]
 		try:
@@ -250,7 +262,11 @@ def bias_checks(bias,overscan=False):
 		if np.median(middleslice-bottomslice) > 15:
 			print 'found drop in ',bias,j
 			rv['dropFlag'][i,j] = 1
-		bias_residual = overscan_subtract(data,hdr)
+		if oscanModels is not None and imNum in oscanModels:
+			_,colbias,rowbias,_ = oscanModels[imNum]
+			bias_residual = subtract_overscan_fit(data,hdr,colbias,rowbias)
+		else:
+			bias_residual = overscan_subtract(data,hdr)
 		s = stats_region('amp_central_quadrant')
 		mn,sd = array_stats(bias_residual[s],method='mean',rms=True,
 		                    clip_sig=5.0,clip_iters=2)
@@ -258,6 +274,17 @@ def bias_checks(bias,overscan=False):
 		rv['residualRmsAdu'][i,j] = sd
 	return rv
 
+class SidecarMap(object):
+	'''maps raw file paths to the overscan sidecars (.oscfit) made by the 
+	   pipeline, which keeps the UT date subdirectories of the raw data'''
+	def __init__(self,dataDir,sidecarDir):
+		self.dataDir = dataDir
+		self.sidecarDir = sidecarDir
+	def __call__(self,f):
+		f = os.path.relpath(f,self.dataDir)
+		return os.path.join(self.sidecarDir,
+		                    f.replace('.fits','.oscfit.fits'))
+
 def quick_parallel(fun,input,nproc,**kwargs):
 	if nproc > 1:
 		fun_with_args = partial(fun,**kwargs)
@@ -271,7 +298,7 @@ def quick_parallel(fun,input,nproc,**kwargs):
 	return np.concatenate(rv)
 
 def run_qa(log,logFits,datadir,nproc=1,dogainrn=True,dobitcheck=True,
-	       nsplit=0,nrun=0):
+	       nsplit=0,nrun=0,sidecar_map=None):
 	imType = np.char.rstrip(log['imType'])
 	fileNames = np.char.rstrip(log['fileName'])
 	utDirs = np.char.rstrip(log['utDir'])
@@ -327,7 +354,8 @@ def run_qa(log,logFits,datadir,nproc=1,dogainrn=True,dobitcheck=True,
 		print ii[0],len(ii)
 	print 'checking overscans for ',len(ii),' images'
 	images = filePaths[ii]
-	biasrmp = quick_parallel(bias_checks,images,nproc,overscan=True)
+	biasrmp = quick_parallel(bias_checks,images,nproc,overscan=True,
+	                         sidecar_map=sidecar_map)
 	biasrmp = np.lib.recfunctions.append_fields(biasrmp,'imType',imType[ii],
 	                                            dtypes=imType.dtype)
 	logFits.write(biasrmp,extname='OSCANCHK')
@@ -504,6 +532,8 @@ if __name__=='__main__':
 	                    help="which chunk number to run")
 	parser.add_argument("-u","--utdate",type=str,
 	                    help="restrict UT date")
+	parser.add_argument("--oscandir",type=str,
+	                    help="directory with pipeline overscan sidecars")
 	args = parser.parse_args()
 	#
 	if args.utdate is not None:
@@ -521,7 +551,9 @@ if __name__=='__main__':
 				run_qa(log,logFits,args.datadir,nproc=args.nproc,
 				       dogainrn=(not args.nogainrn),
 				       dobitcheck=(not args.nobitcheck),
-				       nsplit=args.numsplit,nrun=args.splitnum)
+				       nsplit=args.numsplit,nrun=args.splitnum,
+				       sidecar_map=None if args.oscandir is None
+				           else SidecarMap(args.datadir,args.oscandir))
 				logFits.close()
 				# if this isn't here multiprocess gets stuck in an infinite
 				# loop... why?
@@ -61,9 +61,7 @@ def process_data(dataMap,redo=True,withvar=True,oscanims=False,bias2d=False):
 		#imProcess.process_files(flatFrames)
 
 def imstat(dataMap,outfn='stats'):
-	from astropy.stats import sigma_clip
-	from scipy.stats import mode,scoreatpercentile
-	array_stats = bokutil.array_stats
+	fields = ['mode','mean','median','p25','p75','p10','p90']
 	fnlen = len(os.path.basename(dataMap['files'][0]))
 	st = np.zeros(len(dataMap['flatSequence']),
 	              dtype=[('file','S%d'%fnlen),
@@ -83,16 +81,13 @@ def imstat(dataMap,outfn='stats'):
 		st['file'][_i] = fn
 		st['expTime'][_i] = expTime
 		for j,extn in enumerate(['IM%d' % n for n in range(1,17)]):
-			modeVal,pix = array_stats(fits[extn].read()[dataMap['statsPix']],
-			                          method='mode',retArray=True)
-			st['mode'][_i,j] = modeVal
-			st['mean'][_i,j] = pix.mean()
-			st['median'][_i,j] = np.ma.median(pix)
-			st['iqr25'][_i,j] = scoreatpercentile(pix,25)
-			st['iqr75'][_i,j] = scoreatpercentile(pix,75)
-			st['iqr10'][_i,j] = scoreatpercentile(pix,10)
-			st['iqr90'][_i,j] = scoreatpercentile(pix,90)
-			print '%5d ' % (modeVal),
+			v = bokutil.array_multi_stats(
+			                  fits[extn].read()[dataMap['statsPix']],fields)
+			for k in ['mode','mean','median']:
+				st[k][_i,j] = v[k]
+			for p in [25,75,10,90]:
+				st['iqr%d'%p][_i,j] = v['p%d'%p]
+			print '%5d ' % (v['mode']),
 		print
 	fitsio.write(outfn+'.fits',st,clobber=True)
 
@@ -0,0 +1,6 @@
+import os,sys
+
+# run the tests against the source tree
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,_root)
+os.environ.setdefault('BOKPIPE',os.path.join(_root,'bokpipe'))
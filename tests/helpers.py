@@ -0,0 +1,20 @@
+import numpy as np
+import fitsio
+
+def write_mef(fileName,ims,extNames=None,hdrs=None,hdr0=None):
+	'''write a list of 2d arrays as a multi-extension FITS file'''
+	if extNames is None:
+		extNames = [ 'IM%d' % (i+1) for i in range(len(ims)) ]
+	fits = fitsio.FITS(fileName,'rw',clobber=True)
+	fits.write(None,header=hdr0)
+	for i,(extn,im) in enumerate(zip(extNames,ims)):
+		hdr = None if hdrs is None else hdrs[i]
+		fits.write(im,extname=extn,header=hdr)
+	fits.close()
+	return fileName
+
+def random_mef(fileName,next=4,shape=(64,48),seed=1,**kwargs):
+	rs = np.random.RandomState(seed)
+	ims = [ rs.normal(1000,10,size=shape).astype(np.float32)
+	          for i in range(next) ]
+	return write_mef(fileName,ims,**kwargs),ims
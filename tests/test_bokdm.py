@@ -0,0 +1,51 @@
+import threading
+import numpy as np
+from astropy.table import Table
+
+from bokpipe import bokdm
+
+from helpers import random_mef
+
+class _CountingLock(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.n = 0
+	def __enter__(self):
+		self.n += 1
+		return self.lock.__enter__()
+	def __exit__(self,*args):
+		return self.lock.__exit__(*args)
+
+def test_master_loaded_once(tmpdir,monkeypatch):
+	fn,ims = random_mef(str(tmpdir.join('master.fits')))
+	lock = _CountingLock()
+	monkeypatch.setattr(bokdm.MasterCalibrator,'_loadLock',lock)
+	cal = bokdm.MasterCalibrator(fn)
+	def _get(extn):
+		return cal.getImage(extn)
+	threads = [ threading.Thread(target=_get,args=('IM%d'%(i%4+1),))
+	              for i in range(8) ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	assert cal.nLoads == 1
+	n = lock.n
+	for extNum,im in enumerate(ims,start=1):
+		assert np.array_equal(cal['IM%d'%extNum],im)
+	# the lock is only taken until the image is loaded
+	assert lock.n == n
+
+def test_storage_does_not_leak_to_shared_maps(tmpdir):
+	obsDb = Table(dict(utDate=['20150101']*2,filter=['g','g'],
+	                   imType=['zero','object'],fileName=['a','b']))
+	dm = bokdm.BokDataManager(obsDb,str(tmpdir),str(tmpdir))
+	dm.setProcessSteps(['oscan','proc1'])
+	dm.calNameMap = bokdm.SimpleFileNameMap(None,dm.getCalDir())
+	dm.setStorage(['cal','proc1'],'int16',2.)
+	calMap = dm('cal')
+	assert (calMap.storage,calMap.quantLevel) == ('int16',2.)
+	assert not hasattr(dm.calNameMap,'storage')
+	assert calMap('x') == dm.calNameMap('x')
+	assert dm('proc1').storage == 'int16'
+	assert not hasattr(dm('bias'),'storage')
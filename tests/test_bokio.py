@@ -0,0 +1,65 @@
+import os
+import threading
+from time import time
+
+from bokpipe import bokio
+
+def _write(path,nbytes=1000):
+	with open(path,'wb') as f:
+		f.write('x'*nbytes)
+
+def _age(path,dt=3600):
+	t = time() - dt
+	os.utime(path,(t,t))
+
+def test_store_resolve_and_flush(tmpdir):
+	store = bokio.TmpfsFileStore(str(tmpdir.join('store')))
+	diskDir = tmpdir.mkdir('data')
+	onDisk = str(diskDir.join('a.fits'))
+	_write(onDisk)
+	assert store.resolve(onDisk) == onDisk
+	newf = str(diskDir.join('b.fits'))
+	storePath = store.resolve(newf)
+	assert storePath.startswith(store.storeDir+os.sep)
+	assert store.resolve(storePath) == storePath
+	_write(storePath)
+	assert store.resolve(newf) == storePath
+	assert store.report()['nfiles'] == 1
+	nameMap = bokio.StoreNameMap(store,bokio.FileNameMap(str(diskDir)))
+	assert nameMap('b.fits') == storePath
+	store.flush()
+	assert open(newf).read() == 'x'*1000
+	assert store.files() == []
+	store.clear()
+	assert not os.path.exists(store.storeDir)
+
+def test_spill_keeps_recently_resolved(tmpdir):
+	storeDir = str(tmpdir.join('store'))
+	diskDir = tmpdir.mkdir('data')
+	store = bokio.TmpfsFileStore(storeDir,capacity=2500./1024**2)
+	paths = [ str(diskDir.join('f%d.fits'%i)) for i in range(3) ]
+	for p in paths[:2]:
+		_write(store.resolve(p))
+		_age(store.storePath(p))
+	# resolving a file marks it as in use
+	assert store.resolve(paths[0]) == store.storePath(paths[0])
+	# another worker needs room for a new file
+	other = bokio.TmpfsFileStore(storeDir,capacity=2500./1024**2)
+	assert other.resolve(paths[2]) == other.storePath(paths[2])
+	assert other.nSpilled == 1
+	assert os.path.exists(store.storePath(paths[0]))
+	assert not os.path.exists(store.storePath(paths[1]))
+	assert open(paths[1]).read() == 'x'*1000
+	assert store.resolve(paths[1]) == paths[1]
+
+def test_resolve_waits_for_lock(tmpdir):
+	store = bokio.TmpfsFileStore(str(tmpdir.join('store')))
+	path = str(tmpdir.join('a.fits'))
+	rv = []
+	t = threading.Thread(target=lambda: rv.append(store.resolve(path)))
+	with store._locked():
+		t.start()
+		t.join(0.2)
+		assert rv == []
+	t.join()
+	assert rv == [store.storePath(path)]
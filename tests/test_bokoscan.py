@@ -0,0 +1,101 @@
+import os
+import numpy as np
+import fitsio
+
+from bokpipe import bokproc
+from bokpipe.bokio import FileNameMap
+from bokpipe.bokoscan import OverscanCollection,BokOverscanSubtract
+from bokpipe.bokoscan import load_overscan_sidecar,subtract_overscan_fit
+from bokpipe.bokoscan import overscan_subtract
+from bokpipe.bokproc import BokWeightMap
+
+from helpers import write_mef
+
+def _strip(v,shape=(20,4)):
+	return np.full(shape,v,dtype=np.float32)
+
+def test_collection_ordered_by_time(tmpdir):
+	imgFile = str(tmpdir.join('oscan_IM1'))
+	coll = OverscanCollection(imgFile)
+	# completion order of the workers, with f2 processed twice
+	for f,mjd in [('f3',3.),('f1',1.),('f2',2.),('f0',np.nan),('f2',2.)]:
+		v = 10*mjd if f != 'f2' else 7.
+		coll.append(_strip(v),np.zeros(20),f+'.fits',mjd=mjd)
+	recs = coll.records()
+	assert list(recs['file']) == ['f1.fits','f2.fits','f3.fits','f0.fits']
+	assert np.allclose(recs['oscan'][:3,0,0],[10.,7.,30.])
+	assert np.isnan(recs['oscan'][3,0,0])
+	coll.write_image()
+	im,hdr = fitsio.read(imgFile+'.fits',header=True)
+	assert [ hdr['OVSCN%03d'%n] for n in range(1,5) ] == \
+	         ['f1.fits','f2.fits','f3.fits','f0.fits']
+	assert np.allclose(im[0,[0,4,8]],[10.,7.,30.])
+	tab = fitsio.read(imgFile+'.fits',ext='FRAMES')
+	assert list(tab['file']) == list(recs['file'])
+	coll.close()
+
+def _raw_frame(rawFile,nx=100,ny=90,nox=20,noy=8):
+	rs = np.random.RandomState(3)
+	raw = fitsio.FITS(rawFile,'rw',clobber=True)
+	raw.write(None,header={'EXPTIME':30.})
+	hdr = {'DATASEC':'[1:%d,1:%d]'%(nx,ny),
+	       'BIASSEC':'[%d:%d,1:%d]'%(nx+1,nx+nox,ny)}
+	for extn in bokproc.bok90mef_extensions:
+		d = rs.normal(1500,10,(ny+noy,nx+nox))
+		d[:ny,:nx] += rs.poisson(2000,(ny,nx))
+		d[40:50,40:50] = 64000
+		d[20,20] = 0
+		raw.write(d.astype(np.uint16),extname=extn,header=hdr)
+	raw.close()
+	return np.zeros((ny,nx),dtype=np.uint8)
+
+def test_weight_map_from_oscan_sidecar(tmpdir):
+	rawDir = str(tmpdir.mkdir('raw'))
+	mask = _raw_frame(os.path.join(rawDir,'r0.fits'))
+	mask[:,10] = 1
+	bpFile = str(tmpdir.join('badpix.fits'))
+	write_mef(bpFile,[mask]*16,extNames=bokproc.bok90mef_extensions)
+	bpMap = lambda f: bpFile
+	m = lambda sfx: FileNameMap(str(tmpdir),sfx)
+	raw = FileNameMap(rawDir)
+	BokOverscanSubtract(input_map=raw,output_map=m('_o'),
+	                    oscan_sidecar_map=m('.oscfit'),
+	                    debug=True).process_files(['r0.fits'])
+	BokWeightMap(input_map=raw,output_map=m('.wht0'),_mask_map=bpMap,
+	             debug=True).process_files(['r0.fits'])
+	whmap = BokWeightMap(input_map=raw,output_map=m('.wht1'),
+	                     oscan_map=m('_o'),oscan_sidecar_map=m('.oscfit'),
+	                     _mask_map=bpMap,debug=True)
+	# the raw counts come from the overscan-subtracted image
+	assert whmap.inputNameMap('r0.fits') == str(tmpdir.join('r0_o.fits'))
+	whmap.process_files(['r0.fits'])
+	w0 = fitsio.FITS(str(tmpdir.join('r0.wht0.fits')))
+	w1 = fitsio.FITS(str(tmpdir.join('r0.wht1.fits')))
+	for extn in bokproc.bok90mef_extensions:
+		ivar = w1[extn].read()
+		assert np.array_equal(ivar,w0[extn].read())
+		assert np.all(ivar[40:50,40:50]==0) and ivar[20,20]==0 and \
+		         np.all(ivar[:,10]==0)
+
+def test_sidecar_fit_args(tmpdir):
+	rawDir = str(tmpdir.mkdir('raw'))
+	rawFile = os.path.join(rawDir,'r0.fits')
+	_raw_frame(rawFile)
+	m = lambda sfx: FileNameMap(str(tmpdir),sfx)
+	raw = FileNameMap(rawDir)
+	for sfx,kwargs in [('_d',{}),('_m',{'method':'median_value'})]:
+		BokOverscanSubtract(input_map=raw,output_map=m(sfx),
+		                    oscan_sidecar_map=m(sfx+'.oscfit'),debug=True,
+		                    **kwargs).process_files(['r0.fits'])
+	sidecar = lambda sfx: str(tmpdir.join('r0%s.oscfit.fits'%sfx))
+	assert load_overscan_sidecar(sidecar('_m'),rawFile) is not None
+	assert load_overscan_sidecar(sidecar('_m'),rawFile,fit_args={}) is None
+	models = load_overscan_sidecar(sidecar('_d'),rawFile,fit_args={})
+	# the saved models are those of overscan_subtract with its defaults
+	rawFits = fitsio.FITS(rawFile)
+	for extn in ['IM1','IM9']:
+		data,hdr = rawFits[extn].read(),rawFits[extn].read_header()
+		_,colbias,rowbias,_ = models[extn]
+		assert np.allclose(subtract_overscan_fit(data,hdr,colbias,rowbias),
+		                   overscan_subtract(data.astype(np.float32),hdr),
+		                   atol=1e-3)
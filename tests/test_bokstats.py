@@ -0,0 +1,25 @@
+import numpy as np
+
+from bokpipe import bokstats
+
+def test_hist_median_exact_for_counts():
+	rs = np.random.RandomState(2)
+	for v in [ rs.poisson(1000,size=1001),
+	           rs.poisson(1000,size=1000).astype(np.float32) ]:
+		assert bokstats.hist_median(v) == np.median(v)
+
+def test_hist_median_wide_range_integers():
+	# unit bins over the full range would need ~2**24 (or 2**40) counts
+	for v in [ np.array([0,3,7,2**24-1],dtype=np.float32),
+	           np.array([-2**40,5,17,2**40,9],dtype=np.int64) ]:
+		assert bokstats.hist_median(v) == np.median(v)
+
+def test_hist_estimators_masked_integers():
+	rs = np.random.RandomState(3)
+	v = rs.poisson(1000,size=2001)
+	arr = np.ma.masked_array(v,mask=(v>1040))
+	good = v[v<=1040]
+	assert bokstats.hist_median(arr) == np.median(good)
+	assert np.isclose(bokstats.nan_mode(arr,'histogram'),
+	                  3*np.median(good) - 2*good.mean())
+	assert np.abs(bokstats.nan_mode(arr,'peak') - 1000) < 20
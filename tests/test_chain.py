@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import fitsio
+
+from bokpipe import bokutil,bokproc
+from bokpipe.bokio import FileNameMap
+
+from helpers import random_mef,write_mef
+
+def _steps(tmpdir,suffix,**kwargs):
+	inMap = FileNameMap(str(tmpdir))
+	addMap = FileNameMap(str(tmpdir),'_add'+suffix)
+	mulMap = FileNameMap(str(tmpdir),'_mul'+suffix)
+	operand = str(tmpdir.join('operand.fits'))
+	return [ bokproc.BokImArith('+',operand,input_map=inMap,
+	                            output_map=addMap,**kwargs),
+	         bokproc.BokImArith('*',operand,input_map=addMap,
+	                            output_map=mulMap,**kwargs) ],mulMap
+
+def test_chain_matches_steps(tmpdir):
+	fn,ims = random_mef(str(tmpdir.join('raw.fits')))
+	write_mef(str(tmpdir.join('operand.fits')),[ np.full_like(im,1.5)
+	                                             for im in ims ])
+	steps,seqMap = _steps(tmpdir,'1')
+	for step in steps:
+		step.process_files([fn])
+	steps,chainMap = _steps(tmpdir,'2',hdu_threads=3)
+	chain = bokutil.BokProcessChain(steps,hdu_threads=3)
+	chain.process_files([fn])
+	# the intermediate product is consumed in memory
+	assert not os.path.exists(str(tmpdir.join('raw_add2.fits')))
+	seqFits = fitsio.FITS(seqMap(fn))
+	chainFits = fitsio.FITS(chainMap(fn))
+	assert len(seqFits) == len(chainFits) == len(ims)+1
+	for extNum,im in enumerate(ims,start=1):
+		seq = seqFits[extNum].read()
+		assert np.array_equal(seq,chainFits[extNum].read())
+		assert np.allclose(seq,(im+1.5)*1.5)
+		assert seqFits[extNum].get_extname() == \
+		         chainFits[extNum].get_extname()
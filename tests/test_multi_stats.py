@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from bokpipe import bokutil
+
+def _arrays():
+	rs = np.random.RandomState(5)
+	im = rs.normal(1000,20,(60,50)).astype(np.float32)
+	im[rs.rand(*im.shape) < 0.02] = 5e4
+	im[3,:10] = np.nan
+	counts = rs.poisson(800,(60,50)).astype(np.int32)
+	masked = np.ma.array(im,mask=rs.rand(*im.shape) < 0.1)
+	return [im,counts,masked]
+
+@pytest.fixture(params=[ (e,m) for e in bokutil._clip_engines
+                                for m in bokutil.mode_estimators ])
+def engine(request,monkeypatch):
+	monkeypatch.setenv('BOKPIPE_CLIP_ENGINE','astropy')
+	monkeypatch.setenv('BOKPIPE_MODE_ESTIMATOR','pearson')
+	engine,estimator = request.param
+	bokutil.set_clip_engine(engine)
+	bokutil.set_mode_estimator(estimator)
+	yield request.param
+	bokutil.set_clip_engine('astropy')
+	bokutil.set_mode_estimator('pearson')
+
+def _same(a,b):
+	a,b = np.asarray(a),np.asarray(b)
+	return a.shape == b.shape and (a == b or (np.isnan(a) and np.isnan(b)))
+
+@pytest.mark.parametrize('clipArgs',[{},{'clip_sig':3.0,'clip_iters':3}])
+def test_multi_stats_match_array_stats(engine,clipArgs):
+	fields = ['mean','median','mode','rms','p25','npix']
+	for arr in _arrays():
+		stats = bokutil.array_multi_stats(arr,fields,**clipArgs)
+		for k in ['mean','median','mode']:
+			assert _same(stats[k],bokutil.array_stats(arr,method=k,
+			                                          **clipArgs)), k
+		rms = bokutil.array_stats(arr,method='mean',rms=True,**clipArgs)[1]
+		assert _same(stats['rms'],rms)
+		# the other fields come from the same clipped pixels
+		stats,clipped = bokutil.array_multi_stats(arr,['npix','p50'],
+		                                          retArray=True,**clipArgs)
+		v = clipped.compressed()
+		v = v[np.isfinite(v)]
+		assert stats['npix'] == v.size
+		assert np.isclose(stats['p50'],np.median(v))
+
+def test_multi_stats_fields(engine):
+	arr = _arrays()[0]
+	assert bokutil.array_multi_stats(arr,[]) == {}
+	with pytest.raises(ValueError):
+		bokutil.array_multi_stats(arr,['mean','bogus'])
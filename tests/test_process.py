@@ -0,0 +1,80 @@
+import os
+import tempfile
+import threading
+import numpy as np
+import fitsio
+import pytest
+
+from bokpipe import bokutil,bokproc
+from bokpipe.bokio import FileNameMap
+
+from helpers import random_mef,write_mef
+
+class _Step(bokutil.BokProcess):
+	def process_hdu(self,extName,data,hdr):
+		return data,hdr
+
+def _failing_map(fun,args):
+	raise RuntimeError('pool failed')
+
+def test_resident_file_removed_on_error(tmpdir,monkeypatch):
+	monkeypatch.setattr(tempfile,'tempdir',str(tmpdir))
+	step = _Step(processes=2,procmap=_failing_map,resident=True)
+	with pytest.raises(RuntimeError):
+		step.process_files(['a.fits','b.fits'])
+	assert os.listdir(str(tmpdir)) == []
+	assert step.procMap is _failing_map
+
+class _ThreadedStep(_Step):
+	_hduParallel = True
+
+def test_hdu_thread_pools_closed(tmpdir):
+	fn,ims = random_mef(str(tmpdir.join('in.fits')))
+	nthreads = threading.active_count()
+	step = _ThreadedStep(output_map=FileNameMap(str(tmpdir),'_out'),
+	                     hdu_threads=3)
+	step.process_files([fn])
+	assert bokutil._hduPools == {}
+	assert threading.active_count() == nthreads
+	outFits = fitsio.FITS(str(tmpdir.join('in_out.fits')))
+	for extNum,im in enumerate(ims,start=1):
+		assert np.array_equal(outFits[extNum].read(),im)
+
+class _FailingStep(_Step):
+	def process_hdu(self,extName,data,hdr):
+		if extName == 'IM3':
+			raise ValueError('bad HDU')
+		return data+1,hdr
+
+@pytest.mark.parametrize('pipelined',[False,True])
+def test_failed_update_leaves_input(tmpdir,pipelined):
+	fn,ims = random_mef(str(tmpdir.join('in.fits')))
+	# quantized in-place updates go through a temporary file
+	step = _FailingStep(storage='int16',pipelined=pipelined)
+	with pytest.raises(ValueError):
+		step.process_file(fn)
+	assert os.listdir(str(tmpdir)) == ['in.fits']
+	fits = fitsio.FITS(fn)
+	for extNum,im in enumerate(ims,start=1):
+		assert np.array_equal(fits[extNum].read(),im)
+
+def _open_files():
+	fds = []
+	for fd in os.listdir('/proc/self/fd'):
+		try:
+			fds.append(os.readlink(os.path.join('/proc/self/fd',fd)))
+		except OSError:
+			pass
+	return fds
+
+def test_gain_balance_closes_files_on_error(tmpdir):
+	fn,ims = random_mef(str(tmpdir.join('in.fits')),next=16,
+	                    extNames=bokproc.bok90mef_extensions)
+	# a bright star mask without CCD2..4
+	bsFile = write_mef(str(tmpdir.join('bs.fits')),[np.zeros((8,8))],
+	                   extNames=['CCD1'])
+	step = bokproc.BokCalcGainBalanceFactors(ccd_mask_map=lambda f: bsFile)
+	# the traceback keeps the frames, and any FITS left open, alive
+	with pytest.raises(IOError) as excinfo:
+		step.process_file(fn)
+	assert not set([fn,bsFile]) & set(_open_files())
@@ -0,0 +1,47 @@
+from functools import partial
+import pytest
+
+from bokpipe import bokutil
+
+def _square(x):
+	return x*x
+
+class _Echo(bokutil.BokProcess):
+	def process_file(self,f):
+		return (self.__class__.__name__,f)
+	def _ingestOutput(self,procOut):
+		self.out = procOut
+
+class _Echo2(_Echo):
+	pass
+
+@pytest.fixture
+def procmap():
+	pm = bokutil.AdaptiveProcMap(2)
+	yield pm
+	pm.close()
+
+def test_map_keeps_order(procmap):
+	items = range(50)
+	assert procmap(_square,items) == map(_square,items)
+	assert procmap.map(partial(pow,2),items) == [ 2**i for i in items ]
+	assert procmap([],[]) == []
+
+def test_task_keys():
+	p = _Echo()
+	assert bokutil._task_key(p._process_file_exc) == \
+	         '_Echo._process_file_exc'
+	for cls in [_Echo,_Echo2]:
+		task = bokutil._ResidentTask('x.pkl',cls.__name__,'_process_file_exc')
+		assert bokutil._task_key(task) == \
+		         '%s._process_file_exc' % cls.__name__
+	assert bokutil._task_key(partial(_square)) == '_square'
+
+def test_resident_timings_per_class(procmap):
+	files = [ 'f%d.fits'%i for i in range(6) ]
+	for cls in [_Echo,_Echo2]:
+		p = cls(processes=2,procmap=procmap,resident=True)
+		p.process_files(files)
+		assert p.out == [ (cls.__name__,f) for f in files ]
+	assert sorted(procmap.taskTime) == ['_Echo._process_file_exc',
+	                                    '_Echo2._process_file_exc']
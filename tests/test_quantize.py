@@ -0,0 +1,41 @@
+import numpy as np
+import fitsio
+import pytest
+
+from bokpipe import bokutil
+
+from helpers import write_mef
+
+def _images():
+	rs = np.random.RandomState(3)
+	noisy = rs.normal(1000,10,(64,48)).astype(np.float32)
+	# a smooth ramp far from zero has no pixel noise, the steps are then
+	# finer than the float32 resolution of the values
+	ramp = np.tile(np.linspace(49999,50001,48),(64,1)).astype(np.float32)
+	ims = [noisy,ramp]
+	for im in ims:
+		im[5,:3] = np.nan
+		im[10,20] = np.inf
+	return ims
+
+@pytest.mark.parametrize('pipelined',[False,True])
+def test_int16_round_trip(tmpdir,pipelined):
+	ims = _images()
+	inFile = str(tmpdir.join('in.fits'))
+	outFile = str(tmpdir.join('out.fits'))
+	write_mef(inFile,ims)
+	mef = (bokutil.PipelinedMefImage if pipelined else bokutil.BokMefImage)
+	fits = mef(inFile,output_file=outFile,storage='int16')
+	for extName,data,hdr in fits:
+		fits.update(data,hdr)
+	fits.close()
+	outFits = bokutil.BokMefImage(outFile,read_only=True)
+	assert outFits.fits[1].read().dtype == np.float32
+	for (extName,data,hdr),im in zip(outFits,ims):
+		assert hdr['QNBLANK'] == 4
+		good = np.isfinite(im)
+		assert np.array_equal(np.isfinite(data),good)
+		assert np.all(np.abs(data-im)[good] <= 0.5*hdr['BSCALE']+
+		                                      np.abs(im[good])*2**-23)
+		sub = outFits.get(extName,np.s_[4:12,:24])
+		assert np.array_equal(np.isfinite(sub),good[4:12,:24])
@@ -0,0 +1,37 @@
+import numpy as np
+import fitsio
+import pytest
+
+from bokpipe import bokutil
+
+from helpers import random_mef
+
+_subsets = [ np.s_[:,:], np.s_[5:20,3:40], np.s_[-10:,:-5],
+             np.s_[::2,::3], np.s_[1:60:7,2:47:9], np.s_[::-1,:],
+             np.s_[10:0:-2,::-1], np.s_[50:3:-8,40:1:-3], np.s_[::-10,5::7],
+             np.s_[-1:-20:-6,-2::-1], np.s_[3:4,7:8] ]
+_empty = [ np.s_[10:10,:], np.s_[:,20:5], np.s_[0:10:-1,::2],
+           np.s_[5:5:-9,3:3] ]
+
+@pytest.fixture(scope='module')
+def hdu(tmpdir_factory):
+	fn,ims = random_mef(str(tmpdir_factory.mktemp('rs').join('im.fits')),
+	                    next=1)
+	fits = fitsio.FITS(fn)
+	yield fits[1]
+	fits.close()
+
+@pytest.mark.parametrize('s',_subsets)
+def test_read_subset(hdu,s):
+	im = hdu.read()
+	sub = bokutil.read_subset(hdu,s)
+	assert sub.dtype == im.dtype
+	assert np.array_equal(sub,im[s])
+	assert np.array_equal(bokutil.read_subset(im,s),im[s])
+
+@pytest.mark.parametrize('s',_empty)
+def test_read_empty_subset(hdu,s):
+	im = hdu.read()
+	sub = bokutil.read_subset(hdu,s)
+	assert sub.shape == im[s].shape
+	assert sub.dtype == im.dtype
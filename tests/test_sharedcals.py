@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+
+from bokpipe import bokutil
+
+from helpers import random_mef
+
+@pytest.fixture
+def shm(tmpdir,monkeypatch):
+	monkeypatch.setattr(bokutil,'_shared_cal_base',lambda: str(tmpdir))
+	monkeypatch.setattr(bokutil,'_sharedCalDir',None)
+	monkeypatch.setattr(bokutil,'_sharedCalRunDir',None)
+	monkeypatch.delenv('BOKPIPE_SHARED_CAL_DIR',raising=False)
+	monkeypatch.setenv('BOKPIPE_SHARED_CALS','0')
+	yield tmpdir
+	bokutil.set_shared_calibrations(False)
+
+def test_shared_fits_matches_file(shm):
+	fn,ims = random_mef(str(shm.join('master.fits')))
+	bokutil.set_shared_calibrations(True)
+	fits = bokutil.open_calibration(fn)
+	assert isinstance(fits,bokutil.SharedFakeFITS)
+	for extNum,im in enumerate(ims,start=1):
+		assert np.array_equal(fits['IM%d'%extNum],im)
+	rep = bokutil.shared_calibration_report()
+	assert len(rep) == 1 and rep[0][1] >= fits.nbytes
+	bokutil.clear_shared_calibrations()
+
+def test_runs_keep_to_their_own_entries(shm):
+	fn,ims = random_mef(str(shm.join('master.fits')))
+	# an entry of another run sharing the same tmpfs
+	other = shm.mkdir('bokcals_1_xyz').mkdir('bokcal_other_0123')
+	other.join('1.npy').write('x')
+	bokutil.set_shared_calibrations(True)
+	runDir = bokutil.shared_calibration_dir()
+	assert os.path.dirname(runDir) == str(shm)
+	bokutil.open_calibration(fn)
+	assert [ e for e,n in bokutil.shared_calibration_report() ] == \
+	         os.listdir(runDir)
+	bokutil.clear_shared_calibrations()
+	assert not os.path.exists(runDir)
+	assert other.join('1.npy').check()
+	assert bokutil.shared_calibration_report(str(shm)) == []
@@ -0,0 +1,71 @@
+import threading
+import numpy as np
+import fitsio
+import pytest
+
+from bokpipe import bokutil
+from helpers import random_mef,write_mef
+
+def _inputs(tmpdir,n=3):
+	return [ random_mef(str(tmpdir.join('in%d.fits'%i)),seed=i)[0]
+	           for i in range(n) ]
+
+def test_stack_matches_mean(tmpdir):
+	files = _inputs(tmpdir)
+	outf = str(tmpdir.join('stack.fits'))
+	bokutil.ClippedMeanStack(reject=None,maxmem=1e-4).stack(files,outf)
+	for extn in ['IM1','IM4']:
+		expected = np.mean([ fitsio.read(f,extn) for f in files ],axis=0)
+		assert np.allclose(fitsio.read(outf,extn),expected,rtol=1e-6)
+
+class _FailingStack(bokutil.ClippedMeanStack):
+	def _combine(self,imCube,w,**kwargs):
+		raise RuntimeError('combine failed')
+
+def test_band_reader_closed_on_error(tmpdir,monkeypatch):
+	closed = []
+	origClose = bokutil.CubeBandReader.close
+	def close(self):
+		closed.append(True)
+		origClose(self)
+	monkeypatch.setattr(bokutil.CubeBandReader,'close',close)
+	nthreads = threading.active_count()
+	files = _inputs(tmpdir)
+	with pytest.raises(RuntimeError):
+		_FailingStack(reject=None,maxmem=1e-4).stack(files,
+		                                  str(tmpdir.join('stack.fits')))
+	assert closed == [True]
+	assert threading.active_count() == nthreads
+
+def _quantized_inputs(tmpdir,n=3):
+	files,floats = [],[]
+	for i in range(n):
+		fn,ims = random_mef(str(tmpdir.join('f%d.fits'%i)),seed=i)
+		ims[0][10,5+i:9+i] = np.nan
+		write_mef(fn,ims)
+		qf = str(tmpdir.join('q%d.fits'%i))
+		fits = bokutil.BokMefImage(fn,output_file=qf,storage='int16')
+		for extName,data,hdr in fits:
+			fits.update(data,hdr)
+		fits.close()
+		files.append(qf)
+		floats.append(ims)
+	return files,floats
+
+def test_stack_quantized_inputs(tmpdir):
+	files,floats = _quantized_inputs(tmpdir)
+	floatFiles = [ str(tmpdir.join('f%d.fits'%i)) for i in range(len(files)) ]
+	for inputs,outf in [(files,'stack.fits'),(floatFiles,'fstack.fits')]:
+		bokutil.ClippedMeanStack(reject=None,maxmem=1e-4).stack(inputs,
+		                                                 str(tmpdir.join(outf)))
+	# NaN pixels stack as NaN, as for float inputs, not at the BLANK value
+	for extn in ['IM1','IM2']:
+		stack = fitsio.read(str(tmpdir.join('stack.fits')),extn)
+		expected = fitsio.read(str(tmpdir.join('fstack.fits')),extn)
+		assert 'BSCALE' not in fitsio.read_header(str(tmpdir.join('stack.fits')),
+		                                          extn)
+		assert np.allclose(stack,expected,atol=2.,equal_nan=True)
+	# calibration readers restore the BLANK pixels too
+	for fits in [bokutil.FakeFITS(files[0]),
+	             bokutil.SharedFakeFITS(files[0],str(tmpdir))]:
+		assert np.array_equal(np.isnan(fits['IM1']),np.isnan(floats[0][0]))